@@ -0,0 +1,2 @@
+# Micro and loopback benchmarks, run from the src directory, e.g.
+#   python3 -m benchmarks.checksum
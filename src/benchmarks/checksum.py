@@ -0,0 +1,76 @@
+import argparse
+import os
+import random
+import sys
+import timeit
+from reliableUDP import checksum
+from reliableUDP.utilities import PACKET_SIZE, MAX_SEGMENT_SIZE, defaultHeaderLen
+
+# Lengths of the data the engines are checked with: every length up to a few
+# 64-bit words (odd ones included), then segment sizes and their neighbours
+CHECK_LENGTHS = list(range(0, 70)) + [PACKET_SIZE - 1, PACKET_SIZE, PACKET_SIZE + 1, MAX_SEGMENT_SIZE - 1,
+                                      MAX_SEGMENT_SIZE]
+
+
+# The (name, header, data) buffers every engine must give the loop's result
+# for: all-zero, all-0xFF and seeded random ones, as bytes and as views
+# that do not start at the beginning of their buffer
+def check_cases(seed=0):
+    rand = random.Random(seed)
+    for length in CHECK_LENGTHS:
+        for pattern in ('zero', 'ones', 'random'):
+            if pattern == 'zero':
+                header, data = bytes(defaultHeaderLen), bytes(length)
+            elif pattern == 'ones':
+                header, data = b'\xff' * defaultHeaderLen, b'\xff' * length
+            else:
+                header = bytes(rand.getrandbits(8) for i in range(defaultHeaderLen))
+                data = bytes(rand.getrandbits(8) for i in range(length))
+            yield '%s %d bytes' % (pattern, length), header, data
+            yield '%s %d bytes, view' % (pattern, length), bytearray(header), memoryview(b'\x00' + data)[1:]
+    # a header of ones with other data, and the other way round
+    yield 'ones header, zero data', b'\xff' * defaultHeaderLen, bytes(PACKET_SIZE)
+    yield 'zero header, ones data', bytes(defaultHeaderLen), b'\xff' * (PACKET_SIZE + 1)
+
+
+# Returns the (engine, case) pairs whose result differs from loop_sum
+def check_engines():
+    mismatches = []
+    for case, header, data in check_cases():
+        expected = checksum.loop_sum(header, data)
+        for name, engine in checksum.engines.items():
+            if engine(header, data) != expected:
+                mismatches.append((name, case))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the rUDP checksum engines')
+    parser.add_argument('-n', '--number', type=int, default=2000, help='Segments checksummed per engine')
+    parser.add_argument('-s', '--size', type=int, default=PACKET_SIZE, help='Payload size of a segment')
+    parser.add_argument('-c', '--check-only', action='store_true',
+                        help='Only check that the engines agree with the loop, without timing them')
+    args = parser.parse_args()
+    # every engine must be bit-identical to the loop, exits with 1 otherwise
+    mismatches = check_engines()
+    for name, case in mismatches:
+        print('engine %s differs from loop on %s' % (name, case))
+    if mismatches:
+        sys.exit(1)
+    print('%d engines agree with loop on %d lengths' % (len(checksum.engines), len(CHECK_LENGTHS)))
+    if args.check_only:
+        return
+    header = bytearray(os.urandom(defaultHeaderLen))
+    data = bytearray(os.urandom(args.size))
+    view = memoryview(data)
+    baseline = None
+    print('%-8s %12s %12s %10s' % ('engine', 'us/segment', 'MB/s', 'speedup'))
+    for name, engine in checksum.engines.items():
+        cost = timeit.timeit(lambda: engine(header, view), number=args.number) / args.number
+        if baseline is None:
+            baseline = cost
+        print('%-8s %12.2f %12.1f %9.1fx' % (name, cost * 1e6, args.size / cost / 1e6, baseline / cost))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+import argparse
+import heapq
+import random
+import socket
+import threading
+import time
+from benchmarks.loopback import sink, source
+from reliableUDP.client import rUDPClient
+from reliableUDP.server import rUDPServer
+from reliableUDP.utilities import fill_checksum
+
+
+# Relays the datagrams of one client to a server and back, dropping each with
+# probability loss and delivering the others delay seconds later. The client
+# checks the ports of the headers, the link puts its own and the client's in them.
+class lossyLink:
+    def __init__(self, serverAddr, loss, delay, seed=1):
+        self.serverAddr = serverAddr
+        self.loss = loss
+        self.delay = delay
+        self.random = random.Random(seed)
+        self.front = self.new_socket()
+        self.back = self.new_socket()
+        self.port = self.front.getsockname()[1]
+        self.clientAddr = None
+        self.dropped = 0
+        self.relayed = 0
+        # (due, serial, socket, data, addr) waiting to be delivered
+        self.pending = []
+        self.serial = 0
+        self.cond = threading.Condition()
+        self.closed = False
+        for target in (self.from_client, self.from_server, self.deliver):
+            threading.Thread(target=target, daemon=True).start()
+
+    def new_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024)
+        sock.bind(('127.0.0.1', 0))
+        sock.settimeout(0.5)
+        return sock
+
+    def from_client(self):
+        while not self.closed:
+            try:
+                data, addr = self.front.recvfrom(65536)
+            except socket.timeout:
+                continue
+            self.clientAddr = addr
+            self.forward(self.back, data, self.serverAddr)
+
+    def from_server(self):
+        while not self.closed:
+            try:
+                data, addr = self.back.recvfrom(65536)
+            except socket.timeout:
+                continue
+            if self.clientAddr is not None:
+                self.forward(self.front, self.rewrite(data), self.clientAddr)
+
+    def rewrite(self, data):
+        headerLen = (data[12] >> 4) * 4
+        header = bytearray(data[:headerLen])
+        header[0:2] = self.port.to_bytes(2, byteorder='big')
+        header[2:4] = self.clientAddr[1].to_bytes(2, byteorder='big')
+        fill_checksum(header, memoryview(data)[headerLen:])
+        return bytes(header) + data[headerLen:]
+
+    def forward(self, sock, data, addr):
+        if self.random.random() < self.loss:
+            self.dropped += 1
+            return
+        self.cond.acquire()
+        try:
+            self.serial += 1
+            heapq.heappush(self.pending, (time.monotonic() + self.delay, self.serial, sock, data, addr))
+            self.cond.notify()
+        finally:
+            self.cond.release()
+
+    def deliver(self):
+        while not self.closed:
+            self.cond.acquire()
+            try:
+                while not self.pending:
+                    self.cond.wait(0.5)
+                    if self.closed:
+                        return
+                due, serial, sock, data, addr = self.pending[0]
+                wait = due - time.monotonic()
+                if wait > 0:
+                    self.cond.wait(wait)
+                    continue
+                heapq.heappop(self.pending)
+            finally:
+                self.cond.release()
+            sock.sendto(data, addr)
+            self.relayed += 1
+
+    def close(self):
+        self.closed = True
+
+
+def transfer(total, segSize, controller, loss, delay, engine):
+    receiver = sink(total)
+    server = rUDPServer('127.0.0.1', 0, receiver, segSize, engine=engine, congestion=controller)
+    receiver.rudp = server
+    link = lossyLink(('127.0.0.1', server.conn.port), loss, delay)
+    sender = source(total)
+    client = rUDPClient(sender, segSize, engine=engine, congestion=controller)
+    sender.rudp = client
+    start = time.perf_counter()
+    threading.Thread(target=client.connect, args=['127.0.0.1', link.port], daemon=True).start()
+    finished = receiver.done.wait(300)
+    elapsed = time.perf_counter() - start
+    client.finished = True
+    link.close()
+    return finished, elapsed, client, link
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Congestion controllers over a link with emulated loss and delay')
+    parser.add_argument('-b', '--bytes', type=int, default=1024 * 1024, help='Bytes sent per transfer')
+    parser.add_argument('-s', '--segment-size', type=int, default=1452, help='Segment size to offer')
+    parser.add_argument('-c', '--controllers', default='reno,cubic,bbr', help='Comma separated controllers to run')
+    parser.add_argument('-l', '--loss', default='0,0.01', help='Comma separated loss probabilities')
+    parser.add_argument('-d', '--delay', default='0,20', help='Comma separated one way delays in ms')
+    parser.add_argument('-e', '--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='The transport engine of both ends')
+    args = parser.parse_args()
+    print('%-8s %-6s %-8s %10s %10s %10s %10s %10s %10s %10s' % ('control', 'loss', 'delay', 'seconds', 'MB/s',
+                                                             'dropped', 'recovered', 'timeouts', 'cwnd',
+                                                             'srtt ms'))
+    for loss in [float(l) for l in args.loss.split(',')]:
+        for delay in [float(d) for d in args.delay.split(',')]:
+            for controller in args.controllers.split(','):
+                finished, elapsed, client, link = transfer(args.bytes, args.segment_size, controller, loss,
+                                                           delay / 1000, args.engine)
+                srtt = (client.get_rtt() or 0) * 1000
+                stats = client.get_send_stats()
+                result = '%10.2f %10.2f' % (elapsed, args.bytes / elapsed / 1e6) if finished else \
+                    '%10s %10s' % ('timeout', '-')
+                # recovered counts the losses repaired by fast recovery
+                print('%-8s %-6g %-8g %s %10d %10d %10d %10d %10.1f' % (controller, loss, delay, result, link.dropped,
+                                                                        stats['fastRecoveries'], stats['timeouts'],
+                                                                        client.sendWin.get_cwnd(), srtt))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+import argparse
+import time
+from reliableUDP.utilities import *
+
+
+# Fills a window of segments in flight, then acks them in order every
+# ackEvery segments, as a receiver with delayed acks does
+def ack_window(window, ackEvery, segSize):
+    sendWin = sndBuffer(window * segSize, 'reno')
+    sendWin.segSize = segSize
+    sendWin.start()
+    pool = msgPool()
+    payload = bytes(segSize)
+    sent = []
+    for index in range(window):
+        sendWin.add(payload)
+        seqNum = index * segSize
+        mess = message(rUDPHeader(seqNum=seqNum, ACK=0).pack(), None, sendWin)
+        sendWin.send(mess)
+        pool.add_msg(mess, seqNum + segSize)
+        sent.append(seqNum + segSize)
+    acks = sent[ackEvery - 1::ackEvery]
+    start = time.perf_counter()
+    for ackNum in acks:
+        mess = pool.get_mess(ackNum)
+        sendWin.ack(mess)
+        pool.ack_to_num(ackNum)
+    return (time.perf_counter() - start) / len(acks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Cost per ack of the segments in flight over window sizes')
+    parser.add_argument('-w', '--windows', default='64,256,1024,4096,16384',
+                        help='Comma separated windows in segments')
+    parser.add_argument('-a', '--ack-every', type=int, default=ACK_EVERY, help='Segments covered by each ack')
+    parser.add_argument('-s', '--segment-size', type=int, default=1452, help='Segment size')
+    args = parser.parse_args()
+    print('%-8s %12s' % ('window', 'us/ack'))
+    for window in [int(w) for w in args.windows.split(',')]:
+        cost = ack_window(window, args.ack_every, args.segment_size)
+        print('%-8d %12.2f' % (window, cost * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.workers import SRC_DIR, start_server
+
+# Sends a sparse file larger than the 32-bit sequence space with lsend and
+# fetches it back with lget through server.py and client.py, then checks
+# that both copies match the original. Random blocks are written around
+# every 4 GiB boundary so that data misplaced across a wrap shows up.
+
+GIB = 1 << 30
+BLOCK = 64 * 1024
+
+
+def make_sparse(path, size, seed=1):
+    rand = random.Random(seed)
+    with open(path, 'wb') as f:
+        f.truncate(size)
+        offsets = [0, size - BLOCK]
+        for boundary in range(4 * GIB, size, 4 * GIB):
+            offsets += [boundary - BLOCK, boundary]
+        offsets += [rand.randrange(0, size - BLOCK) for i in range(8)]
+        for offset in offsets:
+            f.seek(max(0, offset))
+            f.write(rand.randbytes(min(BLOCK, size - max(0, offset))))
+
+
+def digest(path):
+    result = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(4 * 1024 * 1024)
+            if not data:
+                return result.hexdigest()
+            result.update(data)
+
+
+# Peak resident memory of a process in MB, None where /proc is missing
+def peak_rss(pid):
+    try:
+        with open('/proc/%d/status' % pid) as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def run_client(clientDir, port, engine, command, timeout, options=()):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'client.py'), '-e', engine] + list(options) +
+                               [command, '127.0.0.1:%d' % port, 'file.bin'],
+                               cwd=clientDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='End-to-end lsend and lget of a sparse file past 4 GiB')
+    parser.add_argument('-b', '--bytes', type=int, default=4 * GIB + 256 * 1024 * 1024,
+                        help='Size of the sparse file')
+    parser.add_argument('-e', '--engine', choices=['thread', 'asyncio'], default='asyncio',
+                        help='The transport engine of the server and the client')
+    parser.add_argument('-B', '--buffer-size', type=int, default=None,
+                        help='Sending and receiving buffers of both ends, bounding the window')
+    parser.add_argument('-t', '--timeout', type=float, default=1800, help='Seconds allowed for each transfer')
+    args = parser.parse_args()
+    options = ['-B', str(args.buffer_size)] if args.buffer_size is not None else []
+    baseDir = tempfile.mkdtemp(prefix='lftp-large-')
+    failures = 0
+    try:
+        dataDir = os.path.join(baseDir, 'data')
+        clientDir = os.path.join(baseDir, 'client')
+        os.makedirs(dataDir)
+        os.makedirs(clientDir)
+        original = os.path.join(clientDir, 'file.bin')
+        make_sparse(original, args.bytes)
+        expected = digest(original)
+        port = random.randint(20000, 60000)
+        server = start_server(dataDir, port, 1, args.engine, options)
+        try:
+            # the server's peak memory so far follows each transfer
+            print('%-6s %14s %10s %10s %8s %12s' % ('action', 'bytes', 'seconds', 'MB/s', 'intact',
+                                                   'server MB'))
+            elapsed = run_client(clientDir, port, args.engine, 'lsend', args.timeout, options)
+            uploaded = os.path.join(dataDir, 'file.bin')
+            intact = os.path.exists(uploaded) and digest(uploaded) == expected
+            failures += not intact
+            print('%-6s %14d %10.1f %10.1f %8s %12s' % ('lsend', args.bytes, elapsed, args.bytes / elapsed / 1e6,
+                                                        intact, '%.1f' % (peak_rss(server.pid) or 0)), flush=True)
+            os.remove(original)
+            elapsed = run_client(clientDir, port, args.engine, 'lget', args.timeout, options)
+            intact = os.path.exists(original) and digest(original) == expected
+            failures += not intact
+            print('%-6s %14d %10.1f %10.1f %8s %12s' % ('lget', args.bytes, elapsed, args.bytes / elapsed / 1e6,
+                                                        intact, '%.1f' % (peak_rss(server.pid) or 0)), flush=True)
+            if server.poll() is not None:
+                print('server exited with %d' % server.returncode)
+                failures += 1
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(baseDir, ignore_errors=True)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+import argparse
+import os
+import threading
+import time
+from reliableUDP.application import app
+from reliableUDP.client import rUDPClient
+from reliableUDP.server import rUDPServer
+from reliableUDP.utilities import DEFAULT_BUFFER_SIZE
+
+
+# Counts what the server receives
+class sink(app):
+    def __init__(self, total):
+        app.__init__(self)
+        self.total = total
+        self.received = 0
+        self.done = threading.Event()
+        self.lock = threading.Lock()
+        self.rudp = None
+
+    def process_data(self, user):
+        self.lock.acquire()
+        try:
+            conn = self.rudp.connections[user]
+            data = conn.consume_rcv_buffer()
+            self.received += len(data)
+            conn.release_rcv_buffer()
+            if self.received >= self.total:
+                self.done.set()
+        finally:
+            self.lock.release()
+
+    def next(self, user):
+        pass
+
+    def remove_user(self, user):
+        pass
+
+    def notify_close(self, user=None):
+        pass
+
+
+# Pushes total bytes through the client's sending buffer
+class source(app):
+    def __init__(self, total):
+        app.__init__(self)
+        self.total = total
+        self.sent = 0
+        self.data = memoryview(os.urandom(65536))
+        self.lock = threading.Lock()
+        self.rudp = None
+
+    def next(self, user=None):
+        self.lock.acquire()
+        try:
+            while self.sent < self.total:
+                size = min(self.rudp.segSize, self.total - self.sent)
+                if not self.rudp.append_snd_buffer(self.data[:size]):
+                    break
+                self.sent += size
+        finally:
+            self.lock.release()
+
+    def process_data(self, user=None):
+        pass
+
+    def remove_user(self, user):
+        pass
+
+    def notify_close(self):
+        pass
+
+
+def transfer(total, segSize, offload, engine, bufferSize=None):
+    receiver = sink(total)
+    server = rUDPServer('127.0.0.1', 0, receiver, segSize, offload, engine, bufferSize=bufferSize)
+    receiver.rudp = server
+    sender = source(total)
+    client = rUDPClient(sender, segSize, offload, engine, bufferSize)
+    sender.rudp = client
+    start = time.perf_counter()
+    threading.Thread(target=client.connect, args=['127.0.0.1', server.conn.port], daemon=True).start()
+    finished = receiver.done.wait(120)
+    elapsed = time.perf_counter() - start
+    client.finished = True
+    return finished, elapsed, client, server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Loopback rUDP throughput across segment sizes and engines')
+    parser.add_argument('-b', '--bytes', type=int, default=1024 * 1024, help='Bytes sent per transfer')
+    parser.add_argument('-s', '--sizes', default='1452,4096,8192,16384',
+                        help='Comma separated segment sizes to offer')
+    parser.add_argument('-e', '--engines', default='thread,asyncio', help='Comma separated engines to run')
+    parser.add_argument('-B', '--buffer-sizes', default=str(DEFAULT_BUFFER_SIZE),
+                        help='Comma separated sending and receiving buffer sizes')
+    parser.add_argument('--no-offload', action='store_true', help='Only run without UDP GSO/GRO')
+    args = parser.parse_args()
+    modes = [False] if args.no_offload else [False, True]
+    # fallbacks are the datagrams the server received outside its ring
+    print('%-8s %-8s %-8s %-8s %10s %10s %10s %10s %10s' % ('engine', 'segment', 'buffer', 'offload', 'seconds',
+                                                            'MB/s', 'srtt ms', 'rto ms', 'fallbacks'))
+    for engine in args.engines.split(','):
+        for size in [int(s) for s in args.sizes.split(',')]:
+            for bufferSize in [int(b) for b in args.buffer_sizes.split(',')]:
+                for offload in modes:
+                    finished, elapsed, client, server = transfer(args.bytes, size, offload, engine, bufferSize)
+                    srtt = (client.get_rtt() or 0) * 1000
+                    rto = client.get_rto() * 1000
+                    ring = server.get_ring_stats()
+                    fallbacks = ring['fallbacks'] if ring is not None else '-'
+                    if not finished:
+                        print('%-8s %-8d %-8d %-8s %10s %10s %10.2f %10.1f %10s' % (
+                            engine, client.segSize, client.bufferSize, offload, 'timeout', '-', srtt, rto,
+                            fallbacks))
+                        continue
+                    print('%-8s %-8d %-8d %-8s %10.2f %10.1f %10.2f %10.1f %10s' % (
+                        engine, client.segSize, client.bufferSize, offload, elapsed, args.bytes / elapsed / 1e6,
+                        srtt, rto, fallbacks))
+
+
+if __name__ == "__main__":
+    main()
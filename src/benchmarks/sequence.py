@@ -0,0 +1,75 @@
+import sys
+from reliableUDP.utilities import *
+from reliableUDP.application import SIZE_BYTES, size_message, parse_size
+
+# Receiver positions checked, around the first and a later wrap of the
+# 32-bit sequence numbers
+REFERENCES = [0, 1, SEQ_HALF, SEQ_MASK - PACKET_SIZE, SEQ_MASK, 1 << SEQ_BITS, (1 << SEQ_BITS) + 1,
+              (1 << SEQ_BITS) + SEQ_HALF, (3 << SEQ_BITS) - 7]
+# Distances from the reference, backward and forward, all within the window
+DISTANCES = [0, 1, -1, PACKET_SIZE, -PACKET_SIZE, MAX_BUFFER_SIZE, -MAX_BUFFER_SIZE, SEQ_HALF - 1, -SEQ_HALF + 1]
+# File sizes whose SIZE message must give them back, some of them with a
+# space among their bytes
+SIZES = [0, 1, 0x20, 0x2020, SEQ_MASK, 1 << SEQ_BITS, (1 << SEQ_BITS) + 1, 5 << 30, 0x2000000020,
+         (1 << 63) + 0x20, (1 << (8 * SIZE_BYTES)) - 1]
+
+
+def check_unwrap(failures):
+    for reference in REFERENCES:
+        for distance in DISTANCES:
+            full = reference + distance
+            if full < 0:
+                continue
+            result = unwrap_seq(full & SEQ_MASK, reference)
+            if result != full:
+                failures.append('unwrap_seq(%d, %d) is %d, not %d' % (full & SEQ_MASK, reference, result, full))
+            # through a header sent and received, seqNum and ackNum both
+            data = rUDPHeader(seqNum=full, ackNum=full, ACK=1).pack()
+            header = rUDPHeader.unpack(data)
+            header.unwrap(reference, reference)
+            if (header.seqNum, header.ackNum) != (full, full):
+                failures.append('header with %d received at %d gives %d, %d' %
+                                (full, reference, header.seqNum, header.ackNum))
+            # and the edges of a SACK block from there, when both are in the window
+            right = full + PACKET_SIZE
+            if right - reference >= SEQ_HALF:
+                continue
+            options = pack_sack_option([(full, right)])
+            data = rUDPHeader(ackNum=reference, ACK=1, offset=(defaultHeaderLen + len(options)) // 4).pack() \
+                + options
+            header = rUDPHeader.unpack(data)
+            header.unwrap(0, reference)
+            blocks = get_sack_blocks(data, header)
+            if blocks != [(full, right)]:
+                failures.append('SACK block (%d, %d) received at %d gives %s' % (full, right, reference, blocks))
+
+
+def check_size(failures):
+    for size in SIZES:
+        message = size_message(size)
+        # the receiving side splits the command at its first space
+        cmdIndex = message.index(b' ')
+        cmd, arg = message[:cmdIndex], message[cmdIndex+1:]
+        if cmd != b'SIZE' or len(arg) != SIZE_BYTES or parse_size(arg) != size:
+            failures.append('SIZE %d is sent as %r' % (size, message))
+    try:
+        size_message(1 << (8 * SIZE_BYTES))
+        failures.append('SIZE %d does not fit but was sent' % (1 << (8 * SIZE_BYTES)))
+    except OverflowError:
+        pass
+
+
+def main():
+    failures = []
+    check_unwrap(failures)
+    check_size(failures)
+    for failure in failures:
+        print(failure)
+    if failures:
+        sys.exit(1)
+    print('sequence numbers unwrap at %d positions, %d SIZE messages round trip' %
+          (len(REFERENCES) * len(DISTANCES), len(SIZES)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.workers import SRC_DIR, start_server
+
+# Fetches a file with lget and sends it back with lsend over a growing
+# number of --streams against a server with as many --workers, then
+# checks that every copy matches the original.
+
+
+def digest(path):
+    result = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(4 * 1024 * 1024)
+            if not data:
+                return result.hexdigest()
+            result.update(data)
+
+
+def run_client(clientDir, port, engine, command, filename, streams, timeout):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'client.py'), '-e', engine,
+                                '-n', str(streams), command, '127.0.0.1:%d' % port, filename],
+                               cwd=clientDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        process.wait(timeout)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description='lget and lsend of one file over several streams')
+    parser.add_argument('-s', '--streams', default='1,2,4,8', help='Comma separated numbers of streams')
+    parser.add_argument('-b', '--bytes', type=int, default=64 * 1024 * 1024, help='Size of the file')
+    parser.add_argument('-w', '--workers', type=int, default=None,
+                        help='Server processes, by default the largest number of streams')
+    parser.add_argument('-e', '--engine', choices=['thread', 'asyncio'], default='asyncio',
+                        help='The transport engine of the server and the clients')
+    parser.add_argument('-t', '--timeout', type=float, default=600, help='Seconds allowed for each transfer')
+    args = parser.parse_args()
+    counts = [int(n) for n in args.streams.split(',')]
+    baseDir = tempfile.mkdtemp(prefix='lftp-streams-')
+    try:
+        dataDir = os.path.join(baseDir, 'data')
+        clientDir = os.path.join(baseDir, 'client')
+        os.makedirs(dataDir)
+        os.makedirs(clientDir)
+        original = os.path.join(dataDir, 'file.bin')
+        with open(original, 'wb') as f:
+            f.write(os.urandom(args.bytes))
+        expected = digest(original)
+        port = random.randint(20000, 60000)
+        server = start_server(dataDir, port, args.workers or max(counts), args.engine)
+        try:
+            print('%-8s %-6s %10s %10s %8s' % ('streams', 'action', 'seconds', 'MB/s', 'intact'))
+            for streams in counts:
+                fetched = os.path.join(clientDir, 'file.bin')
+                elapsed = run_client(clientDir, port, args.engine, 'lget', 'file.bin', streams, args.timeout)
+                intact = os.path.exists(fetched) and digest(fetched) == expected
+                print('%-8d %-6s %10.2f %10.1f %8s' % (streams, 'lget', elapsed, args.bytes / elapsed / 1e6, intact),
+                      flush=True)
+                # sent back under another name, the server keeps the original
+                os.rename(fetched, os.path.join(clientDir, 'upload.bin'))
+                elapsed = run_client(clientDir, port, args.engine, 'lsend', 'upload.bin', streams, args.timeout)
+                uploaded = os.path.join(dataDir, 'upload.bin')
+                intact = os.path.exists(uploaded) and digest(uploaded) == expected
+                print('%-8d %-6s %10.2f %10.1f %8s' % (streams, 'lsend', elapsed, args.bytes / elapsed / 1e6,
+                                                       intact), flush=True)
+                for path in (uploaded, os.path.join(clientDir, 'upload.bin')):
+                    if os.path.exists(path):
+                        os.remove(path)
+        finally:
+            server.terminate()
+            server.wait()
+    finally:
+        shutil.rmtree(baseDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
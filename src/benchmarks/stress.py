@@ -0,0 +1,103 @@
+import argparse
+import hashlib
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from benchmarks.workers import SRC_DIR, start_server
+
+# Many simultaneous lsend and lget clients (one process each) against one
+# server, checks every file arrived intact and reports the aggregate
+# throughput. Exits with 1 when a file is missing or corrupted, a client
+# timed out or the server died.
+
+
+def digest(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def client(command, port, filename, cwd, engine):
+    return subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'client.py'), '-e', engine,
+                             command, '127.0.0.1:%d' % port, filename],
+                            cwd=cwd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def run(uploads, downloads, size, workers, engine, baseDir):
+    dataDir = os.path.join(baseDir, 'data')
+    os.makedirs(dataDir)
+    with open(os.path.join(dataDir, 'file.bin'), 'wb') as f:
+        f.write(os.urandom(size))
+    expected = {'file.bin': digest(os.path.join(dataDir, 'file.bin'))}
+    dirs = []
+    for i in range(uploads + downloads):
+        clientDir = os.path.join(baseDir, 'client%d' % i)
+        os.makedirs(clientDir)
+        dirs.append(clientDir)
+        if i < uploads:
+            name = 'up%d.bin' % i
+            with open(os.path.join(clientDir, name), 'wb') as f:
+                f.write(os.urandom(size))
+            expected[name] = digest(os.path.join(clientDir, name))
+    port = random.randint(20000, 60000)
+    server = start_server(dataDir, port, workers, engine)
+    try:
+        start = time.perf_counter()
+        processes = []
+        for i, clientDir in enumerate(dirs):
+            if i < uploads:
+                processes.append(client('lsend', port, 'up%d.bin' % i, clientDir, engine))
+            else:
+                processes.append(client('lget', port, 'file.bin', clientDir, engine))
+        timedOut = 0
+        for process in processes:
+            try:
+                process.wait(300)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                timedOut += 1
+        elapsed = time.perf_counter() - start
+        # an upload's DONE goes out before the server closes the file
+        time.sleep(0.5)
+        alive = server.poll() is None
+    finally:
+        server.terminate()
+        server.wait()
+    sent = sum(1 for i in range(uploads) if os.path.exists(os.path.join(dataDir, 'up%d.bin' % i)) and
+               digest(os.path.join(dataDir, 'up%d.bin' % i)) == expected['up%d.bin' % i])
+    got = sum(1 for clientDir in dirs[uploads:] if os.path.exists(os.path.join(clientDir, 'file.bin')) and
+              digest(os.path.join(clientDir, 'file.bin')) == expected['file.bin'])
+    return elapsed, sent, got, timedOut, alive
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simultaneous uploads and downloads against one server')
+    parser.add_argument('-u', '--uploads', type=int, default=8, help='Concurrent lsend clients')
+    parser.add_argument('-g', '--downloads', type=int, default=8, help='Concurrent lget clients')
+    parser.add_argument('-b', '--bytes', type=int, default=1024 * 1024, help='Size of every file')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Server processes')
+    parser.add_argument('-e', '--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='The transport engine of the server and the clients')
+    args = parser.parse_args()
+    baseDir = tempfile.mkdtemp(prefix='lftp-stress-')
+    try:
+        elapsed, sent, got, timedOut, alive = run(args.uploads, args.downloads, args.bytes, args.workers, args.engine, baseDir)
+    finally:
+        shutil.rmtree(baseDir, ignore_errors=True)
+    total = (sent + got) * args.bytes
+    print('uploads   %d/%d intact' % (sent, args.uploads))
+    print('downloads %d/%d intact' % (got, args.downloads))
+    print('%.2f s, %.1f MB/s aggregate' % (elapsed, total / elapsed / 1e6))
+    if timedOut:
+        print('%d clients timed out' % timedOut)
+    if not alive:
+        print('the server died')
+    if sent != args.uploads or got != args.downloads or timedOut or not alive:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+import argparse
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+# Runs server.py with a growing number of --workers and measures how long
+# many concurrent lget clients (one process each) take to fetch a file
+
+SRC_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# options are further arguments of server.py
+def start_server(dataDir, port, workers, engine, options=()):
+    server = subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'server.py'), '-a', '127.0.0.1',
+                               '-p', str(port), '-d', dataDir, '-w', str(workers), '-e', engine] + list(options),
+                              cwd=dataDir, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    # both modes print a line ending with the readiness once listening
+    for line in server.stdout:
+        if 'ready' in line:
+            return server
+    raise RuntimeError('The server exited before listening')
+
+
+def run(workers, clients, size, engine, baseDir):
+    dataDir = os.path.join(baseDir, 'data')
+    os.makedirs(dataDir, exist_ok=True)
+    path = os.path.join(dataDir, 'file.bin')
+    if not os.path.exists(path) or os.path.getsize(path) != size:
+        with open(path, 'wb') as f:
+            f.write(os.urandom(size))
+    port = random.randint(20000, 60000)
+    server = start_server(dataDir, port, workers, engine)
+    try:
+        dirs = []
+        for i in range(clients):
+            clientDir = os.path.join(baseDir, 'client%d' % i)
+            shutil.rmtree(clientDir, ignore_errors=True)
+            os.makedirs(clientDir)
+            dirs.append(clientDir)
+        start = time.perf_counter()
+        processes = [subprocess.Popen([sys.executable, os.path.join(SRC_DIR, 'client.py'), '-e', engine,
+                                       'lget', '127.0.0.1:%d' % port, 'file.bin'],
+                                      cwd=clientDir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                     for clientDir in dirs]
+        for process in processes:
+            try:
+                process.wait(300)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        elapsed = time.perf_counter() - start
+        complete = sum(1 for clientDir in dirs
+                       if os.path.exists(os.path.join(clientDir, 'file.bin')) and
+                       os.path.getsize(os.path.join(clientDir, 'file.bin')) == size)
+        return elapsed, complete
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent lget clients against a growing number of server workers')
+    parser.add_argument('-w', '--workers', default='1,2,4', help='Comma separated numbers of server workers')
+    parser.add_argument('-c', '--clients', type=int, default=8, help='Concurrent lget clients')
+    parser.add_argument('-b', '--bytes', type=int, default=2 * 1024 * 1024, help='Size of the file fetched')
+    parser.add_argument('-e', '--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='The transport engine of the server and the clients')
+    args = parser.parse_args()
+    print('%d CPUs, %d clients fetching %d bytes each' % (os.cpu_count(), args.clients, args.bytes))
+    print('%-8s %10s %10s %10s %10s' % ('workers', 'complete', 'seconds', 'MB/s', 'speedup'))
+    baseDir = tempfile.mkdtemp(prefix='lftp-workers-')
+    try:
+        baseline = None
+        for workers in [int(w) for w in args.workers.split(',')]:
+            elapsed, complete = run(workers, args.clients, args.bytes, args.engine, baseDir)
+            if baseline is None:
+                baseline = elapsed
+            print('%-8d %10s %10.2f %10.1f %10.2f' % (workers, '%d/%d' % (complete, args.clients), elapsed,
+                                                      complete * args.bytes / elapsed / 1e6, baseline / elapsed))
+    finally:
+        shutil.rmtree(baseDir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
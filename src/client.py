@@ -5,13 +5,18 @@ import socket
 import os
 import sys
 import json
+import time
+import multiprocessing
 from enum import Enum
 from reliableUDP.lftplog import logger
 from reliableUDP.client import rUDPClient
-from reliableUDP.application import app
+from reliableUDP.utilities import ACK_EVERY
+from reliableUDP.application import app, msgAssembler, split_message, fileSink, SINK_BATCH_SIZE, partRecord, \
+    missing_ranges, size_message, parse_size
 
 clientStates = Enum('clientStates', ('CLOSED', 'SENDREQUEST', 'DATA'))
-operations = Enum('operations', ('GET', 'SEND', 'LIST'))
+# PART asks for the ranges of an upload the server has, see run_streams
+operations = Enum('operations', ('GET', 'SEND', 'LIST', 'PART'))
 
 commands = {
     'lsend': operations.SEND,
@@ -19,8 +24,12 @@ commands = {
     'ls': operations.LIST
 }
 
+# With an offset only length bytes of the file from there are transferred,
+# the other ranges going over other connections (see run_streams)
 class client(app):
-    def __init__(self, serverIP, serverPort, action, filename):
+    def __init__(self, serverIP, serverPort, action, filename, segSize=None, engine='thread', bufferSize=None,
+                 congestion='reno', ackEvery=ACK_EVERY, pacing=True, rate=None, offset=None, length=0,
+                 progress=True):
         app.__init__(self)
         self.lock = threading.Lock()
         self.lock.acquire()
@@ -28,11 +37,22 @@ class client(app):
         self.serverPort = serverPort
         self.action = action
         self.filename = filename
-        self.rudp = rUDPClient(app=self)
+        self.rudp = rUDPClient(app=self, segSize=segSize, engine=engine, bufferSize=bufferSize,
+                               congestion=congestion, ackEvery=ackEvery, pacing=pacing, rate=rate)
         self.state = clientStates.CLOSED
         self.waitingList = []
+        self.assembler = msgAssembler()
         self.file = None
         self.fileSize = 0
+        self.range = None if offset is None else (offset, length)
+        # end of the data to transfer, and whether the server said DONE
+        self.end = 0
+        self.completed = False
+        self.progress = progress
+        # the [start, end) ranges the server answered PART with
+        self.parts = None
+        # where the next segment of an uploaded file is read from
+        self.position = 0
         try:
             if self.action == operations.SEND:
                 self.file = open(filename, 'rb')
@@ -41,41 +61,61 @@ class client(app):
             sys.exit()
         finally:
             self.lock.release()
+
+    # Returns once the connection is closed
+    def run(self):
         self.rudp.connect(self.serverIP, self.serverPort)
 
     def close(self):
         self.rudp.finished = True
         if self.file:
             self.file.close()
-        print()
+        if self.completed and self.action == operations.GET and self.range is None:
+            # only kept to resume a download cut short
+            partRecord(self.filename).remove()
+        if self.progress:
+            print()
         sys.exit()
 
+    # End of the data to transfer in a file of fileSize bytes
+    def range_end(self):
+        if self.range is None:
+            return self.fileSize
+        return max(self.range[0], min(self.range[0] + self.range[1], self.fileSize))
+
     def update_state(self, newState):
         logger.debug('Client application new state: %s' % str(newState))
         self.state = newState
 
     def send_data(self, data, useBuffer):
-        buf = bytearray(5120)
         length = len(data)
+        buf = bytearray(4 + length)
         buf[0:4] = int.to_bytes(length, length=4, byteorder='big')
         buf[4:4+length] = data
-        pad_len = 5120 - 4 - length
-        buf[4+length:5120] = b'\0' * pad_len
-        if useBuffer:
-            if not self.rudp.append_snd_buffer(buf):
-                self.waitingList.append(buf)
-                return False
-        else:
-            self.rudp.send_msg(buf)
-        return True
+        sent = True
+        for segment in split_message(buf, self.rudp.segSize):
+            if useBuffer:
+                # keep the order once something has to wait
+                if not sent or not self.rudp.append_snd_buffer(segment):
+                    self.waitingList.append(segment)
+                    sent = False
+            else:
+                self.rudp.send_msg(segment)
+        return sent
 
     def send_request(self):
-        if self.action == operations.GET:
+        if self.range is not None and self.action in (operations.GET, operations.SEND):
+            command = b'lRGET' if self.action == operations.GET else b'lRSEND'
+            self.send_data(b'%s %d %d %s' % (command, self.range[0], self.range[1],
+                                             bytes(self.filename, encoding='utf-8')), False)
+        elif self.action == operations.GET:
             self.send_data(b'lGET %s' % bytes(self.filename, encoding='utf-8'), False)
         elif self.action == operations.SEND:
             self.send_data(b'lSEND %s' % bytes(self.filename, encoding='utf-8'), False)
         elif self.action == operations.LIST:
             self.send_data(b'lLIST', False)
+        elif self.action == operations.PART:
+            self.send_data(b'lPART %s' % bytes(self.filename, encoding='utf-8'), False)
 
 
     def next(self, user=None):
@@ -93,39 +133,61 @@ class client(app):
                         else:
                             return
                 if self.action == operations.SEND:
-                    while True and not self.file.closed:
-                        data = self.file.read(5116)
-                        print('\rUploaded %.5f%%.' % (float(self.file.tell()) * 100 / self.fileSize), end='')
-                        if self.file.tell() == self.fileSize:
-                            print('\rFile upload completed', end='')
-                        if len(data) == 0:
+                    while not self.file.closed:
+                        length = min(self.rudp.segSize - 4, self.end - self.position)
+                        if length == 0:
+                            if self.progress:
+                                print('\rFile upload completed', end='')
                             logger.debug('complete')
+                            # all of it is in the sending buffer, the server's DONE follows
+                            self.file.close()
                             break
-                        else:
+                        # each segment is a message of its own, read from
+                        # the file straight into the sending buffer
+                        count = self.rudp.append_snd_file(self.file.fileno(), self.position, length,
+                                                          int.to_bytes(length, length=4, byteorder='big'))
+                        if count is None:
                             # Pause when we cannot add new data to send
-                            if not self.send_data(data, True):
-                                break
+                            break
+                        if count < length:
+                            logger.error('File %s shrank while being sent' % self.filename)
+                            self.end = self.position
+                            continue
+                        self.position += count
+                        if self.progress:
+                            print('\rUploaded %.5f%%.' % (float(self.position) * 100 / self.fileSize), end='')
         finally:
             self.lock.release()
 
 
     def process_data(self, user=None):
         goNext = False
+        data = None
         try:
             self.lock.acquire()
             data = self.rudp.consume_rcv_buffer()
-            length = int.from_bytes(data[:4], byteorder='big')
-            content = data[4:4+length]
+            content = self.assembler.feed(data)
+            if content is None:
+                return
             if self.state == clientStates.SENDREQUEST:
+                # control messages are tiny, copy them out of the receive buffer
+                content = bytes(content)
                 if self.action == operations.SEND:
                     cmdIndex = content.index(b' ')
                     cmd = content[:cmdIndex]
                     arg = content[cmdIndex+1:]
+                    resume = None
+                    if cmd == b'CONTINUE' and b' ' in arg:
+                        # the server holds the file up to resume from an
+                        # upload cut short
+                        resume, arg = arg.split(b' ', 1)
+                        resume = int(resume)
                     if cmd == b'EXISTED' and content[len(cmd)+1:].decode() == self.filename:
                         print('File already existed on the server!')
                         self.rudp.finish_conn()
-                    elif cmd == b'WAITING' and content[len(cmd)+1:].decode() == self.filename:
-                        print('Sending the file now...')
+                    elif cmd in (b'WAITING', b'CONTINUE') and arg.decode() == self.filename:
+                        if self.progress:
+                            print('Sending the file now...')
                         self.update_state(clientStates.DATA)
                         logger.info('server waiting for file')
                         # send file size
@@ -133,7 +195,15 @@ class client(app):
                         self.file.seek(0, os.SEEK_END)
                         self.fileSize = self.file.tell()
                         self.file.seek(begin_pos, os.SEEK_SET)
-                        self.send_data(b'SIZE ' + int.to_bytes(self.fileSize, byteorder='little', length=4), False)
+                        if resume is not None:
+                            if self.progress:
+                                print('Continuing after the %d bytes the server has' % resume)
+                            self.range = (resume, max(self.fileSize - resume, 0))
+                        # SIZE is the size of the file, a range is sent from where it starts
+                        self.end = self.range_end()
+                        if self.range is not None:
+                            self.position = min(self.range[0], self.end)
+                        self.send_data(size_message(self.fileSize), False)
                         goNext = True
                 elif self.action == operations.LIST:
                     files = json.loads(content.decode())
@@ -141,6 +211,18 @@ class client(app):
                         print(name, end=' ')
                     print()
                     self.update_state(clientStates.DATA)
+                elif self.action == operations.PART:
+                    cmdIndex = content.index(b' ')
+                    cmd = content[:cmdIndex]
+                    arg = content[cmdIndex+1:]
+                    if cmd == b'PART':
+                        self.parts = [tuple(part) for part in json.loads(arg.decode())]
+                        self.update_state(clientStates.DATA)
+                    elif cmd == b'NOTEXIST':
+                        # nothing to resume after
+                        self.parts = []
+                        self.completed = True
+                        self.rudp.finish_conn()
                 elif self.action == operations.GET:
                     cmdIndex = content.index(b' ')
                     cmd = content[:cmdIndex]
@@ -149,23 +231,48 @@ class client(app):
                         print('Requested file does not exist on the server!')
                         self.rudp.finish_conn()
                     elif cmd.decode() == 'SIZE':
-                        self.file = open(self.filename, 'wb')
-                        self.fileSize = int.from_bytes(arg, byteorder='little')
-                        print('Receiving the file now ..., size: %d' % self.fileSize)
+                        self.fileSize = parse_size(arg)
+                        self.end = self.range_end()
+                        # it holds segments of the receiving buffer until
+                        # written, an empty range only asks for the size.
+                        # The record next to the file tells what a resumed
+                        # download still needs.
+                        record = partRecord(self.filename)
+                        if self.range is None:
+                            record.remove()
+                            self.file = fileSink(self.filename, self.fileSize,
+                                                 min(SINK_BATCH_SIZE, self.rudp.bufferSize // 4), record=record)
+                        elif self.end > self.range[0]:
+                            self.file = fileSink(self.filename, self.fileSize,
+                                                 min(SINK_BATCH_SIZE, self.rudp.bufferSize // 4), offset=self.range[0],
+                                                 record=record)
+                        if self.progress:
+                            print('Receiving the file now ..., size: %d' % self.fileSize)
                         self.update_state(clientStates.DATA)
             elif self.state == clientStates.DATA:
-                if (self.file is None or self.file.closed or self.file.tell() == self.fileSize) and content.decode() == 'DONE':
+                if (self.file is None or self.file.closed or self.file.tell() == self.end) and content == b'DONE':
+                    self.completed = True
                     self.rudp.finish_conn()
                 elif self.action == operations.GET:
                     if self.file.closed:
                         return
-                    if self.file.tell() == self.fileSize:
+                    if self.file.tell() == self.end:
                         return
-                    self.file.write(content)
-                    print('\rDownloaded %.5f%%.' % ((float(self.file.tell()) * 100) / self.fileSize), end='')
-                    if self.file.tell() == self.fileSize:
-                        print('\rFile download completed', end='')
+                    # released by the sink once written
+                    self.file.write(content, self.rudp.release_rcv_buffer)
+                    data = None
+                    if self.progress:
+                        print('\rDownloaded %.5f%%.' % ((float(self.file.tell()) * 100) / self.fileSize), end='')
+                    if self.file.tell() == self.end:
+                        self.file.flush()
+                        if self.progress:
+                            print('\rFile download completed', end='')
         finally:
+            if data is not None:
+                if isinstance(self.file, fileSink):
+                    # it holds segments consumed before this one
+                    self.file.flush()
+                self.rudp.release_rcv_buffer()
             self.lock.release()
         if goNext:
             self.next()
@@ -180,12 +287,130 @@ class client(app):
 
 
 
+# Cuts the [start, end) ranges into pieces of about the same length and
+# deals them to at most count streams, each getting a list of
+# (offset, length). An empty range still makes a piece.
+def split_ranges(ranges, count):
+    step = max(1, -(-sum(end - start for start, end in ranges) // count))
+    pieces = []
+    for start, end in ranges:
+        for offset in range(start, max(end, start + 1), step):
+            pieces.append((offset, min(step, end - offset)))
+    return [pieces[i::count] for i in range(min(count, len(pieces)))]
+
+
+# Runs the ranges of a stream one after the other in a process of its own,
+# so that the streams do not share an interpreter lock, and exits with 0
+# once all of them completed
+def run_stream(serverIP, serverPort, action, filename, ranges, options):
+    for offset, length in ranges:
+        cli = client(serverIP, serverPort, action, filename, offset=offset, length=length, progress=False,
+                     **options)
+        try:
+            cli.run()
+        except SystemExit:
+            pass
+        if not cli.completed:
+            sys.exit(1)
+    sys.exit(0)
+
+
+# Runs a request answered without moving the file in this process
+def ask(serverIP, serverPort, action, filename, **options):
+    cli = client(serverIP, serverPort, action, filename, offset=0, length=0, progress=False, **options)
+    try:
+        cli.run()
+    except SystemExit:
+        pass
+    return cli
+
+
+# Transfers the file in ranges over streams connections at once and
+# returns whether all of them completed. A download asks for the size
+# with an empty range first. With resume only the ranges missing from the
+# record next to a downloaded file, or from the server's PART answer for
+# an upload, are transferred.
+def run_streams(serverIP, serverPort, action, filename, streams, resume=False, **options):
+    start = time.perf_counter()
+    if action == operations.GET:
+        probe = ask(serverIP, serverPort, action, filename, **options)
+        if not probe.completed:
+            return False
+        size = probe.fileSize
+        record = partRecord(filename)
+        if resume and record.exists() and os.path.isfile(filename):
+            missing = record.missing(size)
+        else:
+            # the ranges allocate it, stale data must not stay in between
+            record.remove()
+            record.create()
+            open(filename, 'wb').close()
+            missing = [(0, size)]
+    else:
+        if not os.path.isfile(filename):
+            print('File %s does not exist!' % filename)
+            return False
+        size = os.path.getsize(filename)
+        missing = [(0, size)]
+        if resume:
+            probe = ask(serverIP, serverPort, operations.PART, filename, **options)
+            if probe.parts is None:
+                return False
+            if probe.parts:
+                missing = missing_ranges(probe.parts, size)
+    remaining = sum(end - start for start, end in missing)
+    if resume:
+        print('%d of %d bytes to transfer' % (remaining, size))
+        if not missing:
+            if action == operations.GET:
+                record.remove()
+            return True
+    streamRanges = split_ranges(missing, streams)
+    # fresh interpreters, the timer threads of the probe are not forked
+    context = multiprocessing.get_context('spawn')
+    processes = []
+    for ranges in streamRanges:
+        process = context.Process(target=run_stream, args=[serverIP, serverPort, action, filename, ranges, options])
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - start
+    failed = sum(1 for process in processes if process.exitcode != 0)
+    if failed > 0:
+        print('%d of %d streams did not complete' % (failed, len(processes)))
+        return False
+    if action == operations.GET:
+        record.remove()
+    print('%s %d bytes over %d streams in %.2f s, %.1f MB/s' % (
+        'Downloaded' if action == operations.GET else 'Uploaded', remaining, len(processes), elapsed,
+        remaining / elapsed / 1e6))
+    return True
+
 
 def main():
     parser = argparse.ArgumentParser(description='The client program of LFTP')
     parser.add_argument('command', type=str, help='Use lsend, lget or ls to instruct LFTP operation.')
     parser.add_argument('ServerAddr', type=str, help='The ip or domain address and the port of the LFTP server')
     parser.add_argument('filename', type=str, nargs='?', help='The file you wish to get or send.', default=None)
+    parser.add_argument('-s', '--segment-size', type=int, default=None,
+                        help='The largest segment size to offer, by default the one fitting the path MTU')
+    parser.add_argument('-e', '--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='The transport engine running the connection')
+    parser.add_argument('-B', '--buffer-size', type=int, default=None,
+                        help='Bytes of the sending and receiving buffers, 4 MB by default')
+    parser.add_argument('-c', '--congestion', choices=['reno', 'cubic', 'bbr'], default='reno',
+                        help='The congestion controller of the connection')
+    parser.add_argument('-A', '--ack-every', type=int, default=ACK_EVERY,
+                        help='In-order segments acked together, 1 acks every segment')
+    parser.add_argument('-r', '--rate', type=int, default=None,
+                        help='Bytes per second the connection may send at most')
+    parser.add_argument('--no-pacing', dest='pacing', action='store_false',
+                        help='Send the window at once instead of spreading it over the round trip')
+    parser.add_argument('-n', '--streams', type=int, default=1,
+                        help='Connections transferring ranges of the file at once for lget and lsend')
+    parser.add_argument('--resume', action='store_true',
+                        help='Only transfer what an lget or lsend cut short did not')
     args = parser.parse_args()
     args.command = args.command.lower()
     cmd = None
@@ -213,7 +438,18 @@ def main():
     if (cmd == operations.GET or cmd == operations.SEND) and args.filename == None:
         print("A file name must be specified for lget and lsend!")
         return
-    cli = client(ip, port, cmd, args.filename)
+    if args.streams <= 0:
+        print('The number of streams is invalid')
+        return
+    if (args.streams > 1 or args.resume) and cmd != operations.LIST:
+        if not run_streams(ip, port, cmd, args.filename, args.streams, args.resume, segSize=args.segment_size,
+                           engine=args.engine, bufferSize=args.buffer_size, congestion=args.congestion,
+                           ackEvery=args.ack_every, pacing=args.pacing, rate=args.rate):
+            sys.exit(1)
+        return
+    cli = client(ip, port, cmd, args.filename, args.segment_size, args.engine, args.buffer_size,
+                 args.congestion, args.ack_every, args.pacing, args.rate)
+    cli.run()
 
 if __name__ == "__main__":
     main()
@@ -1 +1,3 @@
-from .app import app
+from .app import app, msgAssembler, split_message, fileSink, SINK_BATCH_SIZE, CHECKPOINT_BYTES, partRecord, \
+    PART_SUFFIX, missing_ranges, SIZE_BYTES, size_message, parse_size
+from .executor import ioExecutor, IO_THREADS, IO_QUEUE_SIZE, READ_AHEAD_SEGMENTS
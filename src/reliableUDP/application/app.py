@@ -1,3 +1,4 @@
+import os
 import threading
 from abc import abstractmethod
 
@@ -29,3 +30,299 @@ class app:
     @abstractmethod
     def notify_close(self):
         pass
+
+
+# Application messages start with their length in 4 big endian bytes, one
+# longer than a segment is sent in several and only the first carries the
+# length. Feed the received segments in order to get the messages back.
+class msgAssembler:
+    def __init__(self):
+        self.partial = None
+        self.length = 0
+
+    # Returns the content of the message data completes, None while
+    # more segments are needed
+    def feed(self, data):
+        if self.partial is None:
+            length = int.from_bytes(data[:4], byteorder='big')
+            if length <= len(data) - 4:
+                return data[4:4+length]
+            self.partial = bytearray(data)
+            self.length = length
+        else:
+            self.partial += data
+        if len(self.partial) - 4 < self.length:
+            return None
+        content = self.partial[4:4+self.length]
+        self.partial = None
+        return content
+
+
+# Splits buf, a message with its length prefix, into segments of at most segSize bytes
+def split_message(buf, segSize):
+    if len(buf) <= segSize:
+        return [buf]
+    return [buf[i:i+segSize] for i in range(0, len(buf), segSize)]
+
+
+# A SIZE message carries the size of the whole file in SIZE_BYTES little
+# endian bytes, so files past 4 GiB keep their size
+SIZE_BYTES = 8
+
+
+def size_message(size):
+    return b'SIZE ' + int.to_bytes(size, byteorder='little', length=SIZE_BYTES)
+
+
+# The size in the argument of a SIZE message, what follows its space
+def parse_size(arg):
+    return int.from_bytes(arg, byteorder='little')
+
+
+# Bytes a fileSink gathers before writing them, segments held by it are
+# not released so it should stay well below the receiving buffer
+SINK_BATCH_SIZE = 256 * 1024
+# buffers given to one pwritev, under every system's IOV_MAX
+SINK_MAX_BUFFERS = 512
+# Bytes a fileSink writes between the checkpoints of its partRecord
+CHECKPOINT_BYTES = 8 * 1024 * 1024
+
+
+# Writes a received file at absolute offsets. The segments given to write
+# stay in the receiving buffer until a batch of them is written with one
+# pwritev, then they are released in the order they came. A segment the
+# app releases itself must go through after(), it was consumed after them.
+# Given an ioExecutor the batches are written behind on its threads, the
+# segments they hold close the receiving window until then. With an offset
+# the data is a range written from there into the file as it is, which
+# other sinks may be writing the other ranges of. Given a partRecord the
+# data on disk is added to it every CHECKPOINT_BYTES and on close, so that
+# a transfer cut short can be resumed from there. key is the peer address
+# of the connection the data comes from, the executor runs the releases
+# where that connection runs.
+class fileSink:
+    def __init__(self, path, size=0, batch=SINK_BATCH_SIZE, executor=None, offset=None, record=None, key=None):
+        flags = os.O_WRONLY | os.O_CREAT
+        if offset is None:
+            flags |= os.O_TRUNC
+        self.fd = os.open(path, flags, 0o644)
+        self.size = 0
+        self.batch = batch
+        self.executor = executor
+        self.key = key
+        self.whole = offset is None
+        # end of the data given so far, and of the data handed to pwritev
+        self.position = offset or 0
+        self.written = self.position
+        # end of the data pwritev wrote, and of the data recorded
+        self.record = record
+        self.stored = self.position
+        self.checkpointed = self.position
+        self.pending = []
+        self.releases = []
+        self.closed = False
+        self.lock = threading.Lock()
+        self.allocate(size)
+
+    # Reserves the blocks of a file of size bytes, where the filesystem can
+    def allocate(self, size):
+        self.size = size
+        if size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(self.fd, 0, size)
+            except OSError:
+                # e.g. not supported by the filesystem, the writes extend it
+                pass
+
+    def tell(self):
+        return self.position
+
+    # data is valid until release() is called, once it is written
+    def write(self, data, release=None):
+        self.lock.acquire()
+        try:
+            self.pending.append(data)
+            if release is not None:
+                self.releases.append(release)
+            self.position += len(data)
+            if self.position - self.written >= self.batch or len(self.pending) >= SINK_MAX_BUFFERS:
+                self.write_pending()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        self.lock.acquire()
+        try:
+            self.write_pending()
+        finally:
+            self.lock.release()
+
+    # Calls callback once the data given so far is written
+    def after(self, callback):
+        self.lock.acquire()
+        try:
+            self.write_pending()
+            if self.executor is None:
+                callback()
+            else:
+                self.executor.submit(self, self.complete, [callback])
+        finally:
+            self.lock.release()
+
+    # Flushes and closes the file, a whole one cut at the data received,
+    # then calls done
+    def close(self, done=None):
+        self.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.write_pending()
+            self.closed = True
+            if self.executor is None:
+                self.finish(done)
+            else:
+                self.executor.submit(self, self.finish, done)
+        finally:
+            self.lock.release()
+
+    def finish(self, done):
+        try:
+            if self.record is not None and self.stored > self.checkpointed:
+                self.checkpoint()
+            if self.whole and self.position < self.size:
+                os.ftruncate(self.fd, self.position)
+            os.close(self.fd)
+        finally:
+            if done is not None:
+                self.complete([done])
+
+    # Called with the lock held
+    def write_pending(self):
+        if not self.pending and not self.releases:
+            return
+        offset = self.written
+        self.written = self.position
+        if self.executor is None:
+            self.write_at(offset, self.pending, self.releases)
+        else:
+            self.executor.submit(self, self.write_at, offset, self.pending, self.releases)
+        self.pending = []
+        self.releases = []
+
+    def write_at(self, offset, buffers, releases):
+        try:
+            while buffers:
+                if hasattr(os, 'pwritev'):
+                    count = os.pwritev(self.fd, buffers, offset)
+                else:
+                    count = os.pwrite(self.fd, buffers[0], offset)
+                offset += count
+                # drop what was written, a short write goes on from there
+                while buffers and count >= len(buffers[0]):
+                    count -= len(buffers[0])
+                    buffers.pop(0)
+                if count > 0:
+                    buffers[0] = memoryview(buffers[0])[count:]
+            self.stored = offset
+        finally:
+            self.complete(releases)
+        if self.record is not None and self.stored - self.checkpointed >= CHECKPOINT_BYTES:
+            self.checkpoint()
+
+    # Records the data written so far once the system has it on disk
+    def checkpoint(self):
+        if hasattr(os, 'fdatasync'):
+            os.fdatasync(self.fd)
+        else:
+            os.fsync(self.fd)
+        self.record.add(self.checkpointed, self.stored - self.checkpointed)
+        self.checkpointed = self.stored
+
+    # Runs the callbacks of a job where the connections run
+    def complete(self, callbacks):
+        if self.executor is None:
+            call_all(callbacks)
+        elif callbacks:
+            self.executor.complete(self.key, call_all, callbacks)
+
+
+def call_all(callbacks):
+    for callback in callbacks:
+        callback()
+
+
+# Suffix of the record kept next to a file received in ranges
+PART_SUFFIX = '.lftp-part'
+
+
+# The ranges of a file written so far by transfers that may run in other
+# processes, kept next to the file while it is incomplete. Each finished
+# range is appended as a line "offset length", which the system appends
+# in one piece, so no lock is shared.
+class partRecord:
+    def __init__(self, path):
+        self.path = path + PART_SUFFIX
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def create(self):
+        os.close(os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644))
+
+    def add(self, offset, length):
+        fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+        try:
+            os.write(fd, b'%d %d\n' % (offset, length))
+        finally:
+            os.close(fd)
+
+    # The merged [start, end) ranges recorded, in order
+    def ranges(self):
+        ranges = []
+        try:
+            with open(self.path, 'rb') as f:
+                for line in f:
+                    fields = line.split()
+                    # a line cut by a crash is skipped
+                    if len(fields) == 2 and fields[0].isdigit() and fields[1].isdigit():
+                        ranges.append((int(fields[0]), int(fields[0]) + int(fields[1])))
+        except FileNotFoundError:
+            return []
+        merged = []
+        for start, end in sorted(ranges):
+            if merged and start <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    # Whether the ranges recorded make up a file of size bytes
+    def covers(self, size):
+        return len(missing_ranges(self.ranges(), size)) == 0
+
+    # The [start, end) ranges of a file of size bytes not recorded yet
+    def missing(self, size):
+        return missing_ranges(self.ranges(), size)
+
+    def remove(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            # the last two ranges may finish at once
+            pass
+
+
+# The [start, end) ranges of a file of size bytes that the merged ranges
+# given leave out
+def missing_ranges(ranges, size):
+    missing = []
+    position = 0
+    for start, end in ranges:
+        if start > position:
+            missing.append((position, min(start, size)))
+        position = max(position, end)
+        if position >= size:
+            break
+    if position < size:
+        missing.append((position, size))
+    return [(start, end) for start, end in missing if start < end]
@@ -0,0 +1,79 @@
+import os
+import threading
+from ..engine import workerPool
+from ..lftplog import logger
+
+# Threads doing the disk I/O of a server process, and the jobs each of
+# them may have waiting before the sessions feeding it block
+IO_THREADS = 2
+IO_QUEUE_SIZE = 64
+# Segments of a download brought into the page cache ahead of sending
+READ_AHEAD_SEGMENTS = 64
+
+
+# Runs the disk I/O of the sessions of a process on a few threads of its
+# own so that reads and writes never hold up the connections. Jobs given
+# the same key run in order, complete() hands their results back to the
+# engine the connections run on.
+class ioExecutor:
+    def __init__(self, engine, threads=IO_THREADS, queueSize=IO_QUEUE_SIZE, metrics=None):
+        self.engine = engine
+        self.pool = workerPool(threads, queueSize)
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        # jobs submitted and not done yet, and the seconds the sessions
+        # waited for room in the queues
+        self.depth = 0
+        self.stalled = 0
+
+    def submit(self, key, callback, *args):
+        self.count(1)
+        waited = self.pool.dispatch(key, self.run, callback, args)
+        if waited > 0:
+            self.lock.acquire()
+            try:
+                self.stalled += waited
+            finally:
+                self.lock.release()
+            if self.metrics is not None:
+                self.metrics.add('ioStallUs', int(waited * 1e6))
+
+    def run(self, callback, args):
+        try:
+            callback(*args)
+        finally:
+            self.count(-1)
+
+    def count(self, n):
+        self.lock.acquire()
+        try:
+            self.depth += n
+        finally:
+            self.lock.release()
+        if self.metrics is not None:
+            self.metrics.add('ioQueued', n)
+
+    # Runs callback(*args) where the connection of key runs, from a job
+    def complete(self, key, callback, *args):
+        self.engine.call_soon(key, callback, *args)
+
+    # Asks for length bytes of fd from offset to be read into the page
+    # cache, where the system takes the advice
+    def read_ahead(self, key, fd, offset, length):
+        if hasattr(os, 'posix_fadvise') and length > 0:
+            self.submit(key, advise_will_need, fd, offset, length)
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'stalled': self.stalled,
+            'workers': self.pool.stats()
+        }
+
+
+def advise_will_need(fd, offset, length):
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_WILLNEED)
+    except OSError as e:
+        # the download may be over and its file closed already
+        logger.debug('Read ahead of fd %d skipped: %s' % (fd, e))
@@ -0,0 +1,108 @@
+import sys
+
+# Checksum engines used by fill_checksum and check_header_checksum.
+#
+# Every engine takes a header and a data buffer (bytes, bytearray or
+# memoryview, the header must have an even length) and returns the same
+# 16-bit value as the original loop: the end-around-carry sum of the 1's
+# complement of every big-endian 16-bit word.  The header and the data are
+# never concatenated.
+#
+# As the original loop did, an odd trailing byte b of the data is counted
+# twice: once as the word b and once padded as the word b << 8.
+
+# 2 ** 16 == 1 (mod 0xffff), so words can be summed in any width and
+# folded once at the end.
+_MOD = 0xffff
+
+
+def _fold(total, allOnes):
+    # total is the word sum reduced modulo 0xffff. The sum of complements is
+    # only 0 when every word is 0xffff (or there are no words at all),
+    # otherwise the end-around-carry sum lies within [1, 0xffff].
+    result = -total % _MOD
+    if result == 0 and not allOnes():
+        return 0xffff
+    return result
+
+
+def _is_all_ones(header, data):
+    def check():
+        if len(data) % 2 != 0:
+            return False
+        return (bytes(header) + bytes(data)).strip(b'\xff') == b''
+    return check
+
+
+def _tail(data):
+    # returns the even part of the data and the value the odd byte adds
+    view = memoryview(data)
+    if len(view) % 2 == 0:
+        return view, 0
+    b = view[-1]
+    return view[:-1], b + (b << 8)
+
+
+# The original algorithm, kept as the reference implementation
+def loop_sum(header, data):
+    checksum = 0
+    for i in range(0, len(header), 2):
+        val = ~int.from_bytes(header[i:i+2], byteorder='big', signed=False) & 0x0000ffff
+        checksum = (val + checksum)
+        checksum = (((checksum & 0xffff0000) >> 16) + (checksum & 0x0000ffff))
+    for i in range(0, len(data), 2):
+        val = ~int.from_bytes(data[i:i+2], byteorder='big', signed=False) & 0x0000ffff
+        checksum = (val + checksum)
+        checksum = ((checksum & 0xffff0000) >> 16) + (checksum & 0x0000ffff)
+    if len(data) % 2 != 0:
+        pad = bytearray([data[-1], 0x00])
+        val = ~int.from_bytes(pad, byteorder='big', signed=False) & 0x0000ffff
+        checksum = (val + checksum)
+        checksum = ((checksum & 0xffff0000) >> 16) + (checksum & 0x0000ffff)
+    return checksum
+
+
+# Reads the whole buffer as one big-endian integer, since
+# sum(w[i] * 2**(16*i)) == sum(w[i]) (mod 0xffff)
+def bigint_sum(header, data):
+    even, extra = _tail(data)
+    total = (int.from_bytes(header, byteorder='big') +
+             int.from_bytes(even, byteorder='big') + extra)
+    return _fold(total % _MOD, _is_all_ones(header, data))
+
+
+# A native 64-bit word equals the byte-swapped big-endian word sum
+# times 256 on little-endian hosts (256 * 256 == 1 mod 0xffff)
+_SWAP = 256 if sys.byteorder == 'little' else 1
+
+
+def _word_sum(view):
+    aligned = len(view) - len(view) % 8
+    total = sum(view[:aligned].cast('Q')) * _SWAP
+    return total + int.from_bytes(view[aligned:], byteorder='big')
+
+
+def words_sum(header, data):
+    even, extra = _tail(data)
+    total = _word_sum(memoryview(header).cast('B')) + _word_sum(even.cast('B')) + extra
+    return _fold(total % _MOD, _is_all_ones(header, data))
+
+
+engines = {
+    'loop': loop_sum,
+    'bigint': bigint_sum,
+    'words': words_sum
+}
+
+ones_complement_sum = bigint_sum
+
+
+def set_checksum_engine(name):
+    global ones_complement_sum
+    if name not in engines:
+        raise ValueError('Unknown checksum engine %s' % name)
+    ones_complement_sum = engines[name]
+
+
+def get_checksum_engine():
+    return ones_complement_sum
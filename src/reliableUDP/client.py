@@ -1,4 +1,5 @@
 from .connection import rUDPConnection
+from .engine import new_engine
 from .lftplog import logger
 from .utilities import *
 from .application import app
@@ -6,8 +7,19 @@ import random
 import socket
 
 class rUDPClient:
-    def __init__(self, app):
-        self.conn = rUDPConnection("0.0.0.0", 0)
+    # segSize is the largest segment size offered to the server, by default
+    # the one that fits the MTU of the route to it
+    # engine is 'thread' or 'asyncio', see engine.py
+    # bufferSize is the size of the sending and receiving buffers
+    # congestion names the congestion controller, see congestion.py
+    # ackEvery in-order segments are acked together, or ackDelay seconds
+    # after the first of them
+    # pacing spreads the window over the round trip, rate caps the sending
+    # rate (bytes per second)
+    def __init__(self, app, segSize=None, offload=True, engine='thread', bufferSize=None, congestion='reno',
+                 ackEvery=ACK_EVERY, ackDelay=DELAYED_ACK_TIMEOUT, pacing=True, rate=None):
+        self.engine = new_engine(engine)
+        self.conn = rUDPConnection("0.0.0.0", 0, offload, self.engine)
         self.ip = self.conn.ip
         self.port = self.conn.port
         self.state = SendStates.CLOSED
@@ -17,60 +29,117 @@ class rUDPClient:
         self.serverSeq = 0
         self.canSend = True
         self.messages = msgPool()
-        self.recvWin = rcvBuffer()
+        self.localSegSize = segSize
+        # negotiated in the handshake
+        self.segSize = PACKET_SIZE
+        self.bufferSize = buffer_size(bufferSize)
+        self.conn.set_buffer_size(self.bufferSize)
+        self.recvWin = rcvBuffer(size=self.bufferSize)
+        # sized once the segment size is negotiated, the asyncio engine
+        # gets its datagrams from the event loop
+        self.ring = None
         self.recvEmpty = False
-        self.sendWin = sndBuffer()
+        self.sendWin = sndBuffer(self.bufferSize, congestion)
+        self.rtt = rttEstimator(self.sendWin.on_rtt_sample)
+        self.acks = delayedAck(self.engine, self.ack_msg, ackEvery, ackDelay)
+        self.pacing = pacing
+        self.pacer = pacer(self.engine, self.check_cong_and_send, rate)
+        # whether acks may ride on data, see complete_handshake
+        self.piggyback = False
         self.app = app
         self.finished = False
         self.listener = None
         self.seqLock = threading.Lock()
         self.ackLock = threading.Lock()
+        self.sendLock = threading.Lock()
 
+    # for app to use, the returned memoryview is valid until release_rcv_buffer
     def consume_rcv_buffer(self):
-        if self.recvWin.get_win() == 0:
-            headerDict = defaultHeaderDict.copy()
-            headerDict.update({
-                Sec.sPort: self.port,
-                Sec.dPort: self.destPort,
-                Sec.ackNum: 0,
-                Sec.seqNum: self.seqNum,
-                Sec.ACK: 1,
-                Sec.SYN: 0,
-                Sec.recvWin: 1
-            })
-            headerData = dict_to_header(headerDict)
-            fill_checksum(headerData, bytearray())
-            win_msg = message(headerData, self.conn)
-            win_msg.send((self.destIP, self.destPort))
         data = self.recvWin.pop()
         return data
 
+    # for app to use, hands back the data got from consume_rcv_buffer
+    def release_rcv_buffer(self):
+        full = self.recvWin.get_win() == 0
+        self.recvWin.release()
+        if full:
+            # the window opened again
+            self.ack_msg()
+
     # for app to use
     def append_snd_buffer(self, data: bytearray):
-        full = self.sendWin.add(data)
+        return self.appended(self.sendWin.add(data))
+
+    # for app to use, reads length bytes of the file fd from position into
+    # the sending buffer after prefix, with no copy in between. Returns
+    # the bytes read (fewer when the file ended early, then nothing was
+    # added) or None when the buffer is full.
+    def append_snd_file(self, fd, position, length, prefix=b''):
+        count = self.sendWin.add_file(fd, position, length, prefix)
+        if not self.appended(count is None):
+            return None
+        return count
+
+    # Sends what was added to the sending buffer, full tells that it did not fit
+    def appended(self, full):
         if full:
             if self.sendWin.lastByteSent == self.sendWin.lastByteReady:
                 self.check_cong_and_send()
             return False    # sending buffer cannot add for now
-        if self.sendWin.get_cwnd() == 0:  # first file trunk
-            self.sendWin.set_cwnd(1)
-            self.sendWin.set_win(1)
-            self.sendWin.ssthresh = 10
-            self.sendWin.state = CwndState.SLOWSTART
+        if self.sendWin.state == CwndState.SHAKING:  # first file trunk
+            self.sendWin.start()
             self.check_cong_and_send()
+        elif self.sendWin.can_send():
+            # the window drained before this data was added
+            self.check_cong_and_send(False)
         return True
-        
-    def check_cong_and_send(self):
-        datalist = self.sendWin.get_data()
-        if not datalist:
-            self.app.notify_next_move((self.destIP, self.destPort))
-            return
-        if datalist[0] == 1:
-            return
-        for data in datalist:
-            self.send_msg(data)
-        self.app.notify_next_move((self.destIP, self.destPort))
 
+    # notify is False when called by the app itself
+    def check_cong_and_send(self, notify=True):
+        # Both the ack handler and the app may get here, the window
+        # must be read and sent by one of them at a time
+        self.sendLock.acquire()
+        try:
+            datalist = self.sendWin.get_data()
+            if datalist:
+                # the rest goes when the pacer wakes
+                self.pace()
+                datalist = datalist[:self.pacer.admit(datalist)]
+            if not datalist:
+                if notify:
+                    self.engine.notify_next_move(self.app, (self.destIP, self.destPort))
+                return
+            batch = []
+            for data in datalist:
+                self.send_msg(data, True, batch)
+            self.send_batch(batch)
+        finally:
+            self.sendLock.release()
+        if notify:
+            self.engine.notify_next_move(self.app, (self.destIP, self.destPort))
+
+
+    # Sets the pacer to the window's pacing rate
+    def pace(self):
+        rate = self.sendWin.pacing_rate(self.rtt.get_rtt()) if self.pacing else None
+        self.pacer.set_rate(rate, self.segSize)
+
+    # Smoothed round trip time in seconds, None before the first sample
+    def get_rtt(self):
+        return self.rtt.get_rtt()
+
+    # Current retransmission timeout in seconds
+    def get_rto(self):
+        return self.rtt.get_rto()
+
+    # Congestion window and loss recovery counters of the sending side,
+    # e.g. how many losses were repaired without a timeout
+    def get_send_stats(self):
+        return self.sendWin.stats()
+
+    # Slots and fallbacks of the receive ring, None with the asyncio engine
+    def get_ring_stats(self):
+        return self.ring.stats() if self.ring is not None else None
 
     def update_state(self, newState):
         logger.debug("State: %s->%s" % (self.state, newState))
@@ -79,106 +148,127 @@ class rUDPClient:
     def establish_conn(self):
         # random seq in first handshake
         self.seqNum = random.randint(1, 2 ** 16)
-        headerDict = defaultHeaderDict.copy()
-        headerDict.update({
-            Sec.sPort: self.port,
-            Sec.dPort: self.destPort,
-            Sec.seqNum: self.seqNum,
-            Sec.ackNum: 0,
-            Sec.ACK: 0,
-            Sec.SYN: 1
-        })
-        headerData = dict_to_header(headerDict)
+        self.localSegSize = local_segment_size(self.destIP, self.localSegSize)
+        options = pack_syn_options(self.localSegSize, window_scale(self.recvWin.size)) + \
+            pack_sack_permitted_option()
+        headerData = rUDPHeader(sPort=self.port, dPort=self.destPort, seqNum=self.seqNum, ackNum=0,
+                                ACK=0, SYN=1, offset=(defaultHeaderLen + len(options)) // 4,
+                                recvWin=self.recvWin.get_syn_win()).pack()
+        headerData += options
         fill_checksum(headerData, bytearray())
         logger.debug("First handshake sent, seq: " + str(self.seqNum))
-        syn_msg = message(headerData, self.conn, self.sendWin)
+        syn_msg = message(headerData, self.conn, self.sendWin, rtt=self.rtt)
         syn_msg.send_with_timer((self.destIP, self.destPort))
         self.messages.add_msg(syn_msg, self.seqNum+1)
         self.update_state(SendStates.SYN_SENT)
 
     def third_handshake(self):
         self.seqNum = self.seqNum + 1
-        headerDict = defaultHeaderDict.copy()
-        headerDict.update({
-            Sec.sPort: self.port,
-            Sec.dPort: self.destPort,
-            Sec.seqNum: self.seqNum,
-            Sec.ackNum: self.serverSeq + 1,
-            Sec.ACK: 1,
-            Sec.SYN: 0
-        })
-        headerData = dict_to_header(headerDict)
+        headerData = rUDPHeader(sPort=self.port, dPort=self.destPort, seqNum=self.seqNum,
+                                ackNum=self.serverSeq + 1, ACK=1, SYN=0).pack()
         fill_checksum(headerData, bytearray())
         logger.debug("Third handshake sent, seq: " + str(self.seqNum))
         syn_msg = message(headerData, self.conn)
         syn_msg.send((self.destIP, self.destPort))
         self.messages.add_msg(syn_msg, self.seqNum+1)
         self.update_state(SendStates.ESTABLISHED)
-        self.app.notify_next_move()
-        # Start listening message
-        self.listener = threading.Thread(target=self.listen_msg, daemon=True)
-        self.listener.start()
-        self.listener.join()
+        self.engine.notify_next_move(self.app, (self.destIP, self.destPort))
 
+    # Called with the second handshake received from the server
+    def complete_handshake(self, data, header: rUDPHeader):
+        self.rtt.ack(self.messages.get_mess(self.seqNum+1))
+        self.messages.ack_msg(self.seqNum+1)
+        options = get_options(data, header)
+        self.segSize = min(self.localSegSize, options.get(OPTION_MSS) or PACKET_SIZE)
+        self.recvWin.segSize = self.segSize
+        self.sendWin.segSize = self.segSize
+        if OPTION_WSCALE in options:
+            # the server scales its windows, a server without the option
+            # counts them in segments
+            self.recvWin.scale = window_scale(self.recvWin.size)
+            self.sendWin.peerScale = options[OPTION_WSCALE]
+        # a server that does not take SACK blocks only gets cumulative acks,
+        # nor does it take data with the ACK flag
+        self.recvWin.sack = OPTION_SACK_PERMITTED in options
+        self.piggyback = self.recvWin.sack
+        self.sendWin.peerSack = self.recvWin.sack
+        self.sendWin.set_win(max(header.recvWin, self.segSize))
+        logger.debug('Segment size %d negotiated' % self.segSize)
+        if self.engine.name == 'thread':
+            self.ring = new_recv_ring(self.bufferSize, self.segSize, self.conn.gro)
+        self.serverSeq = header.seqNum + 1
+        self.third_handshake()
 
     def handshake(self):
         logger.debug('Performing first handshake')
         self.establish_conn()
         logger.debug('Waiting for second handshake')
         data, addr = self.conn.socket.recvfrom(100)
-        headerDict = header_to_dict(data)
+        header = rUDPHeader.unpack(data)
         while not (addr == (self.destIP, self.destPort) and
                    check_header_checksum(data) and
-                   self.check_establish_header(headerDict)):
+                   self.check_establish_header(header)):
             data, addr = self.conn.socket.recvfrom(100)
-            headerDict = header_to_dict(data)
-        self.messages.ack_msg(self.seqNum+1)
-        self.serverSeq = headerDict[Sec.seqNum] + 1
-        self.third_handshake()
+            header = rUDPHeader.unpack(data)
+        self.complete_handshake(data, header)
+        # Start listening message
+        self.listener = threading.Thread(target=self.listen_msg, daemon=True)
+        self.listener.start()
+        self.listener.join()
 
-    def check_establish_header(self, headerDict: dict):
-        if headerDict[Sec.dPort] != self.port or headerDict[Sec.sPort] != self.destPort:
+    def check_establish_header(self, header: rUDPHeader):
+        if header.dPort != self.port or header.sPort != self.destPort:
             return False
-        if not (headerDict[Sec.SYN] and headerDict[Sec.ACK]):
+        if not (header.SYN and header.ACK):
             return False
-        return headerDict[Sec.ackNum] == self.seqNum + 1
+        return header.ackNum == self.seqNum + 1
 
     def connect(self, destIP, destPort):
         if self.state == SendStates.CLOSED:
             logger.info('Establishing connection to %s:%d' % (destIP, destPort))
             self.destIP = destIP
             self.destPort = destPort
-            self.handshake()
+            if self.engine.name == 'asyncio':
+                # the loop runs here until the connection is finished
+                self.engine.run(self.conn, self.process_datagram, self.establish_conn,
+                                lambda: self.finished)
+            else:
+                self.handshake()
 
-    def send_msg(self, data):
+    # fromBuffer tells that data is the next unsent segment of sendWin,
+    # with a batch list the message is put in it for send_batch to send
+    def send_msg(self, data, fromBuffer=False, batch=None):
         if self.state == SendStates.CLOSED:
             logger.error("Sending message without establishing connection.")
             raise Exception("Connection not established.")
         self.seqLock.acquire()
         try:
-            headerDict = defaultHeaderDict.copy()
-            headerDict.update({
-                Sec.sPort: self.conn.port,
-                Sec.dPort: self.destPort,
-                Sec.seqNum: self.seqNum,
-                Sec.ackNum: self.serverSeq,
-                Sec.SYN: 0,
-                Sec.ACK: 0,
-                Sec.FIN: 0,
-                Sec.recvWin: self.recvWin.get_win()
-            })
-            headerData = dict_to_header(headerDict)
+            # the delayed ack rides on the data
+            piggyback = self.piggyback and self.acks.take()
+            headerData = rUDPHeader(sPort=self.conn.port, dPort=self.destPort, seqNum=self.seqNum,
+                                    ackNum=self.serverSeq, SYN=0, ACK=piggyback, FIN=0,
+                                    recvWin=self.recvWin.get_win()).pack()
             fill_checksum(headerData, data)
             logger.debug("data message sent, seq: " + str(self.seqNum))
-            data_msg = message(headerData + data, self.conn, self.sendWin)
-            data_msg.send_with_timer((self.destIP, self.destPort))
+            data_msg = message(headerData, self.conn, self.sendWin, data, self.rtt, self.seqNum)
             self.seqNum += len(data)
             self.messages.add_msg(data_msg, self.seqNum)
-            if self.sendWin.state != CwndState.SHAKING:
+            if fromBuffer:
                 self.sendWin.send(data_msg)
+            if batch is not None:
+                batch.append(data_msg)
+            else:
+                data_msg.send_with_timer((self.destIP, self.destPort))
         finally:
             self.seqLock.release()
 
+    # Sends the messages collected by send_msg with as few syscalls as the
+    # socket allows, then starts their timers
+    def send_batch(self, batch):
+        self.conn.send_batch([mess.parts() for mess in batch], (self.destIP, self.destPort))
+        for mess in batch:
+            mess.send_with_timer((self.destIP, self.destPort), True)
+
 
     # initiate Client's first wavehand, fourth wavehand is triggered when the second 
     # and third wavehand are received from server.
@@ -191,38 +281,30 @@ class rUDPClient:
     def first_wavehand(self):
         logger.debug('Sending first wave header')
         self.seqNum = self.seqNum + 1
-        headerDict = defaultHeaderDict.copy()
-        headerDict.update({
-            Sec.sPort: self.port,
-            Sec.dPort: self.destPort,
-            Sec.seqNum: self.seqNum,
-            Sec.ackNum: self.serverSeq,
-            Sec.ACK: 1,
-            Sec.FIN: 1
-        })
-        headerData = dict_to_header(headerDict)
+        headerData = rUDPHeader(sPort=self.port, dPort=self.destPort, seqNum=self.seqNum,
+                                ackNum=self.serverSeq, ACK=1, FIN=1).pack()
         fill_checksum(headerData, bytearray())
         logger.debug("First wave sent, seq: " + str(self.seqNum))
-        syn_msg = message(headerData, self.conn, self.sendWin)
+        syn_msg = message(headerData, self.conn, self.sendWin, rtt=self.rtt, seqNum=self.seqNum)
         syn_msg.send_with_timer((self.destIP, self.destPort))
         self.messages.add_msg(syn_msg, self.seqNum+1)
         self.update_state(SendStates.FIN_WAIT_1)
 
-    def check_second_wave(self, headerDict: dict):
-        if headerDict[Sec.ackNum] != self.seqNum + 1:
+    def check_second_wave(self, header: rUDPHeader):
+        if header.ackNum != self.seqNum + 1:
             return False
-        if headerDict[Sec.FIN] or not headerDict[Sec.ACK]:
+        if header.FIN or not header.ACK:
             return False
-        if headerDict[Sec.dPort] != self.port or headerDict[Sec.sPort] != self.destPort:
+        if header.dPort != self.port or header.sPort != self.destPort:
             return False
         return True
 
-    def check_third_wave(self, headerDict: dict):
-        if headerDict[Sec.ackNum] != self.seqNum + 1:
+    def check_third_wave(self, header: rUDPHeader):
+        if header.ackNum != self.seqNum + 1:
             return False
-        if not headerDict[Sec.FIN] or not headerDict[Sec.ACK]:
+        if not header.FIN or not header.ACK:
             return False
-        if headerDict[Sec.dPort] != self.port or headerDict[Sec.sPort] != self.destPort:
+        if header.dPort != self.port or header.sPort != self.destPort:
             return False
         return True
 
@@ -242,116 +324,150 @@ class rUDPClient:
     def fourth_wavehand(self):
         logger.debug('Sending first wave header')
         self.seqNum = self.seqNum + 1
-        headerDict = defaultHeaderDict.copy()
-        headerDict.update({
-            Sec.sPort: self.port,
-            Sec.dPort: self.destPort,
-            Sec.seqNum: self.seqNum,
-            Sec.ackNum: self.serverSeq,
-            Sec.ACK: 1,
-            Sec.FIN: 0
-        })
-        headerData = dict_to_header(headerDict)
+        headerData = rUDPHeader(sPort=self.port, dPort=self.destPort, seqNum=self.seqNum,
+                                ackNum=self.serverSeq, ACK=1, FIN=0).pack()
         fill_checksum(headerData, bytearray())
         logger.debug("First wave sent, seq: " + str(self.seqNum))
         syn_msg = message(headerData, self.conn)
         syn_msg.send((self.destIP, self.destPort))
         self.update_state(SendStates.TIME_WAIT)
-        close_thread = threading.Timer(30, self.close)
-        close_thread.start()
+        self.engine.schedule(TIME_WAIT_TIMEOUT, self.close)
 
-    def process_msg(self, data):
+    def process_msg(self, data, slot: recvSlot=None):
         if not check_header_checksum(data):
             logger.debug('received a packet with invalid checksum')
-        headerDict = header_to_dict(data)
+            return
+        seqNum, ackNum, offset, flags, recvWin = get_hot_fields(data)
         self.ackLock.acquire()
         try:
-            if headerDict[Sec.ACK]:
+            seqNum = unwrap_seq(seqNum, self.serverSeq)
+            ackNum = unwrap_seq(ackNum, self.seqNum)
+            payload = data[offset * 4:]
+            if flags & FLAG_ACK:
                 # ack message
-                mess = self.messages.get_mess(headerDict[Sec.ackNum])
+                sacked = 0
+                if offset > 5:
+                    sacked = self.process_sack(data, ackNum)
+                mess = self.messages.get_mess(ackNum)
                 if mess is not None:
-                    self.messages.ack_to_num(headerDict[Sec.ackNum])
-                    logger.debug('Received ack message with ackNum=%d' % headerDict[Sec.ackNum])
-                    if headerDict[Sec.ackNum] == self.seqNum and self.state == SendStates.FIN_WAIT_1:
+                    self.rtt.ack(mess)
+                    self.messages.ack_to_num(ackNum)
+                    logger.debug('Received ack message with ackNum=%d' % ackNum)
+                    if ackNum == self.seqNum and self.state == SendStates.FIN_WAIT_1:
                         self.second_wavehand()
-                    elif self.state == SendStates.FIN_WAIT_2 and headerDict[Sec.FIN]:
+                    elif self.state == SendStates.FIN_WAIT_2 and flags & FLAG_FIN:
                         self.third_wavehand()
                     else:
                         if self.sendWin.state != CwndState.SHAKING:
-                            if headerDict[Sec.recvWin] > 0:
-                                if headerDict[Sec.ackNum] > 0:
-                                    flag = self.sendWin.ack(mess)
-                                    self.sendWin.set_win(min(headerDict[Sec.recvWin], self.sendWin.get_cwnd()))
-                                    if flag is not False:
-                                        self.check_cong_and_send()
-                                else:
+                            if ackNum > 0:
+                                flag = self.sendWin.ack(mess)
+                                # a closed window is not applied, what is sent next
+                                # probes it until the window update comes
+                                if recvWin > 0:
+                                    self.sendWin.set_peer_win(recvWin)
+                                if flag is not False:
+                                    self.fast_retransmit(self.sendWin.hole())
                                     self.check_cong_and_send()
-            else:
-                if len(data) - defaultHeaderLen != PACKET_SIZE:
+                            else:
+                                self.check_cong_and_send()
+                elif ackNum > 0 and len(payload) == 0:
+                    # acks nothing new, the server may be missing a segment
+                    self.fast_retransmit(self.sendWin.dup_ack(ackNum, recvWin, sacked))
+                    if self.sendWin.can_send():
+                        # or it opened its window
+                        self.check_cong_and_send()
+            # data may come with an ack
+            if not flags & FLAG_ACK or len(payload) > 0:
+                if len(payload) == 0 or len(payload) > self.segSize:
                     logger.debug('Received data with invalid length, discarded')
                     return
                 # normal data
-                if headerDict[Sec.seqNum] == self.serverSeq:
-
-                    if self.recvWin.get_win() > 0:
-                        logger.debug('add data with seq %d to receiving window' % headerDict[Sec.seqNum])
-                        flag = self.recvWin.add(data[defaultHeaderLen:])
-                        if flag:
-                            self.serverSeq += PACKET_SIZE
+                if seqNum == self.serverSeq:
+                    if self.recvWin.get_win() > 0 and self.recvWin.add(payload, slot):
+                        logger.debug('add data with seq %d to receiving window' % seqNum)
+                        # the segments received out of order may follow it
+                        self.serverSeq, pulled = self.recvWin.pull(self.serverSeq + len(payload))
+                        # filling a hole or closing the window is acked at once
+                        if pulled > 0 or self.recvWin.get_win() == 0 or self.acks.segment():
                             self.ack_msg()
-                        self.app.notify_process_data()
-                    if self.recvWin.get_win() == 0:
+                        for i in range(pulled + 1):
+                            self.engine.notify_process_data(self.app, (self.destIP, self.destPort))
+                    else:
                         logger.debug('rcvWindow full')
-                        headerDict = defaultHeaderDict.copy()
-                        headerDict.update({
-                            Sec.sPort: self.port,
-                            Sec.dPort: self.destPort,
-                            Sec.seqNum: self.seqNum,
-                            Sec.ackNum: 0,
-                            Sec.ACK: 1,
-                            Sec.SYN: 0,
-                            Sec.recvWin: self.recvWin.get_win()
-                        })
-                        headerData = dict_to_header(headerDict)
-                        fill_checksum(headerData, bytearray())
-                        win_msg = message(headerData, self.conn)
-                        win_msg.send((self.destIP, self.destPort))
-                elif headerDict[Sec.seqNum] <= self.serverSeq:
+                        self.ack_msg()
+                elif seqNum < self.serverSeq:
                     self.ack_msg()
                 else:
-                    logger.debug('Discarded packet %d not arrived in order, Expecting: %d' % (headerDict[Sec.seqNum], self.serverSeq))
+                    # kept until the hole before it is filled, the ack
+                    # reports it in a SACK block
+                    if not self.recvWin.add_out_of_order(seqNum, self.serverSeq, payload, slot):
+                        logger.debug('Discarded packet %d beyond the window, Expecting: %d' % (seqNum, self.serverSeq))
+                    self.ack_msg()
         finally:
             self.ackLock.release()
 
+    # mess is the oldest segment in flight once taken as lost, it is sent
+    # again without waiting for its timer
+    def fast_retransmit(self, mess):
+        if mess is not None:
+            mess.retransmit((self.destIP, self.destPort))
+
+    # The server received the messages in the SACK blocks of the ack, only
+    # the holes between them are left to retransmit. Returns how many
+    # messages they reported first
+    def process_sack(self, data, ackNum):
+        header = rUDPHeader.unpack(data)
+        header.ackNum = ackNum
+        sacked = self.messages.sack(get_sack_blocks(data, header))
+        if sacked:
+            self.sendWin.sack(sacked)
+            self.check_cong_and_send(False)
+        return len(sacked)
+
+    # Sends an ack, along with the delayed ones
     def ack_msg(self):
-        headerDict = defaultHeaderDict.copy()
-        headerDict.update({
-            Sec.sPort: self.conn.port,
-            Sec.dPort: self.destPort,
-            Sec.seqNum: self.seqNum,
-            Sec.ackNum: self.serverSeq,
-            Sec.SYN: 0,
-            Sec.ACK: 1,
-            Sec.FIN: 0,
-            Sec.recvWin: self.recvWin.get_win()
-        })
-        headerData = dict_to_header(headerDict)
+        self.acks.take()
+        options = pack_sack_option(self.recvWin.sack_blocks())
+        headerData = rUDPHeader(sPort=self.conn.port, dPort=self.destPort, seqNum=self.seqNum,
+                                ackNum=self.serverSeq, SYN=0, ACK=1, FIN=0,
+                                offset=(defaultHeaderLen + len(options)) // 4,
+                                recvWin=self.recvWin.get_win()).pack()
+        headerData += options
         fill_checksum(headerData, bytearray())
         logger.debug("sent ack message, ackNum: " + str(self.serverSeq))
         ack_msg = message(headerData, self.conn)
         ack_msg.send((self.destIP, self.destPort))
     
+    def process_recv_slot(self, slot: recvSlot):
+        try:
+            for data in slot.datagrams():
+                self.process_msg(data, slot)
+        finally:
+            slot.release()
+
     # Start a thread for this function after establishing connection 
     def listen_msg(self):
         self.conn.socket.settimeout(1)
         while not self.finished:
             try:
-                data, addr = self.conn.socket.recvfrom(6144)
+                slot, addr = self.ring.recv_into(self.conn)
                 if addr != (self.destIP, self.destPort):
                     logger.debug('Received message from unexpected sender')
+                    slot.release()
                     continue
                 else:
-                    processor = threading.Thread(target=self.process_msg, args=[data], daemon=True)
-                    processor.start()
+                    self.engine.dispatch(addr, self.process_recv_slot, slot)
             except socket.timeout:
                 continue
+
+    # Datagram handler of the asyncio engine
+    def process_datagram(self, data, addr):
+        if addr != (self.destIP, self.destPort):
+            logger.debug('Received message from unexpected sender')
+            return
+        if self.state == SendStates.SYN_SENT:
+            header = rUDPHeader.unpack(data)
+            if check_header_checksum(data) and self.check_establish_header(header):
+                self.complete_handshake(data, header)
+            return
+        self.process_msg(data)
@@ -0,0 +1,292 @@
+import time
+from collections import deque
+from enum import Enum
+
+# noinspection PyArgumentList
+CwndState = Enum('CwndState', ('SLOWSTART', 'CONGAVOID', 'SHAKING', 'RECOVERY'))
+
+# A congestion controller decides how many segments a connection keeps in
+# flight. sndBuffer owns one and calls it with its lock held: start once the
+# handshake is done, on_ack for every cumulative ack, on_loss for a loss
+# event, on_recovery_end once a fast recovery is over and on_rtt_sample for
+# every round trip measured. cwnd counts
+# segments and may be fractional, sndBuffer sends int(cwnd) of them.
+
+# RFC 6928
+INITIAL_CWND = 10
+MIN_CWND = 2
+
+
+class congestionController:
+    name = None
+
+    def __init__(self):
+        self.cwnd = INITIAL_CWND
+        self.ssthresh = None
+        self.segSize = 1
+        self.maxCwnd = INITIAL_CWND
+        self.state = CwndState.SLOWSTART
+
+    # segSize is the negotiated segment size, maxCwnd the segments the
+    # sending buffer holds
+    def start(self, segSize, maxCwnd):
+        self.segSize = segSize
+        self.maxCwnd = maxCwnd
+        # slow start until the first loss
+        self.ssthresh = maxCwnd
+        self.cwnd = min(self.cwnd, maxCwnd)
+
+    # segments and size (bytes) were acked, inFlight bytes are still out
+    def on_ack(self, segments, size, inFlight):
+        pass
+
+    # timeout is False for a loss found without waiting for the timer,
+    # the window then stays in fast recovery until on_recovery_end
+    def on_loss(self, timeout=True):
+        pass
+
+    def on_recovery_end(self):
+        if self.state == CwndState.RECOVERY:
+            self.state = CwndState.CONGAVOID
+
+    def on_rtt_sample(self, rtt):
+        pass
+
+    def get_cwnd(self):
+        return max(1, int(self.cwnd))
+
+    # Bytes per second to pace the segments at, None to send them at once
+    def pacing_rate(self):
+        return None
+
+    def clamp(self):
+        self.cwnd = min(self.cwnd, self.maxCwnd)
+
+    def stats(self):
+        return {
+            'name': self.name,
+            'state': self.state.name,
+            'cwnd': self.cwnd,
+            'ssthresh': self.ssthresh
+        }
+
+
+# Slow start, then one more segment per round trip, halved on loss (RFC 5681)
+class renoController(congestionController):
+    name = 'reno'
+
+    def on_ack(self, segments, size, inFlight):
+        if self.state == CwndState.RECOVERY:
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd += segments
+            if self.cwnd >= self.ssthresh:
+                self.state = CwndState.CONGAVOID
+        else:
+            self.cwnd += segments / self.cwnd
+        self.clamp()
+
+    def on_loss(self, timeout=True):
+        self.ssthresh = max(self.cwnd / 2, MIN_CWND)
+        if timeout:
+            self.cwnd = 1
+            self.state = CwndState.SLOWSTART
+        else:
+            self.cwnd = self.ssthresh
+            self.state = CwndState.RECOVERY
+
+
+CUBIC_C = 0.4
+CUBIC_BETA = 0.7
+
+
+# The window follows a cubic function of the time since the last loss,
+# centered on the window the loss happened at (RFC 8312)
+class cubicController(congestionController):
+    name = 'cubic'
+
+    def __init__(self):
+        congestionController.__init__(self)
+        self.wMax = 0
+        self.epochStart = None
+        self.k = 0
+        self.origin = 0
+        # the window Reno would have, the cubic one never falls below it
+        self.wEst = 0
+        self.srtt = 0
+
+    def on_ack(self, segments, size, inFlight):
+        if self.state == CwndState.RECOVERY:
+            return
+        if self.cwnd < self.ssthresh:
+            self.cwnd += segments
+            if self.cwnd >= self.ssthresh:
+                self.state = CwndState.CONGAVOID
+            self.clamp()
+            return
+        now = time.monotonic()
+        if self.epochStart is None:
+            self.epochStart = now
+            if self.cwnd < self.wMax:
+                self.k = ((self.wMax - self.cwnd) / CUBIC_C) ** (1 / 3)
+                self.origin = self.wMax
+            else:
+                self.k = 0
+                self.origin = self.cwnd
+            self.wEst = self.cwnd
+        t = now - self.epochStart + self.srtt
+        target = self.origin + CUBIC_C * (t - self.k) ** 3
+        if target > self.cwnd:
+            self.cwnd += (target - self.cwnd) / self.cwnd * segments
+        else:
+            self.cwnd += 0.01 * segments / self.cwnd
+        self.wEst += 3 * (1 - CUBIC_BETA) / (1 + CUBIC_BETA) * segments / self.cwnd
+        if self.wEst > self.cwnd:
+            self.cwnd = self.wEst
+        self.clamp()
+
+    def on_loss(self, timeout=True):
+        self.epochStart = None
+        # fast convergence, give way to newer flows
+        if self.cwnd < self.wMax:
+            self.wMax = self.cwnd * (1 + CUBIC_BETA) / 2
+        else:
+            self.wMax = self.cwnd
+        self.ssthresh = max(self.cwnd * CUBIC_BETA, MIN_CWND)
+        if timeout:
+            self.cwnd = 1
+            self.state = CwndState.SLOWSTART
+        else:
+            self.cwnd = self.ssthresh
+            self.state = CwndState.RECOVERY
+
+    def on_rtt_sample(self, rtt):
+        self.srtt = rtt if self.srtt == 0 else 0.875 * self.srtt + 0.125 * rtt
+
+    def stats(self):
+        result = congestionController.stats(self)
+        result['wMax'] = self.wMax
+        return result
+
+
+BBR_STARTUP_GAIN = 2.885
+BBR_CWND_GAIN = 2
+BBR_PROBE_GAINS = (1.25, 0.75, 1, 1, 1, 1, 1, 1)
+# delivery rate samples the bottleneck bandwidth is the largest of
+BBR_BW_SAMPLES = 10
+# seconds a minimum round trip stays valid
+BBR_MIN_RTT_WINDOW = 10
+# rounds without 25% more bandwidth before the pipe is taken as full
+BBR_FULL_ROUNDS = 3
+
+
+# Models the path instead of reacting to losses: the bottleneck bandwidth is
+# the largest recent delivery rate and the window is a multiple of the
+# bandwidth-delay product. Losses do not shrink the window below it.
+class bbrController(congestionController):
+    name = 'bbr'
+
+    def __init__(self):
+        congestionController.__init__(self)
+        self.mode = 'STARTUP'
+        self.minRtt = None
+        self.minRttTime = 0
+        self.bwSamples = deque(maxlen=BBR_BW_SAMPLES)
+        self.delivered = 0
+        self.sampleStart = None
+        self.sampleDelivered = 0
+        self.fullBw = 0
+        self.fullRounds = 0
+        self.cycleIndex = 0
+
+    def bandwidth(self):
+        return max(self.bwSamples) if self.bwSamples else None
+
+    # The bandwidth-delay product in segments, None before it is known
+    def bdp(self):
+        bw = self.bandwidth()
+        if bw is None or self.minRtt is None:
+            return None
+        return bw * self.minRtt / self.segSize
+
+    def on_ack(self, segments, size, inFlight):
+        now = time.monotonic()
+        self.delivered += size
+        if self.sampleStart is None:
+            self.sampleStart = now
+            self.sampleDelivered = self.delivered
+        elif now - self.sampleStart >= max(self.minRtt or 0, 0.001):
+            # a sample a round trip long
+            self.bwSamples.append((self.delivered - self.sampleDelivered) / (now - self.sampleStart))
+            self.sampleStart = now
+            self.sampleDelivered = self.delivered
+            self.end_round()
+        bdp = self.bdp()
+        if self.mode == 'STARTUP' or bdp is None:
+            self.cwnd += segments
+        elif self.mode == 'DRAIN':
+            self.cwnd = max(bdp, MIN_CWND)
+            if inFlight <= bdp * self.segSize:
+                self.mode = 'PROBE_BW'
+        else:
+            # the probe gains vary the pacing rate only, the window stays
+            # large enough for it to probe with
+            self.cwnd = max(BBR_CWND_GAIN * bdp, MIN_CWND * 2)
+        self.state = CwndState.SLOWSTART if self.mode == 'STARTUP' else CwndState.CONGAVOID
+        self.clamp()
+
+    def end_round(self):
+        bw = self.bandwidth()
+        if self.mode == 'STARTUP':
+            if bw >= self.fullBw * 1.25:
+                self.fullBw = bw
+                self.fullRounds = 0
+            else:
+                self.fullRounds += 1
+                if self.fullRounds >= BBR_FULL_ROUNDS:
+                    self.mode = 'DRAIN'
+        elif self.mode == 'PROBE_BW':
+            self.cycleIndex = (self.cycleIndex + 1) % len(BBR_PROBE_GAINS)
+
+    def on_loss(self, timeout=True):
+        bdp = self.bdp()
+        if bdp is None:
+            self.cwnd = max(self.cwnd / 2, MIN_CWND)
+        else:
+            self.cwnd = max(min(self.cwnd, bdp), MIN_CWND)
+
+    def on_rtt_sample(self, rtt):
+        now = time.monotonic()
+        if self.minRtt is None or rtt <= self.minRtt or now - self.minRttTime > BBR_MIN_RTT_WINDOW:
+            self.minRtt = rtt
+            self.minRttTime = now
+
+    def pacing_rate(self):
+        bw = self.bandwidth()
+        if bw is None:
+            return None
+        if self.mode == 'STARTUP':
+            return BBR_STARTUP_GAIN * bw
+        if self.mode == 'DRAIN':
+            return bw / BBR_STARTUP_GAIN
+        return BBR_PROBE_GAINS[self.cycleIndex] * bw
+
+    def stats(self):
+        result = congestionController.stats(self)
+        result['mode'] = self.mode
+        result['bandwidth'] = self.bandwidth()
+        result['minRtt'] = self.minRtt
+        return result
+
+
+controllers = {
+    'reno': renoController,
+    'cubic': cubicController,
+    'bbr': bbrController
+}
+
+
+def new_controller(name):
+    if name not in controllers:
+        raise ValueError('Unknown congestion controller %s' % name)
+    return controllers[name]()
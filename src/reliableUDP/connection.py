@@ -1,11 +1,52 @@
 import socket
+import struct
+import sys
 from .lftplog import logger
+from .engine import threadEngine
+
+# Linux UDP segmentation offload (GSO) and receive coalescing (GRO),
+# the constants are missing from older socket modules
+SOL_UDP = getattr(socket, 'SOL_UDP', 17)
+UDP_SEGMENT = getattr(socket, 'UDP_SEGMENT', 103)
+UDP_GRO = getattr(socket, 'UDP_GRO', 104)
+IP_MTU = getattr(socket, 'IP_MTU', 14)
+
+# The kernel splits at most 64 segments out of a GSO send,
+# which must still fit in a single UDP datagram
+GSO_MAX_SEGMENTS = 64
+GSO_MAX_BYTES = 65507
+
+_gsoSizeStruct = struct.Struct('=H')
+_groCmsgSize = socket.CMSG_SPACE(4) if hasattr(socket, 'CMSG_SPACE') else 0
+
+
+# The MTU of the route to ip, None when the platform cannot tell
+def path_mtu(ip):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect((ip, 9))
+        return sock.getsockopt(socket.IPPROTO_IP, IP_MTU)
+    except OSError:
+        return None
+    finally:
+        sock.close()
+
 
 class rUDPConnection:
-    def __init__(self, ip=None, port=None):
+    # engine runs the timers and callbacks of the connections using this socket,
+    # with reusePort several processes can bind the same port (SO_REUSEPORT)
+    # and the kernel spreads the peers among them
+    def __init__(self, ip=None, port=None, offload=True, engine=None, reusePort=False):
         self.ip = ip
         self.port = port
+        self.engine = engine if engine is not None else threadEngine()
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.gso = False
+        self.gro = False
+        if offload:
+            self.enable_offload()
+        if reusePort:
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         if ip is not None:
             self.socket.bind((ip, port))
             (self.ip, self.port) = self.socket.getsockname()
@@ -13,4 +54,92 @@ class rUDPConnection:
         else:
             logger.debug("%s: Created rUDPConnection object" % (type(self).__name__))
 
+    # Turns on GSO and GRO where the kernel supports them
+    def enable_offload(self):
+        if not hasattr(self.socket, 'sendmsg') or not hasattr(self.socket, 'recvmsg_into'):
+            return
+        try:
+            # a gso size of 0 leaves plain sends alone, batches pass theirs per call
+            self.socket.setsockopt(SOL_UDP, UDP_SEGMENT, 0)
+            self.gso = True
+        except OSError:
+            pass
+        try:
+            if self.engine.gro:
+                self.socket.setsockopt(SOL_UDP, UDP_GRO, 1)
+                self.gro = True
+        except OSError:
+            pass
+        logger.debug("%s: UDP GSO %s, GRO %s" % (type(self).__name__, self.gso, self.gro))
+
+    # Grows the socket's kernel buffers to hold a full window, so a burst
+    # the peer is allowed to send is not dropped before it is read. The
+    # kernel caps them at net.core.rmem_max and wmem_max.
+    def set_buffer_size(self, size):
+        for option in (socket.SO_RCVBUF, socket.SO_SNDBUF):
+            try:
+                if self.socket.getsockopt(socket.SOL_SOCKET, option) < size:
+                    self.socket.setsockopt(socket.SOL_SOCKET, option, size)
+            except OSError:
+                pass
+        logger.debug("%s: Socket buffers %d/%d bytes" % (type(self).__name__,
+                     self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF),
+                     self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)))
+
+    # Send a datagram made of several buffers (e.g. a header and a memoryview
+    # of the payload) without joining them first where sendmsg is available
+    def send_parts(self, parts, addr):
+        try:
+            if hasattr(self.socket, 'sendmsg'):
+                return self.socket.sendmsg(parts, [], 0, addr)
+            return self.socket.sendto(b''.join(parts), addr)
+        except BlockingIOError:
+            # the socket is non-blocking under asyncio, a full send buffer
+            # is a loss the retransmission takes care of
+            logger.debug('Socket send buffer full, datagram dropped')
+            return 0
+
+    # Send several datagrams, each given as a list of buffers. With GSO, runs
+    # of datagrams of the same size (the last of a run may be shorter) go out
+    # in a single syscall and the kernel cuts them apart.
+    def send_batch(self, datagrams, addr):
+        i = 0
+        while i < len(datagrams):
+            size = sum(len(part) for part in datagrams[i])
+            j = i + 1
+            total = size
+            while self.gso and j < len(datagrams) and j - i < GSO_MAX_SEGMENTS:
+                length = sum(len(part) for part in datagrams[j])
+                if length > size or total + length > GSO_MAX_BYTES:
+                    break
+                total += length
+                j += 1
+                if length < size:
+                    break
+            if j - i == 1:
+                self.send_parts(datagrams[i], addr)
+            else:
+                parts = [part for datagram in datagrams[i:j] for part in datagram]
+                try:
+                    self.socket.sendmsg(parts, [(SOL_UDP, UDP_SEGMENT, _gsoSizeStruct.pack(size))], 0, addr)
+                except BlockingIOError:
+                    logger.debug('Socket send buffer full, datagrams dropped')
+                except OSError as e:
+                    # e.g. the route cannot take the segment size, send them one by one
+                    logger.warning('UDP GSO send failed (%s), disabling it' % e)
+                    self.gso = False
+                    continue
+            i = j
 
+    # Receive into buffer, returns (length, addr, segSize). segSize is
+    # the size the datagrams coalesced by GRO were cut at, 0 for a single one.
+    def recv_into(self, buffer):
+        if not self.gro:
+            length, addr = self.socket.recvfrom_into(buffer)
+            return length, addr, 0
+        length, ancdata, flags, addr = self.socket.recvmsg_into([buffer], _groCmsgSize)
+        segSize = 0
+        for level, kind, data in ancdata:
+            if level == SOL_UDP and kind == UDP_GRO:
+                segSize = int.from_bytes(data[:4], byteorder=sys.byteorder)
+        return length, addr, segSize
@@ -0,0 +1,233 @@
+import asyncio
+import collections
+import threading
+import time
+from .lftplog import logger
+from .timer import get_timer_wheel
+
+# The transport engine decides which thread runs what: received datagrams,
+# timers and the app callbacks. Connections reach it as conn.engine.
+
+
+WORKER_THREADS = 4
+# Datagrams a worker may have waiting, the receiving thread blocks
+# (and the socket buffer fills) beyond it
+WORKER_QUEUE_SIZE = 256
+
+
+# A thread processing the jobs of its queue in order. The queue holds
+# queueSize jobs for the puts that wait, the others go in past it so that
+# their jobs still run after everything put before them.
+class orderedWorker:
+    def __init__(self, index, queueSize=WORKER_QUEUE_SIZE):
+        self.queueSize = queueSize
+        self.jobs = collections.deque()
+        self.lock = threading.Lock()
+        self.notEmpty = threading.Condition(self.lock)
+        self.notFull = threading.Condition(self.lock)
+        # the most jobs waiting at once, jobs done, puts that had to wait
+        # and the seconds they waited, puts that went past queueSize
+        self.maxDepth = 0
+        self.processed = 0
+        self.blocked = 0
+        self.stalled = 0
+        self.overflowed = 0
+        self.thread = threading.Thread(target=self.run, name='rUDP worker %d' % index, daemon=True)
+        self.thread.start()
+
+    # Returns the seconds waited for room in the queue, never waits unless block
+    def put(self, callback, args, block=True):
+        waited = 0
+        self.lock.acquire()
+        try:
+            if len(self.jobs) >= self.queueSize:
+                if block:
+                    self.blocked += 1
+                    start = time.monotonic()
+                    while len(self.jobs) >= self.queueSize:
+                        self.notFull.wait()
+                    waited = time.monotonic() - start
+                    self.stalled += waited
+                else:
+                    self.overflowed += 1
+            self.jobs.append((callback, args))
+            if len(self.jobs) > self.maxDepth:
+                self.maxDepth = len(self.jobs)
+            self.notEmpty.notify()
+        finally:
+            self.lock.release()
+        return waited
+
+    def run(self):
+        while True:
+            self.lock.acquire()
+            try:
+                while not self.jobs:
+                    self.notEmpty.wait()
+                callback, args = self.jobs.popleft()
+                if len(self.jobs) < self.queueSize:
+                    self.notFull.notify()
+            finally:
+                self.lock.release()
+            try:
+                callback(*args)
+            except Exception as e:
+                logger.exception('Worker job %s failed: %s' % (callback, e))
+            self.processed += 1
+
+    def stats(self):
+        return {
+            'depth': len(self.jobs),
+            'maxDepth': self.maxDepth,
+            'processed': self.processed,
+            'blocked': self.blocked,
+            'stalled': self.stalled,
+            'overflowed': self.overflowed
+        }
+
+
+# Fixed workers with bounded FIFO queues. Jobs are sharded by key (the peer
+# address), so the datagrams of a connection are processed one at a time
+# in arrival order.
+class workerPool:
+    def __init__(self, count=WORKER_THREADS, queueSize=WORKER_QUEUE_SIZE):
+        self.queueSize = queueSize
+        # started on first use, a client only ever needs one
+        self.workers = [None] * count
+        self.lock = threading.Lock()
+
+    # Returns the seconds waited for room in the worker's queue
+    def dispatch(self, key, callback, *args):
+        return self.worker(key).put(callback, args)
+
+    # Like dispatch, but a full queue is not waited for. For jobs given by
+    # threads that hold locks the worker may need, the worker itself among them.
+    def dispatch_nowait(self, key, callback, *args):
+        self.worker(key).put(callback, args, False)
+
+    # The worker of key, started on first use
+    def worker(self, key):
+        index = hash(key) % len(self.workers)
+        worker = self.workers[index]
+        if worker is None:
+            self.lock.acquire()
+            try:
+                if self.workers[index] is None:
+                    self.workers[index] = orderedWorker(index, self.queueSize)
+                worker = self.workers[index]
+            finally:
+                self.lock.release()
+        return worker
+
+    # Queue depth counters of the started workers
+    def stats(self):
+        return [worker.stats() for worker in self.workers if worker is not None]
+
+
+# Received datagrams go to a workerPool, the app callbacks of a connection
+# run on its worker after them, timers run on the process' timer wheel
+class threadEngine:
+    name = 'thread'
+    # datagrams are read with recvmsg, so GRO batches can be split
+    gro = True
+
+    def __init__(self, workers=WORKER_THREADS, queueSize=WORKER_QUEUE_SIZE):
+        self.pool = workerPool(workers, queueSize)
+
+    def schedule(self, delay, callback, *args):
+        return get_timer_wheel().schedule(delay, callback, *args)
+
+    # Runs callback(*args) on the worker of key (the peer address of a
+    # connection) after its jobs so far, from any thread without waiting
+    def call_soon(self, key, callback, *args):
+        self.pool.dispatch_nowait(key, callback, *args)
+
+    # Runs callback(*args) after the jobs dispatched before with the same key
+    def dispatch(self, key, callback, *args):
+        self.pool.dispatch(key, callback, *args)
+
+    def stats(self):
+        return self.pool.stats()
+
+    # user is the peer address, the key of the connection's datagrams
+    def notify_process_data(self, app, user=None):
+        self.pool.dispatch_nowait(user, app.process_data, user)
+
+    def notify_next_move(self, app, user=None):
+        self.pool.dispatch_nowait(user, app.next, user)
+
+
+class rUDPProtocol(asyncio.DatagramProtocol):
+    def __init__(self, handler):
+        self.handler = handler
+
+    def datagram_received(self, data, addr):
+        # a read-only view, slicing out the payload does not copy it
+        self.handler(memoryview(data), addr)
+
+    def error_received(self, exc):
+        logger.debug('UDP error received: %s' % exc)
+
+
+# Everything runs on one asyncio event loop: the datagrams are processed as
+# they arrive, in order, timers are loop timers and the app callbacks are
+# queued on the loop instead of getting a thread each
+class asyncioEngine:
+    name = 'asyncio'
+    # DatagramProtocol does not hand over the GRO segment size
+    gro = False
+
+    def __init__(self):
+        self.loop = None
+
+    def schedule(self, delay, callback, *args):
+        return self.loop.call_later(delay, callback, *args)
+
+    # Runs callback(*args) on the loop, from any thread
+    def call_soon(self, key, callback, *args):
+        self.loop.call_soon_threadsafe(callback, *args)
+
+    # The loop already runs everything in order
+    def dispatch(self, key, callback, *args):
+        callback(*args)
+
+    def stats(self):
+        return []
+
+    def notify_process_data(self, app, user=None):
+        self.loop.call_soon(app.process_data, user)
+
+    def notify_next_move(self, app, user=None):
+        self.loop.call_soon(app.next, user)
+
+    # Runs the loop in the calling thread, feeding the datagrams received by
+    # conn to handler(data, addr). start is called once the loop runs, the
+    # loop stops when until() returns True.
+    def run(self, conn, handler, start=None, until=None):
+        asyncio.run(self.serve(conn, handler, start, until))
+
+    async def serve(self, conn, handler, start, until):
+        self.loop = asyncio.get_running_loop()
+        transport, protocol = await self.loop.create_datagram_endpoint(
+            lambda: rUDPProtocol(handler), sock=conn.socket)
+        try:
+            if start is not None:
+                start()
+            if until is None:
+                await self.loop.create_future()
+            while not until():
+                await asyncio.sleep(0.1)
+        finally:
+            transport.close()
+
+
+engines = {
+    'thread': threadEngine,
+    'asyncio': asyncioEngine
+}
+
+
+def new_engine(name):
+    if name not in engines:
+        raise ValueError('Unknown engine %s' % name)
+    return engines[name]()
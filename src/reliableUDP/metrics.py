@@ -0,0 +1,56 @@
+import multiprocessing
+import threading
+
+# Counters of the server processes sharing a port with SO_REUSEPORT. They
+# live in shared memory, one row per worker: a worker only writes its own
+# row and the parent reads all of them for the readiness and metrics view.
+
+# ioQueued is the disk I/O jobs waiting, ioStallUs the microseconds the
+# sessions waited for room in their queues
+METRIC_FIELDS = ('ready', 'pid', 'connections', 'accepted', 'datagramsIn', 'bytesIn', 'bytesOut', 'ioQueued',
+                 'ioStallUs')
+_fieldIndex = {field: i for i, field in enumerate(METRIC_FIELDS)}
+
+
+class sharedMetrics:
+    # created before the workers are started so that they inherit it
+    def __init__(self, workers):
+        self.workers = workers
+        # rows are written by a single process, no shared lock is needed
+        self.values = multiprocessing.Array('q', workers * len(METRIC_FIELDS), lock=False)
+
+    # The view a worker updates its counters through
+    def worker(self, index):
+        return workerMetrics(self.values, index)
+
+    # One dict of counters per worker
+    def snapshot(self):
+        count = len(METRIC_FIELDS)
+        values = self.values[:]
+        return [dict(zip(METRIC_FIELDS, values[i * count:(i + 1) * count])) for i in range(self.workers)]
+
+    def total(self, field):
+        index = _fieldIndex[field]
+        return sum(self.values[i * len(METRIC_FIELDS) + index] for i in range(self.workers))
+
+    def ready_count(self):
+        return self.total('ready')
+
+
+class workerMetrics:
+    def __init__(self, values, index):
+        self.values = values
+        self.base = index * len(METRIC_FIELDS)
+        self.index = index
+        # the threads of the worker process update the row concurrently
+        self.lock = threading.Lock()
+
+    def add(self, field, n=1):
+        self.lock.acquire()
+        try:
+            self.values[self.base + _fieldIndex[field]] += n
+        finally:
+            self.lock.release()
+
+    def set(self, field, value):
+        self.values[self.base + _fieldIndex[field]] = value
@@ -1,6 +1,8 @@
 import threading
 import random
 from .connection import rUDPConnection
+from .engine import new_engine
+from .congestion import new_controller
 from .utilities import *
 from .lftplog import logger
 
@@ -10,105 +12,164 @@ class serverConn:
         self.addr = addr
         self.destIP, self.destPort = addr
         self.conn = conn
+        self.engine = conn.engine
         self.state = RecvStates.LISTEN
         self.seqNum = 0
         self.clientSeq = 0
         self.app = app
         self.messages = msgPool()
-        self.recvWin = rcvBuffer()
-        self.sendWin = sndBuffer()
+        # negotiated in the handshake
+        self.segSize = PACKET_SIZE
+        self.recvWin = rcvBuffer(size=server.bufferSize)
+        self.sendWin = sndBuffer(server.bufferSize, server.congestion)
+        self.rtt = rttEstimator(self.sendWin.on_rtt_sample)
+        self.acks = delayedAck(self.engine, self.ack_message, server.ackEvery, server.ackDelay)
+        self.pacing = server.pacing
+        self.pacer = pacer(self.engine, self.check_cong_and_send, server.rate, server.pacingBucket)
+        # whether acks may ride on data, see handshake
+        self.piggyback = False
         self.server = server
         self.seqLock = threading.Lock()
         self.ackLock = threading.Lock()
+        self.sendLock = threading.Lock()
         logger.debug('Create a server connection to %s' % str(addr))
 
+    # for app to use, the returned memoryview is valid until release_rcv_buffer
     def consume_rcv_buffer(self):
-        if self.recvWin.get_win() == 0:
-            headerDict = defaultHeaderDict.copy()
-            headerDict.update({
-                Sec.sPort: self.conn.port,
-                Sec.dPort: self.destPort,
-                Sec.ackNum: 0,
-                Sec.seqNum: self.seqNum,
-                Sec.ACK: 1,
-                Sec.SYN: 0,
-                Sec.recvWin: 1
-            })
-            headerData = dict_to_header(headerDict)
-            fill_checksum(headerData, bytearray())
-            win_msg = message(headerData, self.conn)
-            win_msg.send((self.destIP, self.destPort))
         data = self.recvWin.pop()
         return data
 
+    # for app to use, hands back the data got from consume_rcv_buffer
+    def release_rcv_buffer(self):
+        full = self.recvWin.get_win() == 0
+        self.recvWin.release()
+        if full:
+            # the window opened again
+            self.ack_message()
+
     # for app to use
     def append_snd_buffer(self, data: bytearray):
-        full = self.sendWin.add(data)
+        return self.appended(self.sendWin.add(data))
+
+    # for app to use, reads length bytes of the file fd from position into
+    # the sending buffer after prefix, with no copy in between. Returns
+    # the bytes read (fewer when the file ended early, then nothing was
+    # added) or None when the buffer is full.
+    def append_snd_file(self, fd, position, length, prefix=b''):
+        count = self.sendWin.add_file(fd, position, length, prefix)
+        if not self.appended(count is None):
+            return None
+        return count
+
+    # Sends what was added to the sending buffer, full tells that it did not fit
+    def appended(self, full):
         if full:
             if self.sendWin.lastByteAcked == self.sendWin.lastByteSent:
                 self.check_cong_and_send()
             return False
-        if self.sendWin.get_cwnd() == 0:  #first file trunk
-            self.sendWin.set_cwnd(1)
-            self.sendWin.set_win(1)
-            self.sendWin.ssthresh = 10
-            self.sendWin.state = CwndState.SLOWSTART
+        if self.sendWin.state == CwndState.SHAKING:  # first file trunk
+            self.sendWin.start()
             self.check_cong_and_send()
+        elif self.sendWin.can_send():
+            # the window drained before this data was added
+            self.check_cong_and_send(False)
         return True
 
-    def check_cong_and_send(self):
-        datalist = self.sendWin.get_data()
-        if not datalist:
-            self.app.notify_next_move((self.destIP, self.destPort))
-            return
-        if datalist[0] == 1:
-            return
-        for data in datalist:
-            self.send_msg(data)
-        self.app.notify_next_move((self.destIP, self.destPort))
+    # notify is False when called by the app itself
+    def check_cong_and_send(self, notify=True):
+        # Both the ack handler and the app may get here, the window
+        # must be read and sent by one of them at a time
+        self.sendLock.acquire()
+        try:
+            datalist = self.sendWin.get_data()
+            if datalist:
+                # the rest goes when the pacer wakes
+                self.pace()
+                datalist = datalist[:self.pacer.admit(datalist)]
+            if not datalist:
+                if notify:
+                    self.engine.notify_next_move(self.app, (self.destIP, self.destPort))
+                return
+            batch = []
+            for data in datalist:
+                self.send_msg(data, True, batch)
+            self.send_batch(batch)
+        finally:
+            self.sendLock.release()
+        if notify:
+            self.engine.notify_next_move(self.app, (self.destIP, self.destPort))
+
+    # Sets the pacer to the window's pacing rate
+    def pace(self):
+        rate = self.sendWin.pacing_rate(self.rtt.get_rtt()) if self.pacing else None
+        self.pacer.set_rate(rate, self.segSize)
+
+    # Smoothed round trip time in seconds, None before the first sample
+    def get_rtt(self):
+        return self.rtt.get_rtt()
+
+    # Current retransmission timeout in seconds
+    def get_rto(self):
+        return self.rtt.get_rto()
+
+    # Congestion window and loss recovery counters of the sending side,
+    # e.g. how many losses were repaired without a timeout
+    def get_send_stats(self):
+        return self.sendWin.stats()
 
     def update_state(self, newState):
         logger.debug("State: %s->%s" % (self.state, newState))
         self.state = newState
 
-    def handshake(self):
+    # peerOptions are the options of the client's SYN (see get_options),
+    # peerWin the window in bytes it advertised
+    def handshake(self, peerOptions=None, peerWin=0):
+        peerOptions = peerOptions or {}
         # random seq
         self.seqNum = random.randint(1, 2 ** 16)
-        headerDict = defaultHeaderDict.copy()
-        headerDict.update({
-            Sec.sPort: self.conn.port,
-            Sec.dPort: self.destPort,
-            Sec.seqNum: self.seqNum,
-            Sec.ackNum: self.clientSeq + 1,
-            Sec.SYN: 1,
-            Sec.ACK: 1
-        })
-        headerData = dict_to_header(headerDict)
+        localSegSize = local_segment_size(self.destIP, self.server.segSize)
+        self.segSize = min(localSegSize, peerOptions.get(OPTION_MSS) or PACKET_SIZE)
+        self.recvWin.segSize = self.segSize
+        self.sendWin.segSize = self.segSize
+        localScale = window_scale(self.recvWin.size)
+        if OPTION_WSCALE in peerOptions:
+            # windows are scaled byte counts both ways, a client without
+            # the option keeps counting them in segments
+            self.recvWin.scale = localScale
+            self.sendWin.peerScale = peerOptions[OPTION_WSCALE]
+            options = pack_syn_options(localSegSize, localScale)
+        else:
+            options = pack_mss_option(localSegSize)
+        if OPTION_SACK_PERMITTED in peerOptions:
+            # a client offering SACK also takes data with the ACK flag, an
+            # older one would take it for a bare ack and drop the data
+            self.recvWin.sack = True
+            self.piggyback = True
+            self.sendWin.peerSack = True
+            options += pack_sack_permitted_option()
+        self.sendWin.set_win(max(peerWin, self.segSize))
+        logger.debug('Segment size %d negotiated with %s' % (self.segSize, str(self.addr)))
+        headerData = rUDPHeader(sPort=self.conn.port, dPort=self.destPort, seqNum=self.seqNum,
+                                ackNum=self.clientSeq + 1, SYN=1, ACK=1,
+                                offset=(defaultHeaderLen + len(options)) // 4,
+                                recvWin=self.recvWin.get_syn_win()).pack()
+        headerData += options
         fill_checksum(headerData, bytearray())
         logger.debug("Server Second handshake sent, seq: " + str(self.seqNum))
-        syn_msg = message(headerData, self.conn, self.sendWin)
-        syn_msg.send_with_timer(self.addr)
+        syn_msg = message(headerData, self.conn, self.sendWin, rtt=self.rtt)
         self.update_state(RecvStates.SYN_REVD)
         self.seqNum += 1
         self.clientSeq += 1
-        self.recvWin.baseSeq = self.clientSeq
+        # register before sending, the ack may be processed before send returns
         self.messages.add_msg(syn_msg, self.seqNum)
+        syn_msg.send_with_timer(self.addr)
 
     def response_FIN(self):
-        headerDict = defaultHeaderDict.copy()
-        headerDict.update({
-            Sec.sPort: self.conn.port,
-            Sec.dPort: self.destPort,
-            Sec.seqNum: self.seqNum,
-            Sec.ackNum: self.clientSeq,
-            Sec.SYN: 0,
-            Sec.ACK: 1,
-            Sec.FIN: 1
-        })
-        headerData = dict_to_header(headerDict)
+        headerData = rUDPHeader(sPort=self.conn.port, dPort=self.destPort, seqNum=self.seqNum,
+                                ackNum=self.clientSeq, SYN=0, ACK=1, FIN=1).pack()
         fill_checksum(headerData, bytearray())
         logger.debug("Server FIN message sent, seq: " + str(self.seqNum))
-        fin_msg = message(headerData, self.conn, self.sendWin)
+        fin_msg = message(headerData, self.conn, self.sendWin, rtt=self.rtt, seqNum=self.seqNum)
         fin_msg.send(self.addr)
         self.update_state(RecvStates.LAST_ACK)
         self.seqNum += 1
@@ -116,66 +177,76 @@ class serverConn:
         self.messages.add_msg(fin_msg, self.seqNum)
         
 
-    def process_data(self, data, headerDict: dict):
+    # hot is what get_hot_fields read from the header of data
+    def process_data(self, data, hot, slot: recvSlot=None):
         if not check_header_checksum(data):
             logger.debug('Header checksum check failed.')
             return
+        seqNum, ackNum, offset, flags, recvWin = hot
         self.ackLock.acquire()
         try:
-            if headerDict[Sec.ACK]:
-                mess = self.messages.get_mess(headerDict[Sec.ackNum])
+            seqNum = unwrap_seq(seqNum, self.clientSeq)
+            ackNum = unwrap_seq(ackNum, self.seqNum)
+            payload = data[offset * 4:]
+            if flags & FLAG_ACK:
+                sacked = 0
+                if offset > 5:
+                    sacked = self.process_sack(data, ackNum)
+                mess = self.messages.get_mess(ackNum)
                 if mess is not None:
-                    logger.debug('Received ack message with ackNum=%d' % headerDict[Sec.ackNum])
-                    self.messages.ack_to_num(headerDict[Sec.ackNum])
+                    logger.debug('Received ack message with ackNum=%d' % ackNum)
+                    self.rtt.ack(mess)
+                    self.messages.ack_to_num(ackNum)
                     if self.state == RecvStates.SYN_REVD:
                         self.update_state(RecvStates.ESTABLISHED)
-                    else:
-                        if self.sendWin.state != CwndState.SHAKING:
-                            if headerDict[Sec.recvWin] > 0:
-                                if headerDict[Sec.ackNum] > 0:
-                                    flag = self.sendWin.ack(mess)
-                                    self.sendWin.set_win(min(headerDict[Sec.recvWin], self.sendWin.get_cwnd()))
-                                    if flag is not False:
-                                        self.check_cong_and_send()
-                                    # if pausing is True:
-                                    #     self.app.notify_next_move((self.destIP, self.destPort))
-                                else:
-                                    self.check_cong_and_send()
-            else:
-                if len(data) - defaultHeaderLen != PACKET_SIZE:
+                    # The third handshake may arrive after data has been sent,
+                    # its ack then covers the buffered data as well
+                    if self.sendWin.state != CwndState.SHAKING:
+                        if ackNum > 0:
+                            flag = self.sendWin.ack(mess)
+                            # a closed window is not applied, what is sent next
+                            # probes it until the window update comes
+                            if recvWin > 0:
+                                self.sendWin.set_peer_win(recvWin)
+                            if flag is not False:
+                                self.fast_retransmit(self.sendWin.hole())
+                                self.check_cong_and_send()
+                        else:
+                            self.check_cong_and_send()
+                elif ackNum > 0 and len(payload) == 0:
+                    # acks nothing new, the client may be missing a segment
+                    self.fast_retransmit(self.sendWin.dup_ack(ackNum, recvWin, sacked))
+                    if self.sendWin.can_send():
+                        # or it opened its window
+                        self.check_cong_and_send()
+            # data may come with an ack
+            if not flags & FLAG_ACK or len(payload) > 0:
+                if len(payload) == 0 or len(payload) > self.segSize:
                     logger.debug('Received data with invalid length, discarded')
                     return
                 # Normal data message
-                if headerDict[Sec.seqNum] == self.clientSeq:
-                    if self.recvWin.get_win() > 0:
-                        logger.debug('add data with seq %d to receiving window' % headerDict[Sec.seqNum])
-                        flag = self.recvWin.add(data[defaultHeaderLen:])
-                        if flag:
-                            self.clientSeq += PACKET_SIZE
+                if seqNum == self.clientSeq:
+                    if self.recvWin.get_win() > 0 and self.recvWin.add(payload, slot):
+                        logger.debug('add data with seq %d to receiving window' % seqNum)
+                        # the segments received out of order may follow it
+                        self.clientSeq, pulled = self.recvWin.pull(self.clientSeq + len(payload))
+                        # filling a hole or closing the window is acked at once
+                        if pulled > 0 or self.recvWin.get_win() == 0 or self.acks.segment():
                             self.ack_message()
-                        self.app.notify_process_data((self.destIP, self.destPort))
-
-                    if self.recvWin.get_win() == 0:
+                        for i in range(pulled + 1):
+                            self.engine.notify_process_data(self.app, (self.destIP, self.destPort))
+                    else:
                         logger.debug('rcvWindow full')
-                        headerDict = defaultHeaderDict.copy()
-                        headerDict.update({
-                            Sec.sPort: self.conn.port,
-                            Sec.dPort: self.destPort,
-                            Sec.seqNum: self.seqNum,
-                            Sec.ackNum: 0,
-                            Sec.ACK: 1,
-                            Sec.SYN: 0,
-                            Sec.recvWin: self.recvWin.get_win()
-                        })
-                        headerData = dict_to_header(headerDict)
-                        fill_checksum(headerData, bytearray())
-                        win_msg = message(headerData, self.conn)
-                        win_msg.send((self.destIP, self.destPort))
-                elif headerDict[Sec.seqNum] <= self.clientSeq:
+                        self.ack_message()
+                elif seqNum < self.clientSeq:
                     self.ack_message()
                 else:
-                    logger.debug('Discarded packet %d not arrived in order, Expecting: %d' % (headerDict[Sec.seqNum], self.clientSeq))
-            if headerDict[Sec.FIN] and self.state == RecvStates.ESTABLISHED:
+                    # kept until the hole before it is filled, the ack
+                    # reports it in a SACK block
+                    if not self.recvWin.add_out_of_order(seqNum, self.clientSeq, payload, slot):
+                        logger.debug('Discarded packet %d beyond the window, Expecting: %d' % (seqNum, self.clientSeq))
+                    self.ack_message()
+            if flags & FLAG_FIN and self.state == RecvStates.ESTABLISHED:
                 self.update_state(RecvStates.CLOSE_WAIT)
                 # Client closing connection
                 self.response_FIN()
@@ -184,47 +255,67 @@ class serverConn:
         finally:
             self.ackLock.release()
 
-    def send_msg(self, data):
+    # fromBuffer tells that data is the next unsent segment of sendWin,
+    # with a batch list the message is put in it for send_batch to send
+    def send_msg(self, data, fromBuffer=False, batch=None):
         self.seqLock.acquire()
         try:
-            headerDict = defaultHeaderDict.copy()
-            headerDict.update({
-                Sec.sPort: self.conn.port,
-                Sec.dPort: self.destPort,
-                Sec.seqNum: self.seqNum,
-                Sec.ackNum: self.clientSeq,
-                Sec.SYN: 0,
-                Sec.ACK: 0,
-                Sec.FIN: 0,
-                Sec.recvWin: self.recvWin.get_win()
-            })
-            headerData = dict_to_header(headerDict)
+            # the delayed ack rides on the data
+            piggyback = self.piggyback and self.acks.take()
+            headerData = rUDPHeader(sPort=self.conn.port, dPort=self.destPort, seqNum=self.seqNum,
+                                    ackNum=self.clientSeq, SYN=0, ACK=piggyback, FIN=0,
+                                    recvWin=self.recvWin.get_win()).pack()
             fill_checksum(headerData, data)
             logger.debug("data message sent, seq: " + str(self.seqNum))
-            data_msg = message(headerData + data, self.conn, self.sendWin)
-            data_msg.send_with_timer(self.addr)
+            data_msg = message(headerData, self.conn, self.sendWin, data, self.rtt, self.seqNum)
             self.seqNum += len(data)
             self.messages.add_msg(data_msg, self.seqNum)
-            if self.sendWin.state != CwndState.SHAKING:
+            if fromBuffer:
                 self.sendWin.send(data_msg)
+            if batch is not None:
+                batch.append(data_msg)
+            else:
+                data_msg.send_with_timer(self.addr)
+                self.server.count('bytesOut', len(data))
         finally:
             self.seqLock.release()
 
+    # Sends the messages collected by send_msg with as few syscalls as the
+    # socket allows, then starts their timers
+    def send_batch(self, batch):
+        self.conn.send_batch([mess.parts() for mess in batch], self.addr)
+        self.server.count('bytesOut', sum(len(mess.payload) for mess in batch))
+        for mess in batch:
+            mess.send_with_timer(self.addr, True)
+
+
+    # mess is the oldest segment in flight once taken as lost, it is sent
+    # again without waiting for its timer
+    def fast_retransmit(self, mess):
+        if mess is not None:
+            mess.retransmit(self.addr)
+
+    # The client received the messages in the SACK blocks of the ack, only
+    # the holes between them are left to retransmit. Returns how many
+    # messages they reported first
+    def process_sack(self, data, ackNum):
+        header = rUDPHeader.unpack(data)
+        header.ackNum = ackNum
+        sacked = self.messages.sack(get_sack_blocks(data, header))
+        if sacked:
+            self.sendWin.sack(sacked)
+            self.check_cong_and_send(False)
+        return len(sacked)
 
-    # Send the ack message to client
+    # Send the ack message to client, along with the delayed ones
     def ack_message(self):
-        headerDict = defaultHeaderDict.copy()
-        headerDict.update({
-            Sec.sPort: self.conn.port,
-            Sec.dPort: self.destPort,
-            Sec.seqNum: self.seqNum,
-            Sec.ackNum: self.clientSeq,
-            Sec.SYN: 0,
-            Sec.ACK: 1,
-            Sec.FIN: 1,
-            Sec.recvWin: self.recvWin.get_win()
-        })
-        headerData = dict_to_header(headerDict)
+        self.acks.take()
+        options = pack_sack_option(self.recvWin.sack_blocks())
+        headerData = rUDPHeader(sPort=self.conn.port, dPort=self.destPort, seqNum=self.seqNum,
+                                ackNum=self.clientSeq, SYN=0, ACK=1, FIN=1,
+                                offset=(defaultHeaderLen + len(options)) // 4,
+                                recvWin=self.recvWin.get_win()).pack()
+        headerData += options
         fill_checksum(headerData, bytearray())
         logger.debug("sent ack message, ackNum: " + str(self.clientSeq))
         ack_msg = message(headerData, self.conn)
@@ -232,38 +323,107 @@ class serverConn:
 
 
     def removeSelf(self):
+        self.recvWin.discard_out_of_order()
         self.server.removeConn(self.addr)
 
 
 class rUDPServer:
-    def __init__(self, ip, port, app):
-        self.conn = rUDPConnection(ip, port)
+    # segSize is the largest segment size offered to clients, by default
+    # the one that fits the MTU of the route to each of them
+    # engine is 'thread' or 'asyncio', see engine.py
+    # reusePort lets server processes share the port, metrics is the
+    # workerMetrics the counters of this one go to (see metrics.py)
+    # bufferSize is the size of each connection's sending and receiving buffers
+    # congestion names their congestion controller, see congestion.py
+    # ackEvery in-order segments are acked together, or ackDelay seconds
+    # after the first of them
+    # pacing spreads each connection's window over its round trip, rate
+    # caps every connection and totalRate all of them (bytes per second)
+    def __init__(self, ip, port, app, segSize=None, offload=True, engine='thread', reusePort=False,
+                 metrics=None, bufferSize=None, congestion='reno', ackEvery=ACK_EVERY,
+                 ackDelay=DELAYED_ACK_TIMEOUT, pacing=True, rate=None, totalRate=None):
+        # an unknown controller fails here instead of on the first connection
+        new_controller(congestion)
+        self.engine = new_engine(engine)
+        self.conn = rUDPConnection(ip, port, offload, self.engine, reusePort)
+        self.metrics = metrics
         # The server will identify each connection with
         # a tuple of clients' address and port
         self.connections = {}
         self.app = app
-        self.listener = threading.Thread(target=self.recv_msg, daemon=True)
+        self.segSize = segSize
+        self.bufferSize = buffer_size(bufferSize)
+        self.congestion = congestion
+        self.ackEvery = ackEvery
+        self.ackDelay = ackDelay
+        self.pacing = pacing
+        self.rate = rate
+        self.pacingBucket = tokenBucket(totalRate) if totalRate is not None else None
+        self.conn.set_buffer_size(self.bufferSize)
+        self.ring = None
+        if self.engine.name == 'asyncio':
+            self.listener = threading.Thread(target=self.engine.run, args=[self.conn, self.process_datagram],
+                                             daemon=True)
+        else:
+            self.ring = new_recv_ring(self.bufferSize, segSize, self.conn.gro)
+            self.listener = threading.Thread(target=self.recv_msg, daemon=True)
         self.listener.start()
         # Infinite listen loop
 
     def recv_msg(self):
         while True:
-            data, addr = self.conn.socket.recvfrom(6144)
-            recv_thread = threading.Thread(target=self.process_recv_msg, args=[data, addr], daemon=True)
-            recv_thread.start()
+            slot, addr = self.ring.recv_into(self.conn)
+            self.engine.dispatch(addr, self.process_recv_msg, slot, addr)
+
+    def process_recv_msg(self, slot: recvSlot, addr):
+        try:
+            for data in slot.datagrams():
+                self.process_datagram(data, addr, slot)
+        finally:
+            slot.release()
 
-    def process_recv_msg(self, data, addr):
-        headerDict = header_to_dict(data)
-        if headerDict[Sec.SYN] and not headerDict[Sec.ACK]:
+    # slot is None with the asyncio engine
+    def process_datagram(self, data, addr, slot: recvSlot=None):
+        if self.metrics is not None:
+            self.metrics.add('datagramsIn')
+            self.metrics.add('bytesIn', len(data))
+        hot = get_hot_fields(data)
+        flags = hot[3]
+        if flags & FLAG_SYN and not flags & FLAG_ACK:
+            # only the handshake needs the whole header and its options
+            header = rUDPHeader.unpack(data)
             # First handshake
-            self.connections[addr] = serverConn(addr, self.conn, self.app, self)
-            self.connections[addr].clientSeq = headerDict[Sec.seqNum]
-            self.connections[addr].handshake()
+            newConn = serverConn(addr, self.conn, self.app, self)
+            # Hold the connection until the handshake is done so that
+            # early data waits instead of being discarded
+            newConn.ackLock.acquire()
+            try:
+                if addr not in self.connections:
+                    self.count('accepted')
+                    self.count('connections')
+                self.connections[addr] = newConn
+                newConn.clientSeq = header.seqNum
+                newConn.handshake(get_options(data, header), header.recvWin)
+            finally:
+                newConn.ackLock.release()
         else:
             if addr in self.connections:
-                self.connections[addr].process_data(data, headerDict)
+                self.connections[addr].process_data(data, hot, slot)
             else:
                 logger.debug('Received message from unexpected sender')
 
+    # Depth counters of the queues feeding the connections, one dict per worker
+    def get_queue_stats(self):
+        return self.engine.stats()
+
+    # Slots and fallbacks of the receive ring, None with the asyncio engine
+    def get_ring_stats(self):
+        return self.ring.stats() if self.ring is not None else None
+
     def removeConn(self, addr):
         self.connections.pop(addr)
+        self.count('connections', -1)
+
+    def count(self, field, n=1):
+        if self.metrics is not None:
+            self.metrics.add(field, n)
@@ -0,0 +1,172 @@
+import threading
+import time
+from .lftplog import logger
+
+# One hierarchical timer wheel per process drives every retransmission and
+# TIME_WAIT timeout from a single thread, instead of a threading.Timer
+# (an OS thread) per timeout.
+#
+# Level 0 has a slot per tick, each next level a slot per full turn of the
+# level below. A timer is put in the lowest level its delay fits in and
+# moves down a level (cascades) when the level below reaches its slot.
+
+TIMER_TICK = 0.01
+WHEEL_BITS = 6
+WHEEL_SLOTS = 1 << WHEEL_BITS
+WHEEL_MASK = WHEEL_SLOTS - 1
+WHEEL_LEVELS = 4
+# about 46 hours with 10 ms ticks, longer delays are cut down to it
+MAX_TIMER_TICKS = (1 << (WHEEL_BITS * WHEEL_LEVELS)) - 1
+
+
+class timerHandle:
+    __slots__ = ('wheel', 'expires', 'serial', 'callback', 'args', 'bucket')
+
+    def __init__(self, wheel, expires, serial, callback, args):
+        self.wheel = wheel
+        self.expires = expires
+        # order of scheduling, timers due together fire in this order
+        self.serial = serial
+        self.callback = callback
+        self.args = args
+        # the slot holding the timer, None once it fired or was cancelled
+        self.bucket = None
+
+    def cancel(self):
+        self.wheel.cancel(self)
+
+    def pending(self):
+        return self.bucket is not None
+
+
+class timerWheel:
+    def __init__(self, tick=TIMER_TICK):
+        self.tick = tick
+        # the slots are dicts used as insertion ordered sets
+        self.levels = [[{} for i in range(WHEEL_SLOTS)] for level in range(WHEEL_LEVELS)]
+        self.start = time.monotonic()
+        # ticks processed so far
+        self.current = 0
+        self.count = 0
+        self.serial = 0
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.thread = None
+
+    def __len__(self):
+        return self.count
+
+    def now(self):
+        return int((time.monotonic() - self.start) / self.tick)
+
+    # Runs callback(*args) on the wheel's thread after delay seconds
+    def schedule(self, delay, callback, *args):
+        ticks = min(max(1, int(delay / self.tick + 0.999999)), MAX_TIMER_TICKS)
+        self.lock.acquire()
+        try:
+            if self.count == 0:
+                # nothing is waiting, skip the idle ticks instead of walking them
+                self.current = self.now()
+            self.serial += 1
+            # counted from the time now, the wheel may lag behind it, yet
+            # after the tick it processed last
+            expires = min(max(self.now() + ticks, self.current + 1), self.current + MAX_TIMER_TICKS)
+            handle = timerHandle(self, expires, self.serial, callback, args)
+            self.place(handle)
+            self.count += 1
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
+            if self.count == 1:
+                # the thread only sleeps without a timer, otherwise it wakes every tick
+                self.cond.notify()
+            return handle
+        finally:
+            self.lock.release()
+
+    # O(1), the timer is taken out of its slot
+    def cancel(self, handle: timerHandle):
+        self.lock.acquire()
+        try:
+            if handle.bucket is not None:
+                del handle.bucket[handle]
+                handle.bucket = None
+                self.count -= 1
+        finally:
+            self.lock.release()
+
+    # Called with the lock held
+    def place(self, handle: timerHandle):
+        diff = handle.expires - self.current
+        level = 0
+        while level < WHEEL_LEVELS - 1 and diff >= 1 << (WHEEL_BITS * (level + 1)):
+            level += 1
+        bucket = self.levels[level][(handle.expires >> (WHEEL_BITS * level)) & WHEEL_MASK]
+        bucket[handle] = None
+        handle.bucket = bucket
+
+    # Called with the lock held, returns the timers expired up to tick target
+    def advance(self, target):
+        expired = []
+        while self.current < target and self.count > 0:
+            self.current += 1
+            # move the slots reached by the upper levels down, highest first
+            # so what they drop into a lower slot reached now cascades as well
+            for level in range(WHEEL_LEVELS - 1, 0, -1):
+                if self.current & ((1 << (WHEEL_BITS * level)) - 1) == 0:
+                    index = (self.current >> (WHEEL_BITS * level)) & WHEEL_MASK
+                    bucket = self.levels[level][index]
+                    self.levels[level][index] = {}
+                    for handle in bucket:
+                        self.place(handle)
+            index = self.current & WHEEL_MASK
+            bucket = self.levels[0][index]
+            if bucket:
+                self.levels[0][index] = {}
+                for handle in bucket:
+                    handle.bucket = None
+                self.count -= len(bucket)
+                expired.extend(bucket)
+        if self.count == 0:
+            self.current = target
+        # e.g. retransmissions go out in the order the segments were sent
+        expired.sort(key=lambda handle: (handle.expires, handle.serial))
+        return expired
+
+    def run(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while self.count == 0:
+                    self.cond.wait()
+                target = self.now()
+                if target <= self.current:
+                    self.cond.wait(self.start + (self.current + 1) * self.tick - time.monotonic())
+                    continue
+                expired = self.advance(target)
+            finally:
+                self.cond.release()
+            # every timer due by now is run in one batch, outside the lock
+            # so that callbacks can schedule again
+            for handle in expired:
+                try:
+                    handle.callback(*handle.args)
+                except Exception as e:
+                    logger.exception('Timer callback %s failed: %s' % (handle.callback, e))
+
+
+_wheel = None
+_wheelLock = threading.Lock()
+
+
+# The wheel shared by every connection of the process
+def get_timer_wheel():
+    global _wheel
+    if _wheel is None:
+        _wheelLock.acquire()
+        try:
+            if _wheel is None:
+                _wheel = timerWheel()
+        finally:
+            _wheelLock.release()
+    return _wheel
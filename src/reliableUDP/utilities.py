@@ -1,7 +1,13 @@
 from enum import Enum
+from collections import deque
+import os
+import struct
 import threading
-from .connection import rUDPConnection
+import time
+from .connection import rUDPConnection, path_mtu
 from .lftplog import logger
+from . import checksum as checksum_engine
+from .congestion import CwndState, new_controller
 
 # noinspection PyArgumentList
 RecvStates = Enum('RecvStates', ('CLOSED', 'LISTEN', 'SYN_REVD',
@@ -11,8 +17,6 @@ RecvStates = Enum('RecvStates', ('CLOSED', 'LISTEN', 'SYN_REVD',
 SendStates = Enum('SendStates', ('CLOSED', 'SYN_SENT', 'ESTABLISHED',
                                  'FIN_WAIT_1', 'FIN_WAIT_2', 'TIME_WAIT'))
 
-CwndState = Enum('CwndState', ('SLOWSTART', 'CONGAVOID', 'SHAKING'))
-
 # The sections in TCP header
 # noinspection PyArgumentList
 Sec = Enum('headerStruct', ('sPort', 'dPort', 'seqNum', 'ackNum',
@@ -42,26 +46,141 @@ defaultHeaderDict = {
 defaultHeaderLen = 20
 
 
+# sPort, dPort, seqNum, ackNum, offset(4 bits)|NS, flags, recvWin, checksum, urgPtr
+headerStruct = struct.Struct('!HHIIBBHHH')
+# seqNum, ackNum, offset|NS, flags and recvWin, the fields read for every datagram
+hotFieldsStruct = struct.Struct('!4xIIBBH')
+
+# Sequence numbers are byte counts of any size, headers and SACK blocks
+# carry their low 32 bits. A received one is taken as the number with those
+# bits nearest to what the receiver expects (RFC 1982), so a transfer may go
+# past 4 GiB as long as less than 2 GiB of it is in flight.
+SEQ_BITS = 32
+SEQ_MASK = (1 << SEQ_BITS) - 1
+SEQ_HALF = 1 << (SEQ_BITS - 1)
+
+
+# The full sequence number whose low bits are seqNum, nearest to reference
+def unwrap_seq(seqNum, reference):
+    return reference + ((seqNum - reference + SEQ_HALF) & SEQ_MASK) - SEQ_HALF
+
+# Bits of the flags byte
+FLAG_CWR = 0x80
+FLAG_ECE = 0x40
+FLAG_URG = 0x20
+FLAG_ACK = 0x10
+FLAG_PSH = 0x08
+FLAG_RST = 0x04
+FLAG_SYN = 0x02
+FLAG_FIN = 0x01
+
+
+def _flag_property(bit):
+    def getter(self):
+        return bool(self.flags & bit)
+
+    def setter(self, value):
+        if value:
+            self.flags |= bit
+        else:
+            self.flags &= ~bit
+    return property(getter, setter)
+
+
+class rUDPHeader:
+    __slots__ = ('sPort', 'dPort', 'seqNum', 'ackNum', 'offset', 'NS',
+                 'flags', 'recvWin', 'checksum', 'urgPtr')
+
+    def __init__(self, sPort=0, dPort=0, seqNum=0, ackNum=0, ACK=False, SYN=False,
+                 FIN=False, recvWin=0, flags=0, offset=5, NS=False, checksum=0, urgPtr=0):
+        self.sPort = sPort
+        self.dPort = dPort
+        self.seqNum = seqNum
+        self.ackNum = ackNum
+        self.offset = offset
+        self.NS = NS
+        self.flags = flags | (FLAG_ACK if ACK else 0) | (FLAG_SYN if SYN else 0) | (FLAG_FIN if FIN else 0)
+        self.recvWin = recvWin
+        self.checksum = checksum
+        self.urgPtr = urgPtr
+
+    CWR = _flag_property(FLAG_CWR)
+    ECE = _flag_property(FLAG_ECE)
+    URG = _flag_property(FLAG_URG)
+    ACK = _flag_property(FLAG_ACK)
+    PSH = _flag_property(FLAG_PSH)
+    RST = _flag_property(FLAG_RST)
+    SYN = _flag_property(FLAG_SYN)
+    FIN = _flag_property(FLAG_FIN)
+
+    def pack_into(self, buffer, offset=0):
+        headerStruct.pack_into(buffer, offset, self.sPort, self.dPort, self.seqNum & SEQ_MASK,
+                               self.ackNum & SEQ_MASK,
+                               (self.offset << 4) | self.NS, self.flags, self.recvWin,
+                               self.checksum, self.urgPtr)
+
+    def pack(self):
+        result = bytearray(defaultHeaderLen)
+        self.pack_into(result)
+        return result
+
+    @classmethod
+    def unpack(cls, headerData, offset=0):
+        (sPort, dPort, seqNum, ackNum, offNS, flags,
+         recvWin, checksum, urgPtr) = headerStruct.unpack_from(headerData, offset)
+        return cls(sPort, dPort, seqNum, ackNum, flags=flags, recvWin=recvWin,
+                   offset=offNS >> 4, NS=bool(offNS & 0x01), checksum=checksum, urgPtr=urgPtr)
+
+    # Turns the seqNum and ackNum of a received header into full sequence
+    # numbers, expected is the next seq of the peer and sent the next one
+    # of the receiver
+    def unwrap(self, expected, sent):
+        self.seqNum = unwrap_seq(self.seqNum, expected)
+        self.ackNum = unwrap_seq(self.ackNum, sent)
+
+    def to_dict(self):
+        return {
+            Sec.sPort: self.sPort,
+            Sec.dPort: self.dPort,
+            Sec.seqNum: self.seqNum,
+            Sec.ackNum: self.ackNum,
+            Sec.offset: self.offset,
+            Sec.NS: bool(self.NS),
+            Sec.CWR: self.CWR,
+            Sec.ECE: self.ECE,
+            Sec.URG: self.URG,
+            Sec.ACK: self.ACK,
+            Sec.PSH: self.PSH,
+            Sec.RST: self.RST,
+            Sec.SYN: self.SYN,
+            Sec.FIN: self.FIN,
+            Sec.recvWin: self.recvWin,
+            Sec.checksum: self.checksum,
+            Sec.urgPtr: self.urgPtr
+        }
+
+    @classmethod
+    def from_dict(cls, headerDict: dict):
+        flags = (headerDict[Sec.CWR] << 7 | headerDict[Sec.ECE] << 6 |
+                 headerDict[Sec.URG] << 5 | headerDict[Sec.ACK] << 4 |
+                 headerDict[Sec.PSH] << 3 | headerDict[Sec.RST] << 2 |
+                 headerDict[Sec.SYN] << 1 | headerDict[Sec.FIN])
+        return cls(headerDict[Sec.sPort], headerDict[Sec.dPort], headerDict[Sec.seqNum],
+                   headerDict[Sec.ackNum], flags=flags, recvWin=headerDict[Sec.recvWin],
+                   offset=headerDict[Sec.offset], NS=headerDict[Sec.NS],
+                   checksum=headerDict[Sec.checksum], urgPtr=headerDict[Sec.urgPtr])
+
+
+# Returns (seqNum, ackNum, offset, flags, recvWin) without decoding the whole
+# header, the receive path unpacks it only for segments with options
+def get_hot_fields(header: bytearray):
+    seqNum, ackNum, offNS, flags, recvWin = hotFieldsStruct.unpack_from(header)
+    return seqNum, ackNum, offNS >> 4, flags, recvWin
+
+
+# Kept for compatibility, use rUDPHeader.unpack instead
 def header_to_dict(headerData: bytearray):
-    result = dict()
-    result[Sec.sPort] = int.from_bytes(headerData[0:2], byteorder='big', signed=False)
-    result[Sec.dPort] = int.from_bytes(headerData[2:4], byteorder='big', signed=False)
-    result[Sec.seqNum] = int.from_bytes(headerData[4:8], byteorder='big', signed=False)
-    result[Sec.ackNum] = int.from_bytes(headerData[8:12], byteorder='big', signed=False)
-    result[Sec.offset] = int.from_bytes([headerData[12] & 0xf0], byteorder='big', signed=False)
-    result[Sec.NS] = bool(headerData[12] & 0x01)
-    result[Sec.CWR] = bool(headerData[13] & 0x80)
-    result[Sec.ECE] = bool(headerData[13] & 0x40)
-    result[Sec.URG] = bool(headerData[13] & 0x20)
-    result[Sec.ACK] = bool(headerData[13] & 0x10)
-    result[Sec.PSH] = bool(headerData[13] & 0x08)
-    result[Sec.RST] = bool(headerData[13] & 0x04)
-    result[Sec.SYN] = bool(headerData[13] & 0x02)
-    result[Sec.FIN] = bool(headerData[13] & 0x01)
-    result[Sec.recvWin] = int.from_bytes(headerData[14:16], byteorder='big', signed=False)
-    result[Sec.checksum] = int.from_bytes(headerData[16:18], byteorder='big', signed=False)
-    result[Sec.urgPtr] = int.from_bytes(headerData[18:20], byteorder='big', signed=False)
-    return result
+    return rUDPHeader.unpack(headerData).to_dict()
 
 
 def add_int_to_bytearray(array: bytearray, ele: int, length: int):
@@ -69,21 +188,9 @@ def add_int_to_bytearray(array: bytearray, ele: int, length: int):
         array.append(byte)
 
 
+# Kept for compatibility, use rUDPHeader.pack instead
 def dict_to_header(headerDict: dict):
-    result = bytearray(20)
-    result[0:2] = int.to_bytes(headerDict[Sec.sPort], length=2, byteorder='big')
-    result[2:4] = int.to_bytes(headerDict[Sec.dPort], length=2, byteorder='big')
-    result[4:8] = int.to_bytes(headerDict[Sec.seqNum], length=4, byteorder='big')
-    result[8:12] = int.to_bytes(headerDict[Sec.ackNum], length=4, byteorder='big')
-    result[12] = ((headerDict[Sec.offset] << 4) | headerDict[Sec.NS])
-    result[13] = (headerDict[Sec.CWR] << 7 | headerDict[Sec.ECE] << 6 |
-                  headerDict[Sec.URG] << 5 | headerDict[Sec.ACK] << 4 |
-                  headerDict[Sec.PSH] << 3 | headerDict[Sec.RST] << 2 |
-                  headerDict[Sec.SYN] << 1 | headerDict[Sec.FIN])
-    result[14:16] = int.to_bytes(headerDict[Sec.recvWin], length=2, byteorder='big')
-    result[16:18] = int.to_bytes(headerDict[Sec.checksum], length=2, byteorder='big')
-    result[18:20] = int.to_bytes(headerDict[Sec.urgPtr], length=2, byteorder='big')
-    return result
+    return rUDPHeader.from_dict(headerDict).pack()
 
 
 def set_header_checksum(header: bytearray, checksum: bytearray):
@@ -96,281 +203,1134 @@ def ip_to_bytes(ip: str):
 
 # This function should be called before sending each rUDP segment,
 # its functionality is calculate and fill in the checksum in header
-# using 1's complement
+# using 1's complement, data can be any bytes-like object (e.g. a memoryview)
 def fill_checksum(header: bytearray, data: bytearray):
-    checksum = 0
-    header[16:18] = [0x00, 0x00]
-    for i in range(0, len(header), 2):
-        val = ~int.from_bytes(header[i:i+2], byteorder='big', signed=False) & 0x0000ffff
-        checksum = (val + checksum)
-        checksum = (((checksum & 0xffff0000) >> 16) + (checksum & 0x0000ffff))
-    for i in range(0, len(data), 2):
-        val = ~int.from_bytes(data[i:i+2], byteorder='big', signed=False) & 0x0000ffff
-        checksum = (val + checksum)
-        checksum = ((checksum & 0xffff0000) >> 16) + (checksum & 0x0000ffff)
-    if len(data) % 2 != 0:
-        pad = bytearray([data[-1], 0x00])
-        val = ~int.from_bytes(pad, byteorder='big', signed=False) & 0x0000ffff
-        checksum = (val + checksum)
-        checksum = ((checksum & 0xffff0000) >> 16) + (checksum & 0x0000ffff)
-    logger.debug('fill checksum: %d' % checksum)
-    set_header_checksum(header, bytearray(int.to_bytes(checksum, byteorder='big', length=2, signed=False)))
+    header[16:18] = b'\x00\x00'
+    checksum = checksum_engine.ones_complement_sum(header, data)
+    logger.debug('fill checksum: %d', checksum)
+    set_header_checksum(header, int.to_bytes(checksum, byteorder='big', length=2, signed=False))
 
 
 # Check the data using checksum from the header
 def check_header_checksum(data: bytearray):
-    checksum = 0
-    for i in range(0, len(data), 2):
-        val = ~int.from_bytes(data[i:i+2], byteorder='big', signed=False) & 0x0000ffff
-        checksum = (val + checksum)
-        checksum = ((checksum & 0xffff0000) >> 16) + (checksum & 0x0000ffff)
-    if len(data) % 2 != 0:
-        pad = bytearray([data[-1], 0x00])
-        val = ~int.from_bytes(pad, byteorder='big', signed=False) & 0x0000ffff
-        checksum = (val + checksum)
-        checksum = ((checksum & 0xffff0000) >> 16) + (checksum & 0x0000ffff)
+    checksum = checksum_engine.ones_complement_sum(b'', data)
     result = ((checksum & 0x0000ffff) == 0x0000ffff or checksum == 0)
     if not result:
         logger.debug("header checksum error. Received: %d" % checksum)
     return result
 
 
+_seqStruct = struct.Struct('!4xI')
+_ackStruct = struct.Struct('!8xI')
+
+
 def get_seq_num(header: bytearray):
-    return int.from_bytes(header[4:8], byteorder='big', signed=False)
+    return _seqStruct.unpack_from(header)[0]
 
 
 def get_ack_num(header: bytearray):
-    return int.from_bytes(header[8:12], byteorder='big', signed=False)
+    return _ackStruct.unpack_from(header)[0]
 
 
 
 
-MAX_BUFFER_SIZE = 256000
-# Each data packet should be of size 1k
+# Size of the sending and receiving buffers of a connection unless given
+# another, the receiving one is the largest window advertised to the peer
+DEFAULT_BUFFER_SIZE = 4 * 1024 * 1024
+# A buffer takes at least two full segments, at most what a scaled
+# window can advertise
+MIN_BUFFER_SIZE = 32768
+MAX_BUFFER_SIZE = 0xffff << 14
+# The segment size assumed for a peer that does not offer one in its SYN
 PACKET_SIZE = 5120
+# Bounds of the negotiated segment size (the largest payload a segment
+# may carry), the upper one is what loopback ends up with
+MIN_SEGMENT_SIZE = 536
+MAX_SEGMENT_SIZE = 16384
+# MTU assumed when the route's one cannot be read, and the IPv4 and UDP
+# headers taken out of it
+DEFAULT_MTU = 1500
+IP_UDP_OVERHEAD = 28
+
+# TCP style options sent with SYN and SYN-ACK: MSS (kind, length, segment
+# size), window scale (kind, length, shift) padded with a NOP and SACK
+# permitted (kind, length) padded with two. Acks carry the SACK option,
+# (kind, length) then the (left, right) edges of each block received
+# beyond the acked byte (RFC 2018).
+OPTION_END = 0
+OPTION_NOP = 1
+OPTION_MSS = 2
+OPTION_WSCALE = 3
+OPTION_SACK_PERMITTED = 4
+OPTION_SACK = 5
+mssOptionStruct = struct.Struct('!BBH')
+wscaleOptionStruct = struct.Struct('!BBB')
+sackBlockStruct = struct.Struct('!II')
+MAX_WINDOW_SCALE = 14
+# blocks of a SACK option, 36 bytes with its padding
+MAX_SACK_BLOCKS = 4
+
+
+def pack_mss_option(segSize):
+    return mssOptionStruct.pack(OPTION_MSS, mssOptionStruct.size, segSize)
+
+
+def pack_wscale_option(shift):
+    return bytes([OPTION_NOP]) + wscaleOptionStruct.pack(OPTION_WSCALE, wscaleOptionStruct.size, shift)
+
+
+# The options of a SYN or SYN-ACK, 8 bytes so the header stays 4 byte aligned
+def pack_syn_options(segSize, shift):
+    return pack_mss_option(segSize) + pack_wscale_option(shift)
+
+
+def pack_sack_permitted_option():
+    return bytes([OPTION_NOP, OPTION_NOP, OPTION_SACK_PERMITTED, 2])
+
+
+# blocks are (left, right) byte ranges, no option without any
+def pack_sack_option(blocks):
+    if not blocks:
+        return b''
+    result = bytearray([OPTION_NOP, OPTION_NOP, OPTION_SACK, 2 + sackBlockStruct.size * len(blocks)])
+    for left, right in blocks:
+        result += sackBlockStruct.pack(left & SEQ_MASK, right & SEQ_MASK)
+    return result
+
 
-# 512kb receive window, store with a array
+# Returns {kind: value} of the MSS, window scale, SACK permitted (True)
+# and SACK (a list of (left, right)) options in the header
+def get_options(data, header: rUDPHeader):
+    options = {}
+    i = defaultHeaderLen
+    end = min(header.offset * 4, len(data))
+    while i < end:
+        kind = data[i]
+        if kind == OPTION_END:
+            break
+        if kind == OPTION_NOP:
+            i += 1
+            continue
+        if i + 1 >= end or data[i + 1] < 2:
+            break
+        if kind == OPTION_MSS and data[i + 1] == mssOptionStruct.size and i + mssOptionStruct.size <= end:
+            options[OPTION_MSS] = mssOptionStruct.unpack_from(data, i)[2]
+        elif kind == OPTION_WSCALE and data[i + 1] == wscaleOptionStruct.size and \
+                i + wscaleOptionStruct.size <= end:
+            options[OPTION_WSCALE] = min(wscaleOptionStruct.unpack_from(data, i)[2], MAX_WINDOW_SCALE)
+        elif kind == OPTION_SACK_PERMITTED and data[i + 1] == 2:
+            options[OPTION_SACK_PERMITTED] = True
+        elif kind == OPTION_SACK and i + data[i + 1] <= end:
+            options[OPTION_SACK] = [sackBlockStruct.unpack_from(data, j)
+                                    for j in range(i + 2, i + data[i + 1] - sackBlockStruct.size + 1,
+                                                   sackBlockStruct.size)]
+        i += data[i + 1]
+    return options
+
+
+# The SACK blocks of an ack, most acks carry no option at all. Their edges
+# are unwrapped next to the ackNum of the header, unwrapped before.
+def get_sack_blocks(data, header: rUDPHeader):
+    if header.offset * 4 <= defaultHeaderLen:
+        return []
+    return [(unwrap_seq(left, header.ackNum), unwrap_seq(right, header.ackNum))
+            for left, right in get_options(data, header).get(OPTION_SACK, [])]
+
+
+# Returns the segment size offered in the options of the header, None without one
+def get_mss_option(data, header: rUDPHeader):
+    return get_options(data, header).get(OPTION_MSS)
+
+
+# The shift that brings a window of size bytes into the 16-bit field
+def window_scale(size):
+    shift = 0
+    while size >> shift > 0xffff and shift < MAX_WINDOW_SCALE:
+        shift += 1
+    return shift
+
+
+# The buffer size of a connection: the configured one within the bounds
+def buffer_size(size=None):
+    if size is None:
+        return DEFAULT_BUFFER_SIZE
+    return max(MIN_BUFFER_SIZE, min(size, MAX_BUFFER_SIZE))
+
+
+# The segment size offered to the peer at ip: the configured one, or the
+# largest that crosses the route's MTU without IP fragmentation
+def local_segment_size(ip, segSize=None):
+    if segSize is None:
+        mtu = path_mtu(ip) or DEFAULT_MTU
+        segSize = mtu - IP_UDP_OVERHEAD - defaultHeaderLen
+    return max(MIN_SEGMENT_SIZE, min(segSize, MAX_SEGMENT_SIZE))
+
+
+# The header with the most options, and the size of a receive slot large
+# enough for any rUDP datagram
+DATAGRAM_OVERHEAD = 64
+DATAGRAM_SIZE = MAX_SEGMENT_SIZE + DATAGRAM_OVERHEAD
+RECV_RING_SLOTS = 1024
+# Slots beyond a full receiving window, for the datagrams waiting to be processed
+RECV_RING_HEADROOM = 256
+# With GRO a slot takes several datagrams coalesced up to 64kb
+GRO_DATAGRAM_SIZE = 65536
+GRO_RING_SLOTS = RECV_RING_SLOTS // 4
+
+
+# A datagram received into a recvRing slot. The slot goes back to the ring
+# once every holder (the receiving thread, the rcvBuffer) has released it.
+class recvSlot:
+    __slots__ = ('ring', 'index', 'view', 'length', 'segSize', 'refs')
+
+    def __init__(self, ring, index, view):
+        self.ring = ring
+        self.index = index
+        self.view = view
+        self.length = 0
+        # set when GRO coalesced several datagrams of this size into the slot
+        self.segSize = 0
+        self.refs = 1
+
+    @property
+    def data(self):
+        return self.view[:self.length]
+
+    # The datagrams held by the slot, every one but the last is segSize long
+    def datagrams(self):
+        if self.segSize == 0 or self.segSize >= self.length:
+            return [self.data]
+        return [self.view[i:min(i + self.segSize, self.length)]
+                for i in range(0, self.length, self.segSize)]
+
+    def retain(self):
+        self.ring.lock.acquire()
+        try:
+            self.refs += 1
+        finally:
+            self.ring.lock.release()
+
+    def release(self):
+        self.ring.lock.acquire()
+        try:
+            self.refs -= 1
+            if self.refs == 0 and self.index is not None:
+                self.ring.free.append(self.index)
+        finally:
+            self.ring.lock.release()
+
+
+# Fixed slots the socket receives datagrams into with recvfrom_into,
+# so the kernel copy is the only copy of the data
+class recvRing:
+    def __init__(self, count=RECV_RING_SLOTS, size=DATAGRAM_SIZE):
+        self.count = count
+        self.size = size
+        self.buffer = bytearray(count * size)
+        self.view = memoryview(self.buffer)
+        self.free = deque(range(count))
+        # datagrams received into a buffer of their own, the ring being empty
+        self.fallbacks = 0
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        self.lock.acquire()
+        try:
+            index = self.free.popleft() if self.free else None
+            if index is None:
+                self.fallbacks += 1
+        finally:
+            self.lock.release()
+        if index is None:
+            # every slot is held, fall back to a standalone buffer
+            logger.debug('receive ring exhausted')
+            return recvSlot(self, None, memoryview(bytearray(self.size)))
+        return recvSlot(self, index, self.view[index * self.size:(index + 1) * self.size])
+
+    # Receives the next datagram (or GRO batch) from an rUDPConnection
+    def recv_into(self, conn: rUDPConnection):
+        slot = self.acquire()
+        try:
+            slot.length, addr, slot.segSize = conn.recv_into(slot.view)
+        except BaseException:
+            slot.release()
+            raise
+        return slot, addr
+
+    def stats(self):
+        return {
+            'slots': self.count,
+            'free': len(self.free),
+            'fallbacks': self.fallbacks
+        }
+
+
+# A ring with room for a full window of bufferSize bytes held in it (e.g.
+# received out of order) plus RECV_RING_HEADROOM. segSize is the largest
+# segment the datagrams carry, None when it is not known yet.
+def new_recv_ring(bufferSize, segSize=None, gro=False):
+    if gro:
+        # a slot holds one GRO batch, usually of several segments
+        return recvRing(bufferSize // GRO_DATAGRAM_SIZE + GRO_RING_SLOTS, GRO_DATAGRAM_SIZE)
+    if segSize is None:
+        # smaller segments may come, at least the default count is kept
+        return recvRing(max(RECV_RING_SLOTS, bufferSize // MAX_SEGMENT_SIZE + RECV_RING_HEADROOM))
+    segSize = max(MIN_SEGMENT_SIZE, min(segSize, MAX_SEGMENT_SIZE))
+    return recvRing(bufferSize // segSize + RECV_RING_HEADROOM, segSize + DATAGRAM_OVERHEAD)
+
+
+# Receive window of size bytes, holds views of the received datagrams. A
+# popped segment keeps its room in the window until the app releases it.
+# Segments arriving ahead of a lost one wait aside until it is filled.
 class rcvBuffer:
-    def __init__(self):
-        self.buffer = bytearray(MAX_BUFFER_SIZE)
-        self.lastByteRead = 0
-        self.lastByteRcvd = 0
+    def __init__(self, segSize=PACKET_SIZE, size=DEFAULT_BUFFER_SIZE):
+        self.segSize = segSize
+        self.size = size
+        # the shift of the advertised windows once the peer agreed to window
+        # scaling, None while they are counted in segments as before
+        self.scale = None
+        # whether the peer agreed to receive SACK blocks
+        self.sack = False
+        self.segments = deque()
+        self.consumed = deque()
         self.length = 0
+        # seq: (slot, data) of the segments received out of order, and the
+        # [left, right) ranges they make up, in order
+        self.outOfOrder = {}
+        self.ranges = []
+        # seq of the last segment received out of order, its range is
+        # reported first
+        self.latest = None
         # Lock buffer when accessing
         self.lock = threading.Lock()
 
-    def add(self, data: bytearray):
+    # Called with the lock held, returns the data to keep
+    def hold(self, data, slot: recvSlot=None):
+        if slot is not None:
+            slot.retain()
+        elif not (isinstance(data, memoryview) and data.readonly):
+            data = memoryview(bytearray(data))
+        return data
+
+    # slot is the recvSlot data points into, without one the data is copied
+    # unless it is a read-only view (e.g. of the bytes asyncio received)
+    def add(self, data, slot: recvSlot=None):
         self.lock.acquire()
         try:
-            if self.length + PACKET_SIZE > MAX_BUFFER_SIZE:
+            if self.length + len(data) > self.size:
                 return False    # buffer overflow
+            self.segments.append((slot, self.hold(data, slot)))
+            self.length += len(data)
+            return True
+        finally:
+            self.lock.release()
 
-            self.buffer[self.lastByteRcvd:self.lastByteRcvd+PACKET_SIZE] = data
-            self.lastByteRcvd += PACKET_SIZE
-            if self.lastByteRcvd == MAX_BUFFER_SIZE:
-                self.lastByteRcvd = 0
-            self.length += PACKET_SIZE
+    # Keeps data received at seq while expected has not arrived yet, returns
+    # False when it lies beyond the window advertised from expected
+    def add_out_of_order(self, seq, expected, data, slot: recvSlot=None):
+        self.lock.acquire()
+        try:
+            if seq + len(data) - expected > self.size - self.length:
+                return False
+            self.latest = seq
+            if seq in self.outOfOrder:
+                return True
+            self.outOfOrder[seq] = (slot, self.hold(data, slot))
+            self.add_range(seq, seq + len(data))
             return True
         finally:
-            self.lock.release()    
+            self.lock.release()
+
+    # Called with the lock held, there are only as many ranges as holes
+    def add_range(self, left, right):
+        ranges = self.ranges
+        i = 0
+        while i < len(ranges) and ranges[i][1] < left:
+            i += 1
+        if i == len(ranges) or ranges[i][0] > right:
+            ranges.insert(i, [left, right])
+            return
+        ranges[i][0] = min(ranges[i][0], left)
+        ranges[i][1] = max(ranges[i][1], right)
+        while i + 1 < len(ranges) and ranges[i + 1][0] <= ranges[i][1]:
+            ranges[i][1] = max(ranges[i][1], ranges.pop(i + 1)[1])
+
+    # Moves the segments received out of order that follow expected into
+    # the window, returns the seq expected next and how many were moved
+    def pull(self, expected):
+        self.lock.acquire()
+        try:
+            count = 0
+            while expected in self.outOfOrder:
+                slot, data = self.outOfOrder.pop(expected)
+                self.segments.append((slot, data))
+                self.length += len(data)
+                expected += len(data)
+                count += 1
+            while self.ranges and self.ranges[0][1] <= expected:
+                self.ranges.pop(0)
+            return expected, count
+        finally:
+            self.lock.release()
+
+    # The SACK blocks to report, the one holding the latest segment first
+    def sack_blocks(self):
+        self.lock.acquire()
+        try:
+            if not self.sack or not self.ranges:
+                return []
+            blocks = [(left, right) for left, right in self.ranges]
+            for i, (left, right) in enumerate(blocks):
+                if left <= self.latest < right:
+                    blocks.insert(0, blocks.pop(i))
+                    break
+            return blocks[:MAX_SACK_BLOCKS]
+        finally:
+            self.lock.release()
+
+    # Gives back the segments received out of order, e.g. once the
+    # connection is gone
+    def discard_out_of_order(self):
+        self.lock.acquire()
+        try:
+            for slot, data in self.outOfOrder.values():
+                if slot is not None:
+                    slot.release()
+            self.outOfOrder.clear()
+            self.ranges = []
+        finally:
+            self.lock.release()
 
+    # The window field to advertise, it only offers room for full segments
+    # so a window below one segment is advertised as closed
     def get_win(self):
-        return (MAX_BUFFER_SIZE - self.length) // PACKET_SIZE
+        free = self.size - self.length
+        if self.scale is None:
+            return min(free // self.segSize, 0xffff)
+        return min((free - free % self.segSize) >> self.scale, 0xffff)
+
+    # The window of a SYN or SYN-ACK, never scaled
+    def get_syn_win(self):
+        return min(self.size - self.length, 0xffff)
 
 
     def peek(self):
-        if self.length == 0:
+        if len(self.segments) == 0:
             raise Exception('Reading an empty buffer.')
-        return self.buffer[self.lastByteRead: self.lastByteRead + PACKET_SIZE]
+        return self.segments[0][1]
 
 
+    # The returned memoryview stays valid until release is called
     def pop(self):
         self.lock.acquire()
         try:
             result = self.peek()
-            self.lastByteRead += PACKET_SIZE
-            if self.lastByteRead == MAX_BUFFER_SIZE:
-                self.lastByteRead = 0
-            self.length -= PACKET_SIZE
-            logger.debug('%d %d', self.lastByteRcvd // PACKET_SIZE, self.lastByteRead // PACKET_SIZE)
+            self.consumed.append(self.segments.popleft())
+            logger.debug('%d %d', len(self.segments), len(self.consumed))
             return result
         finally:
             self.lock.release()
 
-# 512kb sending window, store with a array
+    # Give back the oldest popped segment
+    def release(self):
+        self.lock.acquire()
+        try:
+            slot, data = self.consumed.popleft()
+            if slot is not None:
+                slot.release()
+            self.length -= len(data)
+        finally:
+            self.lock.release()
+
+
+# Reads len(view) bytes of the file fd from position into view, returns how
+# many there were. One copy from the page cache, the file offset is untouched.
+def read_file_into(fd, view, position):
+    count = 0
+    while count < len(view):
+        if hasattr(os, 'preadv'):
+            n = os.preadv(fd, [view[count:]], position + count)
+        else:
+            data = os.pread(fd, len(view) - count, position + count)
+            n = len(data)
+            view[count:count+n] = data
+        if n == 0:
+            break
+        count += n
+    return count
+
+
+# Duplicate acks taken as a loss (RFC 5681)
+DUP_ACK_THRESHOLD = 3
+
+
+# Sending window of size bytes, store with a array. Segments are of any
+# length up to the segment size, each is stored contiguously, a segment that
+# does not fit before the end of the array starts over at 0 and the skipped
+# tail is freed along with it.
 class sndBuffer:
-    def __init__(self):
-        self.buffer = bytearray(MAX_BUFFER_SIZE)
-        self.messages = {}
+    # congestion names the controller of the window, see congestion.py
+    def __init__(self, size=DEFAULT_BUFFER_SIZE, congestion='reno'):
+        self.size = size
+        # allocated by the first add, a connection that only receives never needs it
+        self.buffer = None
+        self.view = None
+        # (offset, length, skipped) of the segments not sent yet
+        self.segments = deque()
+        # (message, offset, length, skipped) of the segments sent but not acked
+        self.messages = deque()
+        # how many of them the peer reported received with SACK blocks
+        self.sacked = 0
         self.lastByteSent = 0
         self.lastByteAcked = 0
         self.lastByteReady = 0
         self.length = 0
+        # bytes the peer can take and bytes sent but not acked
         self.win = 0
-        self.cwnd = 0
-        self.state = CwndState.SHAKING
-        self.pausing = False
-        self.ssthresh = 0
+        self.inFlight = 0
+        # the peer's window scale, None when it advertises segments of segSize
+        self.peerScale = None
+        # the window field of the peer's last ack
+        self.peerWin = None
+        # the peer reports the segments it received out of order in SACK blocks
+        self.peerSack = False
+        self.segSize = PACKET_SIZE
+        self.controller = new_controller(congestion)
+        self.started = False
+        # segments first sent before it belong to a loss already reacted to
+        self.recoveryTime = 0
+        # duplicate acks of the oldest segment in flight. In fast recovery
+        # until recoveryPoint (the last message sent when it started) is
+        # acked, lastRetransmit is the last hole sent again.
+        self.dupAcks = 0
+        self.recovering = False
+        self.recoveryPoint = None
+        self.lastRetransmit = None
+        # loss events and how they were found
+        self.fastRetransmits = 0
+        self.fastRecoveries = 0
+        self.timeouts = 0
         # Lock buffer when accessing
         self.lock = threading.Lock()
+        # Taken by the adders before lock and held while a file is read
+        # into the place reserved for it, so that the next segment does
+        # not take that place or go before it
+        self.addLock = threading.Lock()
+
+    # SHAKING until the first data is added, then the controller's state
+    @property
+    def state(self):
+        if not self.started:
+            return CwndState.SHAKING
+        return self.controller.state
+
+    # Hands the window to the controller, called once the segment size
+    # has been negotiated
+    def start(self):
+        self.lock.acquire()
+        try:
+            if not self.started:
+                self.controller.start(self.segSize, self.max_cwnd())
+                self.started = True
+        finally:
+            self.lock.release()
 
-    def find_cong(self):
-        # TODO: Pausing feature
-        self.pausing = True
-        if self.state != CwndState.SHAKING and self.state == CwndState.CONGAVOID:
-            if self.lastByteReady >= self.lastByteAcked:
-                self.length = self.lastByteReady - self.lastByteAcked
-            else:
-                self.length = MAX_BUFFER_SIZE + self.lastByteReady - self.lastByteAcked
-            self.state = CwndState.SLOWSTART
-            self.ssthresh = self.cwnd // 2
-            self.cwnd = 1
+    # mess timed out, the losses of one window make a single loss event
+    def find_cong(self, mess=None):
+        self.lock.acquire()
+        try:
+            if not self.started:
+                # handshake retransmission, no window yet
+                return
+            if mess is not None and mess.sentTime is not None and mess.sentTime < self.recoveryTime:
+                return
+            self.recoveryTime = time.monotonic()
+            # a timeout ends fast recovery, the retransmitted hole was lost again
+            self.recovering = False
+            self.dupAcks = 0
+            self.timeouts += 1
+            self.controller.on_loss(True)
+        finally:
+            self.lock.release()
+
+    # ackNum and recvWin are the fields of an ack without data that acked
+    # nothing new, sacked the messages its SACK blocks marked first. It is a
+    # duplicate when the window is unchanged, data is in flight and ackNum is
+    # the oldest segment of it (RFC 5681 §2), with SACK only when it reports
+    # newly received data (RFC 6675 §2), not when it answers a segment sent
+    # twice. The third duplicate ack starts fast recovery, returns the
+    # message to retransmit at once or None.
+    def dup_ack(self, ackNum, recvWin, sacked=0):
+        self.lock.acquire()
+        try:
+            if recvWin != self.peerWin:
+                # a window update, not a duplicate. A closed window is
+                # ignored as by the other acks, the timers probe it
+                if recvWin > 0:
+                    self.apply_peer_win(recvWin)
+                return None
+            if not self.started or self.inFlight <= 0 or not self.messages or \
+                    self.messages[0][0].seqNum != ackNum:
+                return None
+            if self.peerSack and sacked == 0:
+                return None
+            self.dupAcks += 1
+            if self.dupAcks != DUP_ACK_THRESHOLD or self.recovering:
+                return None
+            if self.messages[0][0].sentTime is not None and self.messages[0][0].sentTime < self.recoveryTime:
+                # already reacted to, e.g. by a timeout
+                return None
+            self.recovering = True
+            self.recoveryPoint = self.messages[-1][0]
+            self.recoveryTime = time.monotonic()
+            self.lastRetransmit = None
+            self.controller.on_loss(False)
+            return self.next_hole()
+        finally:
+            self.lock.release()
+
+    # In fast recovery, a partial ack (one short of recoveryPoint) shows the
+    # next hole: the oldest segment in flight (RFC 6582). Returns the
+    # message to retransmit or None.
+    def hole(self):
+        self.lock.acquire()
+        try:
+            if not self.recovering:
+                return None
+            return self.next_hole()
+        finally:
+            self.lock.release()
+
+    # Called with the lock held
+    def next_hole(self):
+        if not self.messages:
+            return None
+        mess = self.messages[0][0]
+        if mess is self.lastRetransmit or mess.sacked:
+            return None
+        self.lastRetransmit = mess
+        self.fastRetransmits += 1
+        return mess
+
+    # The controller's and the loss recovery's counters
+    def stats(self):
+        self.lock.acquire()
+        try:
+            result = self.controller.stats()
+            result['fastRetransmits'] = self.fastRetransmits
+            result['fastRecoveries'] = self.fastRecoveries
+            result['timeouts'] = self.timeouts
+            result['recovering'] = self.recovering
+            return result
+        finally:
+            self.lock.release()
 
+    def on_rtt_sample(self, rtt):
+        self.lock.acquire()
+        try:
+            self.controller.on_rtt_sample(rtt)
+        finally:
+            self.lock.release()
+
+    # Bytes per second to send at: the controller's own rate, or the window
+    # spread over srtt. None before a round trip was measured.
+    def pacing_rate(self, srtt):
+        self.lock.acquire()
+        try:
+            rate = self.controller.pacing_rate()
+            if rate is not None or not srtt:
+                return rate
+            gain = PACING_SLOWSTART_GAIN if self.controller.state == CwndState.SLOWSTART else PACING_GAIN
+            return gain * self.get_cwnd() * self.segSize / srtt
+        finally:
+            self.lock.release()
 
     def get_data(self):
-        datalist = []
-        i = self.lastByteSent
-        #logger.debug("pausing: %d" % self.pausing)
-        if self.length == 0:
+        if len(self.segments) == 0:
             return []
-        if self.pausing is True:
-            return [1]
-        count = 0
-        while count < self.win:
-            datalist.append(self.buffer[i:i+PACKET_SIZE])
-            i += PACKET_SIZE
-            if i == MAX_BUFFER_SIZE:
-                i = 0
-            if i == self.lastByteReady:
+        datalist = []
+        count = self.get_cwnd() - (len(self.messages) - self.sacked)
+        room = self.win - self.inFlight
+        for offset, length, skipped in self.segments:
+            if len(datalist) >= count or length > room:
                 break
-            count += 1
+            datalist.append(self.view[offset:offset+length])
+            room -= length
         return datalist
 
     def get_win(self):
         return self.win
 
+    # Whether get_data would return segments to send
+    def can_send(self):
+        return (len(self.segments) > 0 and len(self.messages) - self.sacked < self.get_cwnd() and
+                self.segments[0][1] <= self.win - self.inFlight)
+
+    # in segments, no more than the buffer can hold
     def get_cwnd(self):
-        return self.cwnd
-        
-    def set_cwnd(self, cwnd):
+        return min(self.controller.get_cwnd(), self.max_cwnd())
+
+    def max_cwnd(self):
+        return max(1, self.size // self.segSize)
+
+    # win is in bytes
+    def set_win(self, win):
         self.lock.acquire()
         try:
-            if cwnd > 20:
-                cwnd = 20
-            self.cwnd = cwnd
+            self.win = win
         finally:
             self.lock.release()
 
-    def set_win(self, win):
+    # Takes the window field of a segment from the peer
+    def set_peer_win(self, recvWin):
         self.lock.acquire()
         try:
-            if win > 20:
-                win = 20
-            self.win = win
+            self.apply_peer_win(recvWin)
         finally:
             self.lock.release()
 
+    # Called with the lock held
+    def apply_peer_win(self, recvWin):
+        self.peerWin = recvWin
+        if self.peerScale is None:
+            self.win = recvWin * self.segSize
+        else:
+            self.win = recvWin << self.peerScale
+
+    # Returns True when the buffer is full and data was not added
     def add(self, data: bytearray):
+        self.addLock.acquire()
         self.lock.acquire()
         try:
-            if self.length + PACKET_SIZE > MAX_BUFFER_SIZE:
+            place = self.place(len(data))
+            if place is None:
                 return True
-            self.buffer[self.lastByteReady:self.lastByteReady+PACKET_SIZE] = data
-            self.lastByteReady += PACKET_SIZE
-            if self.lastByteReady == MAX_BUFFER_SIZE:
-                self.lastByteReady = 0
-            self.length += PACKET_SIZE
+            offset, skipped = place
+            self.buffer[offset:offset+len(data)] = data
+            self.push(offset, len(data), skipped)
             return False
         finally:
-            self.lock.release()    
-    
+            self.lock.release()
+            self.addLock.release()
+
+    # Adds a segment of prefix followed by length bytes of the file fd from
+    # position, read straight into the buffer. Returns the bytes read, the
+    # segment is only added when all of them were, or None when it does
+    # not fit. The file is read without the lock, acks and retransmissions
+    # do not wait for the disk.
+    def add_file(self, fd, position, length, prefix=b''):
+        self.addLock.acquire()
+        try:
+            size = len(prefix) + length
+            self.lock.acquire()
+            try:
+                place = self.place(size)
+            finally:
+                self.lock.release()
+            if place is None:
+                return None
+            # nothing else is written there until it is pushed
+            offset, skipped = place
+            self.buffer[offset:offset+len(prefix)] = prefix
+            count = read_file_into(fd, self.view[offset+len(prefix):offset+size], position)
+            if count == length:
+                self.lock.acquire()
+                try:
+                    self.push(offset, size, skipped)
+                finally:
+                    self.lock.release()
+            return count
+        finally:
+            self.addLock.release()
+
+    # Called with the lock held, returns (offset, skipped) where length
+    # more bytes fit, None when the buffer cannot take them now
+    def place(self, length):
+        if self.buffer is None:
+            self.buffer = bytearray(self.size)
+            # get_data hands out views of the buffer instead of copies
+            self.view = memoryview(self.buffer)
+        offset = self.lastByteReady
+        skipped = 0
+        if offset + length > self.size:
+            skipped = self.size - offset
+            offset = 0
+        if self.length + skipped + length > self.size:
+            return None
+        return offset, skipped
+
+    # Called with the lock held once the segment at offset is filled
+    def push(self, offset, length, skipped):
+        self.segments.append((offset, length, skipped))
+        self.lastByteReady = offset + length
+        if self.lastByteReady == self.size:
+            self.lastByteReady = 0
+        self.length += skipped + length
+
+    # Frees every segment sent up to and including mess,
+    # returns False when mess is not in flight
     def ack(self, mess):
         self.lock.acquire()
         try:
-            if self.state == CwndState.SLOWSTART:
-                if self.lastByteAcked in self.messages and self.messages[self.lastByteAcked].seqNum == mess.seqNum:
-                    if self.messages[self.lastByteAcked].is_acked() is True:
-                        if self.pausing is not True:
-                            self.cwnd += 1
-                        if self.cwnd > 20:
-                            self.cwnd = 20
-                        if self.cwnd == self.ssthresh:
-                            self.state = CwndState.CONGAVOID
-                        self.lastByteAcked += PACKET_SIZE
-                elif self.lastByteAcked in self.messages:
-                    temp = self.lastByteAcked - PACKET_SIZE
-                    for key, value in self.messages.items():
-                        if value.seqNum == mess.seqNum:
-                            temp = key
-                            break
-                    self.lastByteAcked = temp + PACKET_SIZE
-                    if self.lastByteAcked != temp + PACKET_SIZE:
-                        if self.pausing is not True:
-                            self.cwnd += 1
-                        if self.cwnd > 20:
-                            self.cwnd = 20
-                        if self.cwnd == self.ssthresh:
-                            self.state = CwndState.CONGAVOID
-                else:
-                    return False
-                if self.lastByteAcked == MAX_BUFFER_SIZE:
-                    self.lastByteAcked = 0
-                self.length -= PACKET_SIZE
-                if self.lastByteAcked == self.lastByteSent and self.pausing is True:
-                    self.pausing = False
-            else:
-                last = 0
-                if self.messages[self.lastByteAcked].seqNum == mess.seqNum:
-                    self.lastByteAcked += PACKET_SIZE
-                    if self.lastByteAcked == MAX_BUFFER_SIZE:
-                        self.lastByteAcked = 0
-                if self.lastByteSent == 0:
-                    last = MAX_BUFFER_SIZE - PACKET_SIZE
-                else:
-                    last = self.lastByteSent - PACKET_SIZE
-                if self.messages[last].is_acked() is True:
-                    self.cwnd += 1
-                    if self.cwnd > 20:
-                        self.cwnd = 20
-                    self.lastByteAcked = self.lastByteSent
-                    if self.lastByteReady >= self.lastByteAcked:
-                        self.length = self.lastByteReady - self.lastByteAcked
-                    else:
-                        self.length = MAX_BUFFER_SIZE + self.lastByteReady - self.lastByteAcked
-                else:
-                    return False
+            if not mess.buffered:
+                return False
+            segments = 0
+            acked = 0
+            self.dupAcks = 0
+            while True:
+                sent, offset, length, skipped = self.messages.popleft()
+                sent.buffered = False
+                self.length -= skipped + length
+                self.inFlight -= length
+                self.lastByteAcked = offset + length
+                if sent.sacked:
+                    self.sacked -= 1
+                if sent is self.recoveryPoint:
+                    # every loss of the window was repaired without a timeout
+                    self.recovering = False
+                    self.recoveryPoint = None
+                    self.fastRecoveries += 1
+                    self.controller.on_recovery_end()
+                segments += 1
+                acked += length
+                if sent is mess:
+                    break
+            if self.lastByteAcked == self.size:
+                self.lastByteAcked = 0
+            if self.started:
+                self.controller.on_ack(segments, acked, self.inFlight)
+            return True
         finally:
             self.lock.release()
 
+    # Moves the oldest unsent segment in flight, called with the message
+    # carrying it once sent
     def send(self, mess):
         self.lock.acquire()
         try:
-            self.messages[self.lastByteSent] = mess
-            self.lastByteSent += PACKET_SIZE
-            if self.lastByteSent == MAX_BUFFER_SIZE:
+            offset, length, skipped = self.segments.popleft()
+            self.messages.append((mess, offset, length, skipped))
+            mess.buffered = True
+            self.inFlight += length
+            self.lastByteSent = offset + length
+            if self.lastByteSent == self.size:
                 self.lastByteSent = 0
         finally:
             self.lock.release()
 
+    # The peer reported the messages received ahead of a hole, they leave
+    # the congestion window but keep their room in the peer's window
+    # until the cumulative ack frees them
+    def sack(self, messages):
+        self.lock.acquire()
+        try:
+            for mess in messages:
+                if mess.buffered:
+                    self.sacked += 1
+        finally:
+            self.lock.release()
+
+
+# Seconds a closed client waits before releasing its socket
+TIME_WAIT_TIMEOUT = 30
+
+# Retransmission timeout bounds in seconds (RFC 6298), the initial one is
+# used until the first round trip has been measured
+INITIAL_RTO = 1
+MIN_RTO = 0.2
+MAX_RTO = 60
+# Clock granularity, the tick of the timer wheel
+RTO_GRANULARITY = 0.01
+
+
+# Retransmission timeout of a connection computed from the round trip times
+# of its acked segments, as TCP does (RFC 6298)
+class rttEstimator:
+    # onSample(rtt) is called with every sample, e.g. sndBuffer.on_rtt_sample
+    def __init__(self, onSample=None):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = INITIAL_RTO
+        self.samples = 0
+        self.onSample = onSample
+        self.lock = threading.Lock()
+
+    def sample(self, rtt):
+        self.lock.acquire()
+        try:
+            if self.srtt is None:
+                self.srtt = rtt
+                self.rttvar = rtt / 2
+            else:
+                self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+                self.srtt = 0.875 * self.srtt + 0.125 * rtt
+            self.samples += 1
+            rto = self.srtt + max(RTO_GRANULARITY, 4 * self.rttvar)
+            self.rto = min(max(rto, MIN_RTO), MAX_RTO)
+        finally:
+            self.lock.release()
+        if self.onSample is not None:
+            self.onSample(rtt)
+
+    # Takes a sample from an acked message. Following Karn's rule, a message
+    # that has been retransmitted does not tell which copy was acked, one
+    # reported by a SACK block waited for the hole before it.
+    def ack(self, mess):
+        if mess is None or mess.sentTime is None or mess.timeoutCount != 1 or mess.sacked:
+            return
+        self.sample(time.monotonic() - mess.sentTime)
+
+    # A retransmission timed out after timeout seconds, the following
+    # segments wait as long until a new sample is taken
+    def backoff(self, timeout):
+        self.lock.acquire()
+        try:
+            self.rto = min(max(self.rto, timeout), MAX_RTO)
+        finally:
+            self.lock.release()
+
+    def get_rtt(self):
+        return self.srtt
+
+    def get_rto(self):
+        return self.rto
+
+    def stats(self):
+        return {
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'rto': self.rto,
+            'samples': self.samples
+        }
+
+
+# In-order segments are acked together: once every ACK_EVERY of them or
+# DELAYED_ACK_TIMEOUT seconds after the first one not acked yet
+ACK_EVERY = 2
+DELAYED_ACK_TIMEOUT = 0.04
+
+
+# The acks a receiver holds back. Segments out of order, filling a hole or
+# changing the window are acked at once, an ack sent with data takes the
+# place of a delayed one.
+class delayedAck:
+    # flush() sends the ack once the delay is over, every=1 acks every segment
+    def __init__(self, engine, flush, every=ACK_EVERY, delay=DELAYED_ACK_TIMEOUT):
+        self.engine = engine
+        self.flush = flush
+        self.every = max(1, every)
+        self.delay = delay
+        # in-order segments not acked yet
+        self.pending = 0
+        self.timer = None
+        self.lock = threading.Lock()
+
+    # An in-order segment arrived, returns True when it is time to ack
+    def segment(self):
+        self.lock.acquire()
+        try:
+            self.pending += 1
+            if self.pending >= self.every:
+                return True
+            if self.timer is None:
+                self.timer = self.engine.schedule(self.delay, self.expire)
+            return False
+        finally:
+            self.lock.release()
+
+    def expire(self):
+        self.lock.acquire()
+        try:
+            self.timer = None
+            pending = self.pending
+        finally:
+            self.lock.release()
+        if pending > 0:
+            self.flush()
+
+    # An ack is going out, alone or with data, returns whether segments
+    # were waiting for one
+    def take(self):
+        self.lock.acquire()
+        try:
+            pending = self.pending
+            self.pending = 0
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            return pending > 0
+        finally:
+            self.lock.release()
+
+
+# Seconds of sending a pacing bucket holds, two ticks of the timer wheel
+# the pacer waits on
+PACING_QUANTUM = 2 * RTO_GRANULARITY
+# The pacing rate of a window is gain * cwnd / SRTT, more in slow start
+# so that the window can double every round trip
+PACING_GAIN = 1.2
+PACING_SLOWSTART_GAIN = 2
+
+
+# Tokens are bytes, they come back at rate bytes per second up to what
+# PACING_QUANTUM seconds bring. A rate of None lets everything through.
+class tokenBucket:
+    def __init__(self, rate=None, minDepth=0):
+        self.rate = None
+        self.depth = 0
+        self.tokens = 0
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+        self.set_rate(rate, minDepth)
+
+    # minDepth is the smallest burst, e.g. two segments
+    def set_rate(self, rate, minDepth=0):
+        self.lock.acquire()
+        try:
+            if rate is not None:
+                self.depth = max(rate * PACING_QUANTUM, minDepth)
+                if self.rate is None:
+                    self.tokens = self.depth
+                    self.last = time.monotonic()
+            self.rate = rate
+        finally:
+            self.lock.release()
+
+    # Seconds until a segment may go, 0 when it may go now. A segment goes
+    # while any token is left, the bucket may be overdrawn by it.
+    def wait(self, now):
+        self.lock.acquire()
+        try:
+            if self.rate is None:
+                return 0
+            self.tokens = min(self.depth, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens > 0:
+                return 0
+            return -self.tokens / self.rate
+        finally:
+            self.lock.release()
+
+    def consume(self, size):
+        self.lock.acquire()
+        try:
+            if self.rate is not None:
+                self.tokens -= size
+        finally:
+            self.lock.release()
+
 
-MAX_TIMER_COUNT = 32
+# Spreads the segments of a window over the round trip instead of sending
+# them back to back. The connection's bucket follows the pacing rate, capped
+# at rateCap bytes per second, shared is a bucket of several connections
+# (e.g. every one of a server). Held back segments are sent by wake() on the
+# engine's timers, the ones retransmissions use.
+class pacer:
+    def __init__(self, engine, wake, rateCap=None, shared: tokenBucket=None):
+        self.engine = engine
+        self.wake = wake
+        self.rateCap = rateCap
+        self.bucket = tokenBucket(rateCap)
+        self.buckets = [self.bucket] if shared is None else [self.bucket, shared]
+        self.waking = False
+        self.lock = threading.Lock()
+
+    # rate is the pacing rate in bytes per second, None for no pacing
+    def set_rate(self, rate, segSize):
+        if self.rateCap is not None:
+            rate = self.rateCap if rate is None else min(rate, self.rateCap)
+        self.bucket.set_rate(rate, 2 * segSize)
+
+    # Returns how many of the segments in datalist may go now, wake is
+    # called once the rest may
+    def admit(self, datalist):
+        now = time.monotonic()
+        count = 0
+        wait = 0
+        for data in datalist:
+            wait = max(bucket.wait(now) for bucket in self.buckets)
+            if wait > 0:
+                break
+            for bucket in self.buckets:
+                bucket.consume(len(data))
+            count += 1
+        if count < len(datalist):
+            self.schedule(wait)
+        return count
+
+    def schedule(self, wait):
+        self.lock.acquire()
+        try:
+            if self.waking:
+                return
+            self.waking = True
+        finally:
+            self.lock.release()
+        self.engine.schedule(wait, self.expire)
+
+    def expire(self):
+        self.lock.acquire()
+        try:
+            self.waking = False
+        finally:
+            self.lock.release()
+        self.wake()
 
 
 class message:
-    def __init__(self, data, conn: rUDPConnection, sendBuf: sndBuffer=None):
+    # data is the header, the payload (e.g. a view into sndBuffer) is kept
+    # apart and sent with it so retransmissions reuse the same buffers
+    # rtt is the connection's rttEstimator, it sets the timeout and is
+    # backed off by the retransmissions
+    # seqNum is the full sequence number of the header, by default its 32 bits
+    def __init__(self, data, conn: rUDPConnection, sendBuf: sndBuffer=None, payload=None,
+                 rtt: rttEstimator=None, seqNum=None):
         self.acked = False
+        # received by the peer ahead of a hole, no longer retransmitted
+        self.sacked = False
+        # in flight in sendBuf's segments, until acked
+        self.buffered = False
         self.data = data
-        self.seqNum = int.from_bytes(data[4:8], byteorder='big', signed=False)
+        self.payload = payload
+        self.seqNum = get_seq_num(data) if seqNum is None else seqNum
         self.conn = conn
         self.sendBuf = sendBuf
-        # initial time out is 1000 ms
-        self.timeoutTime = 1
+        self.rtt = rtt
+        self.timeoutTime = rtt.get_rto() if rtt is not None else INITIAL_RTO
         self.timeoutCount = 0
+        # time of the first transmission
+        self.sentTime = None
+        # retransmission timeout, scheduled by the connection's engine
+        self.timer = None
 
     def is_acked(self):
         return self.acked
 
-    def send_with_timer(self, destAddr):
+    def ack(self):
+        self.acked = True
+        if self.timer is not None:
+            self.timer.cancel()
+
+    def sack(self):
+        self.sacked = True
+        self.ack()
+
+    # Sends the message again ahead of its timer (fast retransmit), the
+    # timer starts over and a timeout of this copy is a new loss
+    def retransmit(self, destAddr):
+        if self.acked:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        logger.debug('Fast retransmitting message with seqNum=%d' % self.seqNum)
+        self.sentTime = time.monotonic()
+        # by Karn's rule the ack no longer tells the round trip
+        self.timeoutCount += 1
+        self.send(destAddr)
+        self.timer = self.conn.engine.schedule(self.timeoutTime, self.send_with_timer, destAddr)
+
+    # sent tells that the first transmission already went out in a batch
+    def send_with_timer(self, destAddr, sent=False):
         if self.timeoutCount == 3:
             logger.warning('Timeout %d exceeds 3 times' % self.seqNum)
         if self.timeoutCount == 30:
@@ -379,17 +1339,29 @@ class message:
         if not self.acked:
             if self.timeoutCount != 0:
                 logger.debug('Resending message with seqNum=%d' % self.seqNum)
-                self.sendBuf.find_cong()
-            self.send(destAddr)
-            t = threading.Timer(self.timeoutTime, self.send_with_timer, args=[destAddr])
+                self.sendBuf.find_cong(self)
+                # exponential backoff
+                self.timeoutTime = min(self.timeoutTime * 2, MAX_RTO)
+                if self.rtt is not None:
+                    self.rtt.backoff(self.timeoutTime)
+            else:
+                self.sentTime = time.monotonic()
+            if not sent:
+                self.send(destAddr)
+            self.timer = self.conn.engine.schedule(self.timeoutTime, self.send_with_timer, destAddr)
             self.timeoutCount += 1
-            t.start()
         else:
             logger.debug('Message with seqNum=%d finished' % self.seqNum)
 
 
+    # The buffers making up the datagram
+    def parts(self):
+        if self.payload is None:
+            return [self.data]
+        return [self.data, self.payload]
+
     def send(self, destAddr):
-        self.conn.socket.sendto(self.data, destAddr)
+        self.conn.send_parts(self.parts(), destAddr)
 
 
 
@@ -397,7 +1369,11 @@ class message:
 
 class msgPool:
     def __init__(self):
+        # expected ackNum: message, for the lookups by ack and SACK edges
         self.messages = {}
+        # the expected ackNums in the order sent, they only grow so a
+        # cumulative ack pops a prefix
+        self.order = deque()
         self.lock = threading.Lock()
 
 
@@ -405,6 +1381,7 @@ class msgPool:
         try:
             self.lock.acquire()
             self.messages[expectACK] = msg
+            self.order.append(expectACK)
         finally:
             self.lock.release()
 
@@ -415,20 +1392,35 @@ class msgPool:
 
     def ack_msg(self, ackNum):
         if ackNum in self.messages:
-            self.messages[ackNum].acked = True
+            self.messages[ackNum].ack()
             logger.debug('ACKed message with ackNum: %d' % ackNum)
 
+    # Marks the messages inside the (left, right) blocks of a SACK option,
+    # returns the ones not marked before. The message of a block's right
+    # edge leads to the one before it, so only the blocks are walked.
+    def sack(self, blocks):
+        sacked = []
+        try:
+            self.lock.acquire()
+            for left, right in blocks:
+                mess = self.messages.get(right)
+                while mess is not None and mess.seqNum >= left:
+                    if not mess.acked:
+                        mess.sack()
+                        sacked.append(mess)
+                    mess = self.messages.get(mess.seqNum)
+        finally:
+            self.lock.release()
+        return sacked
+
     # ack all messages with ackNum smaller than or equal to the given ackNum
     def ack_to_num(self, ackNum):
         try:
             self.lock.acquire()
-            to_pop = []
-            for key in self.messages:
-                if key <= ackNum:
-                    self.ack_msg(key)
-                    to_pop.append(key)
-            for k in to_pop:
-                self.messages.pop(k)
+            while self.order and self.order[0] <= ackNum:
+                mess = self.messages.pop(self.order.popleft(), None)
+                if mess is not None:
+                    mess.ack()
         finally:
             self.lock.release()
 
@@ -3,24 +3,38 @@ import re
 import threading
 import os
 import json
+import sys
+import time
+import signal
+import multiprocessing
 from pathlib import Path
 from enum import Enum
 from reliableUDP.lftplog import logger
 from reliableUDP.server import rUDPServer, serverConn
-from reliableUDP.application import app
+from reliableUDP.utilities import ACK_EVERY
+from reliableUDP.application import app, msgAssembler, split_message, fileSink, SINK_BATCH_SIZE, partRecord, \
+    ioExecutor, IO_THREADS, READ_AHEAD_SEGMENTS, size_message, parse_size
+from reliableUDP.metrics import sharedMetrics
 
 serverStates = Enum('serverStates', ('RECVREQUEST', 'WAIT_SIZE', 'DATA'))
-operations = Enum('operations', ('GET', 'SEND', 'LIST'))
+operations = Enum('operations', ('GET', 'SEND', 'LIST', 'PART'))
 
 
 commands = {
     b'lSEND': operations.SEND,
     b'lGET': operations.GET,
-    b'lLIST': operations.LIST
+    b'lLIST': operations.LIST,
+    b'lRSEND': operations.SEND,
+    b'lRGET': operations.GET,
+    b'lPART': operations.PART
 }
 
+# followed by the offset and length of the range before the file name
+rangedCommands = (b'lRSEND', b'lRGET')
+
 class serverSession:
-    def __init__(self, destIP, destPort, action, dataDir, conn: serverConn):
+    # io is the ioExecutor of the server, None to do the disk I/O in place
+    def __init__(self, destIP, destPort, action, dataDir, conn: serverConn, io=None, readAhead=0):
         self.lock = threading.Lock()
         self.lock.acquire()
         self.destIP = destIP
@@ -32,6 +46,15 @@ class serverSession:
         self.dir = dataDir
         self.file = None
         self.fileSize = 0
+        # the range requested, None for the whole file, and its end in it
+        self.range = None
+        self.end = 0
+        # where the next segment of a downloaded file is read from, and
+        # the end of what the I/O threads were asked to read ahead
+        self.position = 0
+        self.readAhead = 0
+        self.io = io
+        self.readAheadSize = readAhead * conn.segSize
         self.waitingList = []
         self.lock.release()
 
@@ -41,19 +64,20 @@ class serverSession:
         self.state = newState
 
     def send_data(self, data, useBuffer):
-        buf = bytearray(5120)
         length = len(data)
+        buf = bytearray(4 + length)
         buf[0:4] = int.to_bytes(length, length=4, byteorder='big')
         buf[4:4+length] = data
-        pad_len = 5120 - 4 - length
-        buf[4+length:5120] = b'\0' * pad_len
-        if useBuffer:
-            if not self.conn.append_snd_buffer(buf):
-                self.waitingList.append(buf)
-                return False
-        else:
-            self.conn.send_msg(buf)
-        return True
+        sent = True
+        for segment in split_message(buf, self.conn.segSize):
+            if useBuffer:
+                # keep the order once something has to wait
+                if not sent or not self.conn.append_snd_buffer(segment):
+                    self.waitingList.append(segment)
+                    sent = False
+            else:
+                self.conn.send_msg(segment)
+        return sent
 
     def next(self):
         self.lock.acquire()
@@ -66,19 +90,52 @@ class serverSession:
                         else:
                             return
                 if self.action == operations.GET:
-                    while True and not self.file.closed:
-                        data = self.file.read(5116)
-                        if len(data) == 0:
+                    self.read_ahead()
+                    while not self.file.closed:
+                        length = min(self.conn.segSize - 4, self.end - self.position)
+                        if length == 0:
                             self.send_data(b'DONE', True)
                             self.file.close()
                             break
-                        else:
+                        # each segment is a message of its own, read from
+                        # the file straight into the sending buffer
+                        count = self.conn.append_snd_file(self.file.fileno(), self.position, length,
+                                                          int.to_bytes(length, length=4, byteorder='big'))
+                        if count is None:
                             # Pause when we cannot add new data to send
-                            if not self.send_data(data, True):
-                                break
+                            break
+                        if count < length:
+                            logger.error('File %s shrank while being sent' % self.filename)
+                            self.end = self.position
+                            continue
+                        self.position += count
         finally:
             self.lock.release()
 
+    # Keeps up to readAheadSize bytes past position on their way to the
+    # page cache, asking for more once half of them are sent
+    def read_ahead(self):
+        if self.io is None or self.readAheadSize == 0 or self.file.closed:
+            return
+        end = min(self.end, self.position + self.readAheadSize)
+        if end - self.readAhead >= self.readAheadSize // 2 or (end == self.end and self.readAhead < end):
+            start = max(self.readAhead, self.position)
+            self.io.read_ahead(self, self.file.fileno(), start, end - start)
+            self.readAhead = end
+
+    # Limits the request to length bytes from offset, None to the end of the file
+    def set_range(self, offset, length):
+        self.range = (offset, length)
+
+    # End of the data to transfer in a file of fileSize bytes
+    def range_end(self):
+        if self.range is None:
+            return self.fileSize
+        offset, length = self.range
+        if length is None:
+            return max(offset, self.fileSize)
+        return max(offset, min(offset + length, self.fileSize))
+
     def response_req(self):
         if self.action == operations.GET:
             # getting file from client
@@ -88,7 +145,12 @@ class serverSession:
                 self.file.seek(0, os.SEEK_END)
                 self.fileSize = self.file.tell()
                 self.file.seek(0, os.SEEK_SET)
-                self.send_data(b'SIZE ' + int.to_bytes(self.fileSize, byteorder='little', length=4), False)
+                # SIZE is the size of the file, a range is read from where it starts
+                self.end = self.range_end()
+                if self.range is not None:
+                    self.position = min(self.range[0], self.end)
+                self.readAhead = self.position
+                self.send_data(size_message(self.fileSize), False)
                 self.update_state(serverStates.DATA)
                 self.next()
             except FileNotFoundError as e:
@@ -98,20 +160,53 @@ class serverSession:
             response = bytearray(json.dumps(fileList), encoding='utf-8')
             self.send_data(response, False)
             self.send_data(b'DONE', False)
+        elif self.action == operations.PART:
+            # the ranges of the file an upload can be resumed after
+            path = os.path.join(self.dir, self.filename.decode())
+            record = partRecord(path)
+            if record.exists():
+                ranges = record.ranges()
+            elif os.path.isfile(path):
+                ranges = [(0, os.path.getsize(path))]
+            else:
+                self.send_data(b'NOTEXIST %s' % self.filename, False)
+                return
+            self.send_data(b'PART ' + bytes(json.dumps(ranges), encoding='utf-8'), False)
+            self.send_data(b'DONE', False)
         elif self.action == operations.SEND:
             # Sending file to client
-            checker = Path(os.path.join(self.dir, self.filename.decode()))
-            if checker.exists():
+            path = os.path.join(self.dir, self.filename.decode())
+            checker = Path(path)
+            record = partRecord(path)
+            # ranges go into a file while its part record is there
+            if checker.exists() and not record.exists():
                 self.send_data(b'EXISTED %s' % self.filename, False)
                 return
             logger.info('User %s:%d request to upload file %s' % (self.destIP, self.destPort, self.filename))
-            self.file = open(os.path.join(self.dir, self.filename.decode()), 'wb')
+            reply = b'WAITING %s' % self.filename
+            if checker.exists() and self.range is None:
+                # a whole upload cut short goes on after the data recorded
+                # from the start of the file
+                ranges = record.ranges()
+                resume = ranges[0][1] if ranges and ranges[0][0] == 0 else 0
+                self.set_range(resume, None)
+                reply = b'CONTINUE %d %s' % (resume, self.filename)
+            # recorded before the file shows up for the other ranges, and
+            # kept until the file is complete so that uploads can resume
+            record.create()
+            offset = self.range[0] if self.range is not None else None
+            # it holds segments of the receiving buffer until written
+            self.file = fileSink(path, batch=min(SINK_BATCH_SIZE, self.conn.recvWin.size // 4), executor=self.io,
+                                 offset=offset, record=record, key=(self.destIP, self.destPort))
             self.update_state(serverStates.WAIT_SIZE)
-            self.send_data(b'WAITING %s' % self.filename, False)
+            self.send_data(reply, False)
 
-    def process_data(self, data):
+    # Returns True when data went to the file, release() is then called
+    # once it is written
+    def process_data(self, data, release=None):
         if self.action == operations.SEND:
             if self.state == serverStates.WAIT_SIZE:
+                data = bytes(data)
                 msg = data.split(b' ')
                 if len(msg) < 2:
                     return
@@ -119,63 +214,163 @@ class serverSession:
                 cmd = data[:cmdIndex]
                 arg = data[cmdIndex+1:]
                 if cmd == b'SIZE':
-                    self.fileSize = int.from_bytes(arg, byteorder='little')
+                    self.fileSize = parse_size(arg)
+                    self.file.allocate(self.fileSize)
+                    self.end = self.range_end()
                     self.update_state(serverStates.DATA)
+                    if self.file.tell() >= self.end:
+                        self.file.close(self.received)
             elif self.state == serverStates.DATA:
                 try:
                     self.lock.acquire()
                     if self.file.closed:
-                        return
-                    if self.file.tell() == self.fileSize:
-                        return
-                    self.file.write(data)
-                    if self.file.tell() == self.fileSize:
-                        self.send_data(b'DONE', False)
-                        self.file.close()
+                        return False
+                    if self.file.tell() == self.end:
+                        return False
+                    self.file.write(data, release)
+                    if self.file.tell() == self.end:
+                        # done once all of it is on disk
+                        self.file.close(self.received)
+                    return True
                 finally:
                     self.lock.release()
+        return False
+
+    # Called once an upload is on disk and recorded, the last range of a
+    # file drops the record
+    def received(self):
+        record = partRecord(os.path.join(self.dir, self.filename.decode()))
+        if record.covers(self.fileSize):
+            record.remove()
+        self.send_data(b'DONE', False)
+
+    # Calls release once the data the upload holds is written, segments
+    # consumed before the one it releases may still be
+    def after(self, release):
+        if self.action == operations.SEND and isinstance(self.file, fileSink):
+            self.file.after(release)
+        else:
+            release()
             
 
 class server(app):
-    def __init__(self, ip, port, dataDir):
+    def __init__(self, ip, port, dataDir, segSize=None, engine='thread', reusePort=False, metrics=None,
+                 bufferSize=None, congestion='reno', ackEvery=ACK_EVERY, pacing=True, rate=None, totalRate=None,
+                 ioThreads=IO_THREADS, readAhead=READ_AHEAD_SEGMENTS):
         try:
             app.__init__(self)
+            # only guards the table of user locks, each user is processed
+            # under its own lock so transfers do not wait for each other
             self.lock = threading.Lock()
             self.lock.acquire()
             self.ip = ip
             self.port = port
             self.dir = dataDir
-            self.rudp = rUDPServer(self.ip, self.port, self)
             self.sessions = {}
+            self.assemblers = {}
+            self.userLocks = {}
+            # sessions opened before the executor is up do their I/O in place
+            self.io = None
+            self.readAhead = readAhead
+            self.rudp = rUDPServer(self.ip, self.port, self, segSize, engine=engine, reusePort=reusePort,
+                                   metrics=metrics, bufferSize=bufferSize, congestion=congestion,
+                                   ackEvery=ackEvery, pacing=pacing, rate=rate, totalRate=totalRate)
+            # reads ahead for downloads and writes behind for uploads
+            if ioThreads > 0:
+                self.io = ioExecutor(self.rudp.engine, ioThreads, metrics=metrics)
+        finally:
+            self.lock.release()
+
+    def user_lock(self, user):
+        self.lock.acquire()
+        try:
+            if user not in self.userLocks:
+                self.userLocks[user] = threading.Lock()
+            return self.userLocks[user]
+        finally:
+            self.lock.release()
+
+    # The session of user, None before its request. The tables are shared
+    # by all users, a session is looked up once and used under the user lock.
+    def session(self, user):
+        self.lock.acquire()
+        try:
+            return self.sessions.get(user)
+        finally:
+            self.lock.release()
+
+    def add_session(self, user, session):
+        self.lock.acquire()
+        try:
+            self.sessions[user] = session
+        finally:
+            self.lock.release()
+
+    def assembler(self, user):
+        self.lock.acquire()
+        try:
+            if user not in self.assemblers:
+                self.assemblers[user] = msgAssembler()
+            return self.assemblers[user]
         finally:
             self.lock.release()
 
     def next(self, user):
-        if user in self.sessions:
-            self.sessions[user].next()
+        session = self.session(user)
+        if session is not None:
+            session.next()
 
     def process_data(self, user):
+        data = None
+        kept = False
+        session = None
+        lock = self.user_lock(user)
         try:
-            self.lock.acquire()
-            data = self.rudp.connections[user].consume_rcv_buffer()
-            length = int.from_bytes(data[:4], byteorder='big')
-            content = data[4:4+length]
-            if user not in self.sessions:
+            lock.acquire()
+            conn = self.rudp.connections[user]
+            data = conn.consume_rcv_buffer()
+            content = self.assembler(user).feed(data)
+            if content is None:
+                return
+            session = self.session(user)
+            if session is None:
                 req = bytes(content).split(b' ')
-                if req[0] in commands:
+                if req[0] in rangedCommands and (len(req) < 4 or not req[1].isdigit() or not req[2].isdigit()):
+                    logger.error('Invalid range requested by %s:%d' % user)
+                elif req[0] in commands:
                     action = commands[req[0]]
-                    self.sessions[user] = serverSession(user[0], user[1], action, self.dir, self.rudp.connections[user])
-                    if len(req) > 1:
-                        self.sessions[user].filename = content[len(req[0])+1:]
-                    self.sessions[user].response_req()
+                    session = serverSession(user[0], user[1], action, self.dir, conn, self.io, self.readAhead)
+                    name = bytes(content[len(req[0])+1:])
+                    if req[0] in rangedCommands:
+                        session.set_range(int(req[1]), int(req[2]))
+                        name = name.split(b' ', 2)[2]
+                    if len(name) > 0:
+                        session.filename = name
+                    self.add_session(user, session)
+                    session.response_req()
             else:
-                self.sessions[user].process_data(content)
+                kept = session.process_data(content, conn.release_rcv_buffer)
         finally:
-            self.lock.release()
+            if data is not None and not kept:
+                if session is not None:
+                    session.after(conn.release_rcv_buffer)
+                else:
+                    conn.release_rcv_buffer()
+            lock.release()
             
 
     def remove_user(self, user):
-        self.sessions.pop(user)
+        self.lock.acquire()
+        try:
+            self.sessions.pop(user, None)
+            self.assemblers.pop(user, None)
+            self.userLocks.pop(user, None)
+        finally:
+            self.lock.release()
+
+    # Depth and stall counters of the disk I/O threads, None without them
+    def get_io_stats(self):
+        return self.io.stats() if self.io is not None else None
 
     def notify_close(self, user):
         #Not implement
@@ -183,11 +378,91 @@ class server(app):
 
 
 
+# Runs in each process of --workers, all of them bind the same port
+def run_worker(args, metrics: sharedMetrics, index):
+    view = metrics.worker(index)
+    view.set('pid', os.getpid())
+    lftp_server = server(args.addr, args.port, args.datadir, args.segment_size, args.engine, True, view,
+                         args.buffer_size, args.congestion, args.ack_every, args.pacing, args.rate, args.total_rate,
+                         args.io_threads, args.read_ahead)
+    view.set('ready', 1)
+    lftp_server.rudp.listener.join()
+
+
+def print_metrics(metrics: sharedMetrics):
+    print('%-6s %-8s %-6s %12s %10s %12s %12s %9s %11s' % ('worker', 'pid', 'ready', 'connections', 'accepted',
+                                                           'bytes in', 'bytes out', 'io queue', 'io stall ms'))
+    for index, row in enumerate(metrics.snapshot()):
+        print('%-6d %-8d %-6d %12d %10d %12d %12d %9d %11.1f' % (index, row['pid'], row['ready'], row['connections'],
+                                                                 row['accepted'], row['bytesIn'], row['bytesOut'],
+                                                                 row['ioQueued'], row['ioStallUs'] / 1000))
+    print('total %34d %10d %12d %12d %9d %11.1f' % (metrics.total('connections'), metrics.total('accepted'),
+                                                    metrics.total('bytesIn'), metrics.total('bytesOut'),
+                                                    metrics.total('ioQueued'), metrics.total('ioStallUs') / 1000),
+          flush=True)
+
+
+# Starts a process per worker and reports once all of them listen, the
+# kernel hashes each client address to one of them
+def run_workers(args):
+    metrics = sharedMetrics(args.workers)
+    processes = []
+    for index in range(args.workers):
+        process = multiprocessing.Process(target=run_worker, args=[args, metrics, index], daemon=True)
+        process.start()
+        processes.append(process)
+    # stopping the parent stops the workers as well
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        while metrics.ready_count() < args.workers:
+            if not all(process.is_alive() for process in processes):
+                print('A worker failed to start')
+                return
+            time.sleep(0.05)
+        print('%d workers ready on %s:%d' % (args.workers, args.addr, args.port), flush=True)
+        while all(process.is_alive() for process in processes):
+            if args.metrics_interval > 0:
+                time.sleep(args.metrics_interval)
+                print_metrics(metrics)
+            else:
+                time.sleep(1)
+        print('A worker exited')
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for process in processes:
+            process.terminate()
+
+
 def main():
     parser = argparse.ArgumentParser(description='The server program of LFTP')
     parser.add_argument('-p', '--port', type=int, default=9999, help='The port to listen on')
     parser.add_argument('-a', '--addr', default='0.0.0.0', help='The ip address to listen on')
     parser.add_argument('-d', '--datadir', default='.', help='The data directory of the server')
+    parser.add_argument('-s', '--segment-size', type=int, default=None,
+                        help='The largest segment size to offer, by default the one fitting the path MTU')
+    parser.add_argument('-e', '--engine', choices=['thread', 'asyncio'], default='thread',
+                        help='The transport engine running the connections')
+    parser.add_argument('-B', '--buffer-size', type=int, default=None,
+                        help='Bytes of the sending and receiving buffers of each connection, 4 MB by default')
+    parser.add_argument('-c', '--congestion', choices=['reno', 'cubic', 'bbr'], default='reno',
+                        help='The congestion controller of the connections')
+    parser.add_argument('-A', '--ack-every', type=int, default=ACK_EVERY,
+                        help='In-order segments acked together, 1 acks every segment')
+    parser.add_argument('-r', '--rate', type=int, default=None,
+                        help='Bytes per second each connection may send at most')
+    parser.add_argument('-R', '--total-rate', type=int, default=None,
+                        help='Bytes per second all the connections of a worker may send at most')
+    parser.add_argument('--no-pacing', dest='pacing', action='store_false',
+                        help='Send the window at once instead of spreading it over the round trip')
+    parser.add_argument('-i', '--io-threads', type=int, default=IO_THREADS,
+                        help='Threads reading and writing the files of each worker, 0 to do it on the connections')
+    parser.add_argument('--read-ahead', type=int, default=READ_AHEAD_SEGMENTS,
+                        help='Segments of a download read ahead by the I/O threads')
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help='Server processes sharing the port with SO_REUSEPORT')
+    parser.add_argument('-m', '--metrics-interval', type=float, default=0,
+                        help='Seconds between the metrics reports of the workers, 0 for none')
     args = parser.parse_args()
     if not re.match('^(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?)\.){3}(?:(?:25[0-5]|2[0-4][0-9]|[01]?[0-9][0-9]?))$', args.addr):
         print('The ip address is invalid!')
@@ -195,8 +470,18 @@ def main():
     if args.port > 65535 or args.port <= 0:
         print('The port number is invalid')
         return
+    if args.workers <= 0:
+        print('The number of workers is invalid')
+        return
     print('The address to listen on is %s:%d' % (args.addr, args.port))
-    lftp_server = server(args.addr, args.port, args.datadir)
+    if args.workers > 1:
+        run_workers(args)
+        return
+    lftp_server = server(args.addr, args.port, args.datadir, args.segment_size, args.engine,
+                         bufferSize=args.buffer_size, congestion=args.congestion, ackEvery=args.ack_every,
+                         pacing=args.pacing, rate=args.rate, totalRate=args.total_rate, ioThreads=args.io_threads,
+                         readAhead=args.read_ahead)
+    print('Server ready', flush=True)
     lftp_server.rudp.listener.join()
 
 